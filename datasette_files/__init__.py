@@ -4,14 +4,17 @@ from datetime import datetime, timezone
 import hashlib
 import io
 import json
+import logging
+import os
 from pathlib import Path
 import re
+import secrets
 import sqlite_utils
 import string
+import tempfile
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from html import escape
-from typing import Optional
 from datasette import hookimpl, Response, NotFound, Forbidden
 from datasette.column_types import ColumnType, SQLiteType
 from datasette.permissions import Action, PermissionSQL, Resource
@@ -25,42 +28,63 @@ from .base import (
     DEFAULT_THUMBNAIL_MAX_PIXELS,
     DEFAULT_THUMBNAIL_MAX_SOURCE_BYTES,
     DEFAULT_THUMBNAIL_MEMORY_LIMIT_BYTES,
+    DEFAULT_THUMBNAIL_SIZES,
     DEFAULT_THUMBNAIL_TIMEOUT_SECONDS,
+    DEFAULT_THUMBNAIL_WORKER_LAUNCH,
+    DEFAULT_THUMBNAIL_WORKER_MAX_JOBS,
+    THUMBNAIL_FORMATS,
+    THUMBNAIL_WORKER_LAUNCH_MODES,
     FileMetadata,
     FileTooLarge,
     StorageCapabilities as StorageCapabilities,
     ThumbnailGenerationError,
+    ThumbnailGenerator,
+    ThumbnailResult,
+    ThumbnailSource,
 )
 from .filesystem import FilesystemStorage
+from .reconcile import Drift as Drift, reconcile_catalog
+from .watch import inotify_available
+from .sync import (
+    DEFAULT_SYNC_PAGE_SIZE,
+    SYNC_SQL,
+    SyncResult,
+    sync_catalog,
+    sync_paths,
+)
+from .thumbnail_cache import (
+    DEFAULT_THUMBNAIL_MEMORY_CACHE_BYTES,
+    THUMBNAIL_CACHES,
+    CachedResponse,
+    DatabaseThumbnailCache,
+    DiskThumbnailCache,
+    RecentThumbnails,
+    ThumbnailCache,
+)
+from .tokens import (
+    DEFAULT_MAX_PENDING_UPLOADS_PER_ACTOR,
+    MemoryUploadTokenStore,
+    UPLOAD_TOKEN_STORES,
+    UploadToken as UploadToken,
+)
 
 _FILE_ID_RE = re.compile(r"^df-[a-z0-9]{26}$")
 
 
-@dataclass
-class UploadToken:
-    source_slug: str
-    filename: str
-    content_type: str
-    size: Optional[int]
-    path: str
-    file_id: str
-    created_at: float
-    used: bool = False
-    content_received: bool = False
-    actor: Optional[dict] = None
-    file_meta: Optional[FileMetadata] = None
-    actual_size: Optional[int] = None
-
-
-# Upload token store: {token_string: UploadToken}
-_upload_tokens: dict[str, UploadToken] = {}
-_UPLOAD_TOKEN_TTL = 3600  # 1 hour
 _DEFAULT_MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MB
 _MAX_FILENAME_BYTES = 255
+# Most files a single prepare-batch or complete-batch request may name
+_MAX_UPLOAD_BATCH = 1000
+# Most files a single delete-batch request may name, and how many of their
+# storage objects are deleted at once
+_MAX_DELETE_BATCH = 1000
+_DELETE_CONCURRENCY = 16
 # Cached "failed" thumbnail outcomes (read errors, generator crashes, timeouts)
 # are retried after this many seconds; "skipped" outcomes are policy decisions
 # and persist until the policy cache key changes.
 _THUMBNAIL_FAILURE_RETRY_SECONDS = 300
+# Thumbnails moved out of the internal database this many at a time
+_THUMBNAIL_MOVE_BATCH = 100
 
 pm.add_hookspecs(hookspecs)
 
@@ -83,15 +107,25 @@ class ThumbnailSettings:
     concurrency: int = DEFAULT_THUMBNAIL_CONCURRENCY
     timeout_seconds: float = DEFAULT_THUMBNAIL_TIMEOUT_SECONDS
     memory_limit_bytes: int = DEFAULT_THUMBNAIL_MEMORY_LIMIT_BYTES
+    worker_max_jobs: int = DEFAULT_THUMBNAIL_WORKER_MAX_JOBS
+    worker_launch: str = DEFAULT_THUMBNAIL_WORKER_LAUNCH
+    sizes: tuple = DEFAULT_THUMBNAIL_SIZES
+    formats: tuple = THUMBNAIL_FORMATS
+    memory_cache_bytes: int = DEFAULT_THUMBNAIL_MEMORY_CACHE_BYTES
     eager: bool = True
 
 
 @dataclass
 class _ThumbnailState:
-    """Per-instance thumbnail policy and concurrency limiter."""
+    """Per-instance thumbnail policy, concurrency limiter and caches."""
 
     settings: ThumbnailSettings
     semaphore: asyncio.Semaphore
+    cache: ThumbnailCache = field(default_factory=DiskThumbnailCache)
+    recent: RecentThumbnails = field(init=False)
+
+    def __post_init__(self):
+        self.recent = RecentThumbnails(self.settings.memory_cache_bytes)
 
 
 # In-flight eager generation tasks, referenced so they are not garbage collected
@@ -117,6 +151,127 @@ async def _drain_eager_thumbnails():
         await asyncio.wait(list(_eager_thumbnail_tasks))
 
 
+async def _close_thumbnail_generators():
+    """Let generators that keep worker processes around stop them."""
+    for generator in _thumbnail_generators:
+        close = getattr(generator, "close", None)
+        if close is not None:
+            await await_me_maybe(close())
+
+
+async def _close_sources():
+    """Let the storages configured by a previous startup release their resources."""
+    storages = list(_sources.values())
+    _sources.clear()
+    _source_meta.clear()
+    for storage in storages:
+        await storage.close()
+
+
+# Background tasks syncing sources that set sync_interval or watch
+_sync_tasks: set = set()
+_logger = logging.getLogger(__name__)
+# Seconds a watcher collects events for before updating the catalog
+DEFAULT_WATCH_DEBOUNCE = 0.5
+# How often a watched source is synced instead when inotify is unavailable
+DEFAULT_WATCH_POLL_INTERVAL = 60
+
+
+def _start_background_task(coroutine):
+    task = asyncio.create_task(coroutine)
+    _sync_tasks.add(task)
+    task.add_done_callback(_sync_tasks.discard)
+
+
+async def _sync_forever(datasette, source_slug, interval):
+    while True:
+        await _sync_logging_errors(datasette, source_slug)
+        await asyncio.sleep(interval)
+
+
+async def _sync_logging_errors(datasette, source_slug):
+    try:
+        await sync_source(datasette, source_slug)
+    except Exception:
+        _logger.exception("Syncing source %r failed", source_slug)
+
+
+def _start_sync_task(datasette, source_slug, interval):
+    _start_background_task(_sync_forever(datasette, source_slug, interval))
+
+
+def _start_watch_task(datasette, source_slug, debounce, poll_interval):
+    """Keep a filesystem source's catalog current from inotify events.
+
+    ``poll_interval`` is how often to sync instead if inotify can't be used;
+    ``None`` means a ``sync_interval`` task is already doing that, and also
+    does the initial catch-up sync.
+    """
+
+    async def run():
+        watcher = _sources[source_slug].watcher()
+        try:
+            if not inotify_available():
+                raise OSError("inotify is not available on this platform")
+            await watcher.start()
+        except OSError as ex:
+            _logger.warning(
+                "Can't watch source %r (%s), syncing it periodically instead",
+                source_slug,
+                ex,
+            )
+            if poll_interval:
+                await _sync_forever(datasette, source_slug, poll_interval)
+            return
+        try:
+            if poll_interval:
+                # Catch up with whatever changed while nothing was watching
+                await _sync_logging_errors(datasette, source_slug)
+            async for batch in watcher.batches(debounce):
+                try:
+                    await _apply_watch_batch(datasette, source_slug, batch)
+                except Exception:
+                    _logger.exception(
+                        "Updating the catalog for source %r failed", source_slug
+                    )
+        finally:
+            watcher.close()
+
+    _start_background_task(run())
+
+
+async def _apply_watch_batch(datasette, source_slug, batch):
+    if batch.overflowed:
+        await sync_source(datasette, source_slug)
+        return
+    async with _sync_lock(datasette, source_slug):
+        result = await sync_paths(
+            datasette.get_internal_database(),
+            _sources[source_slug],
+            _source_meta[source_slug]["source_id"],
+            _paths_in_use(datasette, source_slug),
+            paths=batch.paths,
+            added_dirs=batch.added_dirs,
+            removed_dirs=batch.removed_dirs,
+        )
+    await _forget_thumbnails(datasette, result.updated_ids + result.removed_ids)
+
+
+async def _stop_sync_tasks():
+    """Cancel background syncs (used by tests)."""
+    tasks = list(_sync_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _sync_lock(datasette, source_slug) -> asyncio.Lock:
+    locks = getattr(datasette, "_datasette_files_sync_locks", None)
+    if locks is None:
+        locks = datasette._datasette_files_sync_locks = {}
+    return locks.setdefault(source_slug, asyncio.Lock())
+
+
 def _thumbnail_state(datasette) -> _ThumbnailState:
     """Return this instance's thumbnail state, creating it on first use."""
     state = getattr(datasette, "_datasette_files_thumbnail_state", None)
@@ -128,6 +283,40 @@ def _thumbnail_state(datasette) -> _ThumbnailState:
     return state
 
 
+def _paths_in_use(datasette, source_slug):
+    """A ``paths_in_use(paths)`` callable for sync and reconcile: which of
+    these paths belong to uploads to the source still in progress."""
+    tokens = _token_store(datasette)
+
+    async def paths_in_use(paths):
+        return await tokens.paths_in_use(source_slug, paths)
+
+    return paths_in_use
+
+
+def _token_store(datasette):
+    """Return this instance's upload token store.
+
+    ``startup()`` installs the configured store; before then (and for instances
+    that never start up) tokens are kept in memory.
+    """
+    store = getattr(datasette, "_datasette_files_upload_tokens", None)
+    if store is None:
+        config = datasette.plugin_config("datasette-files") or {}
+        store = MemoryUploadTokenStore(max_per_actor=_max_pending_uploads(config))
+        datasette._datasette_files_upload_tokens = store
+    return store
+
+
+def _max_pending_uploads(config):
+    return _positive_number(
+        config,
+        "max_pending_uploads_per_actor",
+        DEFAULT_MAX_PENDING_UPLOADS_PER_ACTOR,
+        int,
+    )
+
+
 def _positive_number(config, key, default, converter):
     value = converter(config.get(key, default))
     if value <= 0:
@@ -135,10 +324,55 @@ def _positive_number(config, key, default, converter):
     return value
 
 
+def _thumbnail_size(value):
+    """Parse a thumbnail size given as ``"WxH"`` or ``[w, h]``."""
+    try:
+        if isinstance(value, str):
+            width, height = value.lower().split("x")
+        else:
+            width, height = value
+        size = (int(width), int(height))
+    except (TypeError, ValueError):
+        raise ValueError(
+            f"thumbnail_sizes entries must look like '200x200', got {value!r}"
+        )
+    if min(size) <= 0:
+        raise ValueError("thumbnail_sizes entries must be greater than zero")
+    return size
+
+
+def _rendition(size, format=None):
+    """The name a thumbnail is cached under, e.g. ``"200x200"`` in the
+    generator's default encoding or ``"200x200.webp"``."""
+    rendition = f"{size[0]}x{size[1]}"
+    return f"{rendition}.{format}" if format else rendition
+
+
 def _thumbnail_settings_from_config(config):
     eager = config.get("thumbnail_eager", True)
     if isinstance(eager, str):
         eager = eager.lower() not in {"0", "false", "no", "off"}
+    worker_launch = config.get(
+        "thumbnail_worker_launch", DEFAULT_THUMBNAIL_WORKER_LAUNCH
+    )
+    if worker_launch not in THUMBNAIL_WORKER_LAUNCH_MODES:
+        raise ValueError(
+            f"thumbnail_worker_launch must be one of "
+            f"{', '.join(THUMBNAIL_WORKER_LAUNCH_MODES)}"
+        )
+    sizes = tuple(
+        dict.fromkeys(
+            _thumbnail_size(size)
+            for size in config.get("thumbnail_sizes", DEFAULT_THUMBNAIL_SIZES)
+        )
+    )
+    if not sizes:
+        raise ValueError("thumbnail_sizes must list at least one size")
+    formats = config.get("thumbnail_formats", THUMBNAIL_FORMATS)
+    if isinstance(formats, str) or not set(formats) <= set(THUMBNAIL_FORMATS):
+        raise ValueError(
+            f"thumbnail_formats must be a list of {', '.join(THUMBNAIL_FORMATS)}"
+        )
     return ThumbnailSettings(
         max_source_bytes=_positive_number(
             config,
@@ -167,10 +401,61 @@ def _thumbnail_settings_from_config(config):
             DEFAULT_THUMBNAIL_MEMORY_LIMIT_BYTES,
             int,
         ),
+        worker_max_jobs=_positive_number(
+            config,
+            "thumbnail_worker_max_jobs",
+            DEFAULT_THUMBNAIL_WORKER_MAX_JOBS,
+            int,
+        ),
+        worker_launch=worker_launch,
+        sizes=sizes,
+        formats=tuple(dict.fromkeys(formats)),
+        memory_cache_bytes=_positive_number(
+            config,
+            "thumbnail_memory_cache_bytes",
+            DEFAULT_THUMBNAIL_MEMORY_CACHE_BYTES,
+            int,
+        ),
         eager=bool(eager),
     )
 
 
+def _thumbnail_formats(settings):
+    """The configured formats at least one registered generator can encode."""
+    return tuple(
+        format
+        for format in settings.formats
+        if any(
+            format in getattr(generator, "output_formats", ())
+            for generator in _thumbnail_generators
+        )
+    )
+
+
+def _negotiate_thumbnail_format(accept, formats):
+    """Pick the first of ``formats`` that an ``Accept`` header asks for.
+
+    Only explicit ``image/webp`` style entries count: plenty of clients send
+    ``*/*`` without being able to decode WebP or AVIF.
+    """
+    accepted = {}
+    for entry in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in entry.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[media_type.lower()] = quality
+    for format in formats:
+        if accepted.get(f"image/{format}", 0) > 0:
+            return format
+    return None
+
+
 def _thumbnail_cache_key(settings):
     generators = [
         [generator.name, str(getattr(generator, "version", "1"))]
@@ -188,6 +473,16 @@ def _thumbnail_cache_key(settings):
     ).hexdigest()
 
 
+def _thumbnail_version(row):
+    """Identify the content of a file row, so thumbnails of older content are
+    never served after it changes."""
+    keys = row.keys()
+    content = (row["content_hash"] if "content_hash" in keys else None) or (
+        row["sync_etag"] if "sync_etag" in keys else None
+    )
+    return f"{content or ''}:{row['size'] if 'size' in keys else ''}"
+
+
 # --- SVG file-type icon generation ---
 
 _FILE_ICON_STYLES = {
@@ -343,15 +638,19 @@ _DEFAULT_STYLE = {
 _SVG_ICON_TEMPLATE = '<svg xmlns="http://www.w3.org/2000/svg" width="200" height="200" viewBox="-2 -2 410 310"><rect x="4" y="4" width="400" height="300" rx="12" fill="#00000008"/><path d="M0,12 Q0,0 12,0 L340,0 L400,60 L400,288 Q400,300 388,300 L12,300 Q0,300 0,288 Z" fill="{bg}" stroke="{stroke}" stroke-width="2"/><path d="M340,0 L340,48 Q340,60 352,60 L400,60" fill="{fold}" stroke="{stroke}" stroke-width="2"/><rect x="100" y="110" width="200" height="80" rx="10" fill="{badge}"/><text x="200" y="150" text-anchor="middle" font-family="system-ui,sans-serif" font-size="36" font-weight="500" fill="#FFFFFF" dominant-baseline="central">{label}</text></svg>'
 
 
-def _generate_file_icon_svg(filename: str, content_type: str) -> str:
-    ext = filename.rsplit(".", 1)[-1].upper() if "." in filename else "?"
+def _file_icon_label(filename: str, content_type: str) -> str:
+    """The label shown on a file's icon, usually its extension."""
     if content_type == "text/csv":
-        ext = "CSV"
+        return "CSV"
     elif content_type == "application/pdf":
-        ext = "PDF"
+        return "PDF"
     elif content_type == "application/json":
-        ext = "JSON"
+        return "JSON"
+    return filename.rsplit(".", 1)[-1].upper() if "." in filename else "?"
 
+
+def _generate_file_icon_svg(filename: str, content_type: str) -> str:
+    ext = _file_icon_label(filename, content_type)
     style = _FILE_ICON_STYLES.get(ext)
     if not style:
         if ext in _TEXT_EXTS or (content_type and content_type.startswith("text/")):
@@ -386,9 +685,14 @@ CREATE TABLE IF NOT EXISTS datasette_files (
     created_at TEXT NOT NULL DEFAULT (datetime('now')),
     metadata TEXT DEFAULT '{}',
     search_text TEXT DEFAULT '',
+    -- Set by source syncs: the storage's version of the file
+    sync_etag TEXT,
     UNIQUE(source_id, path)
 );
 
+CREATE INDEX IF NOT EXISTS datasette_files_source_content_hash
+    ON datasette_files(source_id, content_hash);
+
 CREATE TABLE IF NOT EXISTS _datasette_files_imports (
     id INTEGER PRIMARY KEY,
     file_id TEXT NOT NULL,
@@ -406,23 +710,27 @@ CREATE TABLE IF NOT EXISTS _datasette_files_imports (
 );
 
 CREATE TABLE IF NOT EXISTS datasette_files_thumbnails (
-    file_id TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    rendition TEXT NOT NULL,
     thumbnail BLOB NOT NULL,
     content_type TEXT NOT NULL DEFAULT 'image/png',
     width INTEGER,
     height INTEGER,
     generator TEXT,
     cache_key TEXT,
-    created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    PRIMARY KEY (file_id, rendition)
 );
 
 CREATE TABLE IF NOT EXISTS datasette_files_thumbnail_failures (
-    file_id TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    rendition TEXT NOT NULL,
     status TEXT NOT NULL,
     reason TEXT NOT NULL,
     generator TEXT,
     cache_key TEXT NOT NULL,
-    created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    PRIMARY KEY (file_id, rendition)
 );
 """
 
@@ -448,7 +756,8 @@ CREATE TRIGGER IF NOT EXISTS datasette_files_ad AFTER DELETE ON datasette_files
     VALUES ('delete', old.rowid, old.id, old.filename, old.content_type, old.search_text);
 END;
 
-CREATE TRIGGER IF NOT EXISTS datasette_files_au AFTER UPDATE ON datasette_files BEGIN
+CREATE TRIGGER IF NOT EXISTS datasette_files_au
+AFTER UPDATE OF id, filename, content_type, search_text ON datasette_files BEGIN
     INSERT INTO datasette_files_fts(datasette_files_fts, rowid, id, filename, content_type, search_text)
     VALUES ('delete', old.rowid, old.id, old.filename, old.content_type, old.search_text);
     INSERT INTO datasette_files_fts(rowid, id, filename, content_type, search_text)
@@ -705,6 +1014,150 @@ async def _ensure_column(db, table, column, definition):
         await db.execute_write(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
 
+async def _migrate_thumbnail_renditions(db):
+    """Key cached thumbnails by file and rendition (migration helper).
+
+    Older databases keyed them by file alone, holding one 200x200 thumbnail
+    per file. SQLite can't change a primary key in place, so the table is
+    rebuilt.
+    """
+    columns = (await db.execute("PRAGMA table_info(datasette_files_thumbnails)")).rows
+    if "rendition" in {row["name"] for row in columns}:
+        return
+
+    def migrate(conn):
+        conn.execute(
+            "ALTER TABLE datasette_files_thumbnails "
+            "RENAME TO _datasette_files_thumbnails_old"
+        )
+        conn.execute("""
+            CREATE TABLE datasette_files_thumbnails (
+                file_id TEXT NOT NULL,
+                rendition TEXT NOT NULL,
+                thumbnail BLOB NOT NULL,
+                content_type TEXT NOT NULL DEFAULT 'image/png',
+                width INTEGER,
+                height INTEGER,
+                generator TEXT,
+                cache_key TEXT,
+                created_at TEXT NOT NULL DEFAULT (datetime('now')),
+                PRIMARY KEY (file_id, rendition)
+            )
+            """)
+        conn.execute("""
+            INSERT INTO datasette_files_thumbnails
+                (file_id, rendition, thumbnail, content_type, width, height,
+                 generator, cache_key, created_at)
+            SELECT file_id, '200x200', thumbnail, content_type, width, height,
+                   generator, cache_key, created_at
+            FROM _datasette_files_thumbnails_old
+            """)
+        conn.execute("DROP TABLE _datasette_files_thumbnails_old")
+
+    await db.execute_write_fn(migrate)
+
+
+async def _migrate_thumbnail_failure_renditions(db):
+    """Key thumbnail failures by file and rendition (migration helper).
+
+    Older databases keyed them by file alone, so one rendition failing
+    marked them all as failed. Their failures were all for the single
+    200x200 thumbnail they made.
+    """
+    columns = (
+        await db.execute("PRAGMA table_info(datasette_files_thumbnail_failures)")
+    ).rows
+    if "rendition" in {row["name"] for row in columns}:
+        return
+
+    def migrate(conn):
+        conn.execute(
+            "ALTER TABLE datasette_files_thumbnail_failures "
+            "RENAME TO _datasette_files_thumbnail_failures_old"
+        )
+        conn.execute("""
+            CREATE TABLE datasette_files_thumbnail_failures (
+                file_id TEXT NOT NULL,
+                rendition TEXT NOT NULL,
+                status TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                generator TEXT,
+                cache_key TEXT NOT NULL,
+                created_at TEXT NOT NULL DEFAULT (datetime('now')),
+                PRIMARY KEY (file_id, rendition)
+            )
+            """)
+        conn.execute("""
+            INSERT INTO datasette_files_thumbnail_failures
+                (file_id, rendition, status, reason, generator, cache_key,
+                 created_at)
+            SELECT file_id, '200x200', status, reason, generator, cache_key,
+                   created_at
+            FROM _datasette_files_thumbnail_failures_old
+            """)
+        conn.execute("DROP TABLE _datasette_files_thumbnail_failures_old")
+
+    await db.execute_write_fn(migrate)
+
+
+async def _move_thumbnails_to_cache(db, cache):
+    """Move thumbnails kept in the internal database into ``cache`` (migration
+    helper).
+
+    Earlier versions kept every thumbnail there, as ``thumbnail_cache:
+    database`` still does. Thumbnails of files no longer in the catalog are
+    dropped.
+    """
+    while True:
+        rows = (
+            await db.execute(
+                """
+                SELECT t.rowid AS thumbnail_rowid, t.file_id, t.rendition,
+                       t.thumbnail, t.content_type, t.width, t.height,
+                       t.generator, t.cache_key, f.id, f.content_hash,
+                       f.sync_etag, f.size
+                FROM datasette_files_thumbnails t
+                LEFT JOIN datasette_files f ON f.id = t.file_id
+                ORDER BY t.file_id
+                LIMIT ?
+                """,
+                [_THUMBNAIL_MOVE_BATCH],
+            )
+        ).rows
+        if not rows:
+            return
+        batches = {}
+        for row in rows:
+            if row["id"] is None or row["cache_key"] is None:
+                continue
+            batches.setdefault(
+                (row["file_id"], _thumbnail_version(row), row["cache_key"]), []
+            ).append(row)
+        for (file_id, version, cache_key), batch in batches.items():
+            await cache.put(
+                file_id,
+                version,
+                cache_key,
+                batch[0]["generator"],
+                {
+                    row["rendition"]: ThumbnailResult(
+                        thumb_bytes=row["thumbnail"],
+                        content_type=row["content_type"],
+                        width=row["width"],
+                        height=row["height"],
+                    )
+                    for row in batch
+                },
+            )
+        await db.execute_write(
+            """
+            DELETE FROM datasette_files_thumbnails
+            WHERE rowid IN (SELECT value FROM json_each(?))
+            """,
+            [json.dumps([row["thumbnail_rowid"] for row in rows])],
+        )
+
+
 @hookimpl
 def startup(datasette):
     async def inner():
@@ -714,6 +1167,10 @@ def startup(datasette):
         # Migrate pre-existing databases
         await _ensure_column(db, "datasette_files", "search_text", "TEXT DEFAULT ''")
         await _ensure_column(db, "datasette_files_thumbnails", "cache_key", "TEXT")
+        await _migrate_thumbnail_renditions(db)
+        await _migrate_thumbnail_failure_renditions(db)
+        await _ensure_column(db, "datasette_files", "sync_etag", "TEXT")
+        await db.execute_write_script(SYNC_SQL)
 
         # Drop and recreate FTS table + triggers to ensure schema matches
         # (safe because FTS is a secondary index rebuilt from content table)
@@ -743,11 +1200,37 @@ def startup(datasette):
         # Read source definitions from plugin config
         config = datasette.plugin_config("datasette-files") or {}
         settings = _thumbnail_settings_from_config(config)
+        cache_name = config.get("thumbnail_cache", "disk")
+        if cache_name not in THUMBNAIL_CACHES:
+            raise ValueError(
+                f"Unknown thumbnail_cache '{cache_name}'. "
+                f"Available: {list(THUMBNAIL_CACHES.keys())}"
+            )
+        if cache_name == "disk":
+            thumbnail_cache = DiskThumbnailCache(
+                config.get("thumbnail_cache_directory")
+            )
+        else:
+            thumbnail_cache = THUMBNAIL_CACHES[cache_name]()
+        await thumbnail_cache.startup(datasette)
         datasette._datasette_files_thumbnail_state = _ThumbnailState(
-            settings, asyncio.Semaphore(settings.concurrency)
+            settings, asyncio.Semaphore(settings.concurrency), thumbnail_cache
         )
+        store_name = config.get("upload_token_store", "memory")
+        if store_name not in UPLOAD_TOKEN_STORES:
+            raise ValueError(
+                f"Unknown upload_token_store '{store_name}'. "
+                f"Available: {list(UPLOAD_TOKEN_STORES.keys())}"
+            )
+        token_store = UPLOAD_TOKEN_STORES[store_name](
+            max_per_actor=_max_pending_uploads(config)
+        )
+        await token_store.startup(datasette)
+        datasette._datasette_files_upload_tokens = token_store
+
         sources_config = config.get("sources") or {}
 
+        await _close_sources()
         for slug, source_def in sources_config.items():
             storage_type_name = source_def.get("storage")
             if storage_type_name not in storage_types:
@@ -785,15 +1268,40 @@ def startup(datasette):
                 )
             ).first()
 
+            sync_interval = source_def.get("sync_interval")
+            if sync_interval is not None:
+                sync_interval = _positive_number(
+                    source_def, "sync_interval", None, float
+                )
+                if not storage.capabilities.can_list:
+                    raise ValueError(
+                        f"Source '{slug}' sets sync_interval but its storage "
+                        "does not support listing files"
+                    )
+
+            watch = bool(source_def.get("watch", False))
+            if watch and not isinstance(storage, FilesystemStorage):
+                raise ValueError(
+                    f"Source '{slug}' sets watch but only filesystem sources "
+                    "can be watched"
+                )
+            watch_debounce = _positive_number(
+                source_def, "watch_debounce", DEFAULT_WATCH_DEBOUNCE, float
+            )
+
             _sources[slug] = storage
             _source_meta[slug] = {
                 "slug": slug,
                 "storage_type": storage_type_name,
                 "source_id": row["id"],
                 "capabilities": storage.capabilities,
+                "sync_interval": sync_interval,
+                "watch": watch,
+                "watch_debounce": watch_debounce,
             }
 
         # Collect thumbnail generators
+        await _close_thumbnail_generators()
         _thumbnail_generators.clear()
         for hook in pm.hook.register_thumbnail_generators(datasette=datasette):
             result = await await_me_maybe(hook)
@@ -801,6 +1309,17 @@ def startup(datasette):
                 for gen in result:
                     _thumbnail_generators.append(gen)
 
+        for slug, meta in _source_meta.items():
+            if meta["sync_interval"]:
+                _start_sync_task(datasette, slug, meta["sync_interval"])
+            if meta["watch"]:
+                _start_watch_task(
+                    datasette,
+                    slug,
+                    meta["watch_debounce"],
+                    None if meta["sync_interval"] else DEFAULT_WATCH_POLL_INTERVAL,
+                )
+
         # Adopt thumbnails from databases created before cache keys existed.
         # They were valid when generated; regenerating them under the current
         # limits could permanently replace working thumbnails with icons.
@@ -808,6 +1327,39 @@ def startup(datasette):
             "UPDATE datasette_files_thumbnails SET cache_key = ? WHERE cache_key IS NULL",
             [_thumbnail_cache_key(settings)],
         )
+        if not isinstance(thumbnail_cache, DatabaseThumbnailCache):
+            await _move_thumbnails_to_cache(db, thumbnail_cache)
+
+        # Drop thumbnails of deleted files, and of sizes and formats no
+        # longer configured. A large disk cache takes a while to walk, so
+        # that happens in the background.
+        async def versions(file_ids):
+            rows = (
+                await db.execute(
+                    """
+                    SELECT id, content_hash, sync_etag, size FROM datasette_files
+                    WHERE id IN (SELECT value FROM json_each(?))
+                    """,
+                    [json.dumps(file_ids)],
+                )
+            ).rows
+            return {row["id"]: _thumbnail_version(row) for row in rows}
+
+        async def prune_thumbnails():
+            try:
+                await thumbnail_cache.prune(
+                    _thumbnail_cache_key(settings),
+                    [
+                        _rendition(size, format)
+                        for size in settings.sizes
+                        for format in (None, *_thumbnail_formats(settings))
+                    ],
+                    versions,
+                )
+            except Exception:
+                _logger.exception("Pruning the thumbnail cache failed")
+
+        _start_background_task(prune_thumbnails())
 
     return inner
 
@@ -841,14 +1393,18 @@ async def upload_page(request, datasette):
     )
 
 
-def _clean_expired_tokens():
-    """Remove expired upload tokens."""
-    now = time.time()
-    expired = [
-        t for t, v in _upload_tokens.items() if now - v.created_at > _UPLOAD_TOKEN_TTL
-    ]
-    for t in expired:
-        del _upload_tokens[t]
+async def _clean_expired_tokens(datasette):
+    """Remove expired upload tokens and their staged resumable uploads."""
+    for token_data in await _token_store(datasette).remove_expired():
+        if token_data.staging_path:
+            await asyncio.to_thread(_unlink_staging_file, token_data.staging_path)
+
+
+def _unlink_staging_file(staging_path):
+    try:
+        os.unlink(staging_path)
+    except FileNotFoundError:
+        pass
 
 
 _ALNUM = set(string.ascii_letters + string.digits)
@@ -902,9 +1458,11 @@ def _etag_for_bytes(content: bytes) -> str:
     return f'"{hashlib.md5(content).hexdigest()}"'
 
 
-def _response_with_etag(request, body: bytes, content_type: str):
-    etag = _etag_for_bytes(body)
-    headers = {"ETag": etag}
+def _response_with_etag(
+    request, body: bytes, content_type: str, headers=None, etag=None
+):
+    etag = etag or _etag_for_bytes(body)
+    headers = {**(headers or {}), "ETag": etag}
     if request.headers.get("if-none-match") == etag:
         return Response(body=b"", status=304, headers=headers)
     return Response(body=body, content_type=content_type, headers=headers)
@@ -937,14 +1495,75 @@ async def upload_prepare(request, datasette):
     except (json.JSONDecodeError, ValueError):
         return _error("Invalid JSON")
 
-    filename = body.get("filename")
-    if not filename:
+    if not isinstance(body, dict) or not body.get("filename"):
         return _error("filename is required")
 
-    content_type = body.get("content_type", "application/octet-stream")
-    size = body.get("size")
+    await _clean_expired_tokens(datasette)
+    instructions = await _prepare_upload(datasette, request, source_slug, body)
+    if instructions is None:
+        return _too_many_uploads()
+    return Response.json({"ok": True, **instructions})
+
+
+async def upload_prepare_batch(request, datasette):
+    """POST /-/files/upload/{source_slug}/-/prepare-batch - instructions for many files.
+
+    Takes ``{"files": [{"filename": ..., "content_type": ..., "size": ...}]}``
+    and returns ``{"ok": true, "uploads": [...]}``, one set of upload
+    instructions per file in the same order.
+    """
+    source_slug = request.url_vars["source_slug"]
+    if source_slug not in _sources:
+        raise NotFound(f"Source not found: {source_slug}")
+
+    error = await _check_upload_permission_json(datasette, request, source_slug)
+    if error:
+        return error
+
+    try:
+        body = json.loads(await request.post_body())
+    except (json.JSONDecodeError, ValueError):
+        return _error("Invalid JSON")
+
+    files = body.get("files") if isinstance(body, dict) else None
+    if not isinstance(files, list) or not files:
+        return _error("files must be a non-empty list")
+    if len(files) > _MAX_UPLOAD_BATCH:
+        return _error(f"A batch can contain at most {_MAX_UPLOAD_BATCH} files")
+    for i, spec in enumerate(files):
+        if not isinstance(spec, dict) or not spec.get("filename"):
+            return _error(f"files[{i}]: filename is required")
+
+    await _clean_expired_tokens(datasette)
+    uploads = []
+    for spec in files:
+        instructions = await _prepare_upload(datasette, request, source_slug, spec)
+        if instructions is None:
+            # All or nothing: don't leave half a batch holding tokens
+            tokens = _token_store(datasette)
+            await tokens.remove_many([u["upload_token"] for u in uploads])
+            return _too_many_uploads()
+        uploads.append(instructions)
+    return Response.json({"ok": True, "uploads": uploads})
+
+
+def _too_many_uploads():
+    return _error(
+        "Too many uploads in progress - complete them or wait for them to expire",
+        status=429,
+    )
+
 
-    filename = _sanitize_filename(filename)
+async def _prepare_upload(datasette, request, source_slug, spec):
+    """Issue an upload token for one file described by ``spec``.
+
+    Returns the upload instructions, or None if the actor already has too
+    many uploads in progress.
+    """
+    content_type = spec.get("content_type", "application/octet-stream")
+    size = spec.get("size")
+
+    filename = _sanitize_filename(spec["filename"])
 
     # Generate file ID and storage path
     file_id = "df-" + str(ULID()).lower()
@@ -952,47 +1571,120 @@ async def upload_prepare(request, datasette):
     path = f"{ulid_part}/{filename}"
 
     # Generate upload token
-    _clean_expired_tokens()
     token = "tok_" + str(ULID()).lower()
-    _upload_tokens[token] = UploadToken(
-        source_slug=source_slug,
-        filename=filename,
-        content_type=content_type,
-        size=size,
-        path=path,
-        file_id=file_id,
-        created_at=time.time(),
-        actor=request.actor,
+    added = await _token_store(datasette).add(
+        token,
+        UploadToken(
+            source_slug=source_slug,
+            filename=filename,
+            content_type=content_type,
+            size=size,
+            path=path,
+            file_id=file_id,
+            created_at=time.time(),
+            actor=request.actor,
+        ),
     )
+    if not added:
+        return None
 
     # Build upload URL - for filesystem, it points to our upload endpoint
     upload_url = datasette.urls.path(f"/-/files/upload/{source_slug}/-/upload")
 
-    return Response.json(
-        {
-            "ok": True,
+    instructions = {
+        "upload_token": token,
+        "upload_url": upload_url,
+        "upload_method": "POST",
+        "upload_headers": {},
+        "upload_fields": {
             "upload_token": token,
-            "upload_url": upload_url,
-            "upload_method": "POST",
-            "upload_headers": {},
-            "upload_fields": {
-                "upload_token": token,
-            },
-        }
-    )
+        },
+    }
+    # Resumable uploads need to know when the last byte has arrived
+    if isinstance(size, int) and not isinstance(size, bool) and size >= 0:
+        instructions["resumable_url"] = f"{upload_url}/{token}"
+    return instructions
+
+
+def _upload_too_large(max_size):
+    return _error(f"File exceeds the maximum upload size of {max_size} bytes", 413)
+
+
+async def _token_for_content(datasette, source_slug, token_value):
+    """Look up a token that is about to receive file content.
+
+    Returns ``(token_data, None)``, or ``(None, error_response)``.
+    """
+    if not token_value:
+        return None, _error("upload_token is required")
+
+    token_data = await _token_store(datasette).get(token_value)
+    if not token_data:
+        return None, _error("Invalid or expired upload token")
+
+    if token_data.source_slug != source_slug:
+        return None, _error("Token does not match this source")
+
+    if token_data.content_received:
+        return None, _error("Content already uploaded for this token")
+
+    return token_data, None
+
+
+def _upload_in_progress():
+    return _error("Another request is already uploading to this token", 409)
+
+
+async def _receive_content(datasette, token_value, token_data, store):
+    """Await ``store``, a storage ``receive_upload()`` or ``receive_file()`` call,
+    and record the result on the token.
+
+    Returns an error response if another request is already sending content for
+    the token, otherwise None.
+    """
+    tokens = _token_store(datasette)
+    if not await tokens.claim(token_value):
+        store.close()
+        return _upload_in_progress()
+    try:
+        file_meta = await store
+
+        # Save metadata on the token for the complete step
+        token_data.content_received = True
+        token_data.file_meta = file_meta
+        token_data.actual_size = file_meta.size
+        if token_data.staging_path:
+            # A resumable upload was started and then abandoned for this one
+            await asyncio.to_thread(_unlink_staging_file, token_data.staging_path)
+            token_data.staging_path = None
+        await tokens.save(token_value, token_data)
+    finally:
+        await tokens.release(token_value)
+    return None
 
 
 async def upload_content(request, datasette):
-    """POST /-/files/upload/{source_slug}/-/upload - receive file bytes"""
+    """POST or PUT /-/files/upload/{source_slug}/-/upload - receive file bytes
+
+    POST takes a multipart form with ``upload_token`` and ``file`` fields. PUT
+    takes the file itself as the request body, with the token in ``?token=``,
+    and streams it to the storage backend without spooling it to disk first.
+    """
     source_slug = request.url_vars["source_slug"]
     if source_slug not in _sources:
         raise NotFound(f"Source not found: {source_slug}")
 
     storage = _sources[source_slug]
 
-    # Parse multipart form — use storage's max_file_size if configured,
-    # otherwise use the default limit.
+    # Use storage's max_file_size if configured, otherwise the default limit.
     max_size = storage.capabilities.max_file_size or _DEFAULT_MAX_FILE_SIZE
+
+    if request.method == "PUT":
+        return await _upload_request_body(
+            request, datasette, storage, source_slug, max_size
+        )
+
+    # Parse multipart form
     form = await request.form(
         files=True,
         max_file_size=max_size,
@@ -1000,32 +1692,19 @@ async def upload_content(request, datasette):
     )
     try:
         token_value = form.get("upload_token")
-        if not token_value or (hasattr(token_value, "read") and not token_value):
-            # Try string value
-            pass
         if hasattr(token_value, "read"):
             token_value = None
 
-        if not token_value:
-            return _error("upload_token is required")
-
-        token_data = _upload_tokens.get(token_value)
-        if not token_data:
-            return _error("Invalid or expired upload token")
-
-        if token_data.source_slug != source_slug:
-            return _error("Token does not match this source")
-
-        if token_data.content_received:
-            return _error("Content already uploaded for this token")
+        token_data, error = await _token_for_content(
+            datasette, source_slug, token_value
+        )
+        if error:
+            return error
 
         uploaded = form.get("file")
         if uploaded is None or not hasattr(uploaded, "read"):
             return _error("No file provided")
 
-        content_type = token_data.content_type
-        path = token_data.path
-
         # Stream file chunks to the storage backend
         async def _upload_chunks(uploaded_file, chunk_size=65536):
             while True:
@@ -1034,117 +1713,416 @@ async def upload_content(request, datasette):
                     break
                 yield chunk
 
-        file_meta = await storage.receive_upload(
-            path, _upload_chunks(uploaded), content_type
+        store = storage.receive_upload(
+            token_data.path, _upload_chunks(uploaded), token_data.content_type
         )
-
-        # Save metadata on the token for the complete step
-        token_data.content_received = True
-        token_data.file_meta = file_meta
-        token_data.actual_size = file_meta.size
-
-        return Response.json({"ok": True})
+        error = await _receive_content(datasette, token_value, token_data, store)
+        return error or Response.json({"ok": True})
     finally:
         await form.aclose()
 
 
-async def upload_complete(request, datasette):
-    """POST /-/files/upload/{source_slug}/-/complete - finalize upload and register file."""
-    source_slug = request.url_vars["source_slug"]
-    if source_slug not in _sources:
-        raise NotFound(f"Source not found: {source_slug}")
-
-    error = await _check_upload_permission_json(datasette, request, source_slug)
+async def _upload_request_body(request, datasette, storage, source_slug, max_size):
+    token_value = request.args.get("token")
+    token_data, error = await _token_for_content(datasette, source_slug, token_value)
     if error:
         return error
 
-    meta = _source_meta[source_slug]
+    try:
+        if int(request.headers.get("content-length", "")) > max_size:
+            return _upload_too_large(max_size)
+    except ValueError:
+        # Missing (chunked transfer encoding) or malformed - counted below
+        pass
+
+    async def _limited_chunks():
+        received = 0
+        async for chunk in _request_body_chunks(request):
+            received += len(chunk)
+            if received > max_size:
+                raise FileTooLarge(f"Upload exceeded {max_size} bytes")
+            yield chunk
 
     try:
-        body = json.loads(await request.post_body())
-    except (json.JSONDecodeError, ValueError):
-        return _error("Invalid JSON")
+        error = await _receive_content(
+            datasette,
+            token_value,
+            token_data,
+            storage.receive_upload(
+                token_data.path, _limited_chunks(), token_data.content_type
+            ),
+        )
+    except FileTooLarge:
+        return _upload_too_large(max_size)
+    except _ClientDisconnected:
+        # Nobody is listening; the token can be used to try again
+        return Response(body=b"", status=400)
+    return error or Response.json({"ok": True})
 
-    token_value = body.get("upload_token")
-    if not token_value:
-        return _error("upload_token is required")
 
-    token_data = _upload_tokens.get(token_value)
-    if not token_data:
-        return _error("Invalid or expired upload token")
+class _ClientDisconnected(Exception):
+    pass
 
-    if token_data.source_slug != source_slug:
-        return _error("Token does not match this source")
 
-    if not token_data.content_received:
-        return _error("File content has not been uploaded yet")
+async def _request_body_chunks(request):
+    """Yield the raw request body as it arrives.
 
-    if token_data.used:
-        return _error("This upload token has already been used")
+    Raises ``_ClientDisconnected`` if the client goes away before sending all of it.
+    """
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            raise _ClientDisconnected()
+        chunk = message.get("body", b"")
+        if chunk:
+            yield chunk
+        if not message.get("more_body", False):
+            return
 
-    # Mark token as used
-    token_data.used = True
 
-    file_id = token_data.file_id
-    file_meta = token_data.file_meta
-    filename = token_data.filename
-    content_type = token_data.content_type
-    path = token_data.path
-    actor = token_data.actor
+def _resumable_headers(token_data):
+    return {
+        "Upload-Offset": str(token_data.offset),
+        "Upload-Length": str(token_data.size),
+        "Cache-Control": "no-store",
+    }
+
+
+async def upload_resumable(request, datasette):
+    """HEAD/PATCH /-/files/upload/{source_slug}/-/upload/{token} - resumable upload.
+
+    HEAD reports how many bytes have been received. PATCH appends the request
+    body at ``Upload-Offset``; once ``size`` bytes have arrived the staged file
+    is handed to the storage backend, after which the upload is completed as
+    usual.
+    """
+    source_slug = request.url_vars["source_slug"]
+    if source_slug not in _sources:
+        raise NotFound(f"Source not found: {source_slug}")
+
+    token_value = request.url_vars["upload_token"]
+    tokens = _token_store(datasette)
+    token_data = await tokens.get(token_value)
+    if not token_data or token_data.source_slug != source_slug:
+        raise NotFound("Invalid or expired upload token")
+    if token_data.size is None:
+        return _error("Resumable uploads require a size in the prepare request")
+
+    storage = _sources[source_slug]
+    max_size = storage.capabilities.max_file_size or _DEFAULT_MAX_FILE_SIZE
+
+    if request.method == "HEAD":
+        return Response(body=b"", status=200, headers=_resumable_headers(token_data))
+    if request.method != "PATCH":
+        return Response(body=b"", status=405, headers={"Allow": "HEAD, PATCH"})
+
+    if token_data.content_received:
+        return _error("Content already uploaded for this token", status=409)
+    if token_data.size > max_size:
+        return _upload_too_large(max_size)
+    if request.headers.get("content-type") != "application/offset+octet-stream":
+        return _error(
+            "Content-Type must be application/offset+octet-stream", status=415
+        )
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        return _error("Upload-Offset header is required")
+
+    if not await tokens.claim(token_value):
+        return _upload_in_progress()
+    try:
+        # Re-read under the claim: another request may have sent bytes, or
+        # finished the upload, since the lookup above
+        token_data = await tokens.get(token_value)
+        if token_data is None or token_data.content_received:
+            return _error("Content already uploaded for this token", status=409)
+        if offset != token_data.offset:
+            return Response.json(
+                {"ok": False, "errors": ["Upload-Offset does not match"]},
+                status=409,
+                headers=_resumable_headers(token_data),
+            )
+        if token_data.staging_path is None:
+            fd, token_data.staging_path = await asyncio.to_thread(
+                tempfile.mkstemp,
+                prefix="datasette-files-",
+                suffix=".part",
+                dir=await storage.staging_directory(),
+            )
+            os.close(fd)
+            token_data.staging_sha256 = hashlib.sha256()
+        try:
+            staging = await asyncio.to_thread(open, token_data.staging_path, "r+b")
+        except FileNotFoundError:
+            # Staged on another machine, or lost to a restart, when tokens
+            # are kept in the database. The bytes are gone: start again from
+            # zero rather than asking for them forever.
+            token_data.offset = 0
+            token_data.staging_path = None
+            token_data.staging_sha256 = None
+            return Response.json(
+                {
+                    "ok": False,
+                    "errors": [
+                        "The content received so far for this upload is not "
+                        "on this server: send it again from the start"
+                    ],
+                },
+                status=409,
+                headers=_resumable_headers(token_data),
+            )
+        try:
+            # Discard anything past the acknowledged offset, e.g. a chunk whose
+            # write was interrupted
+            await asyncio.to_thread(staging.truncate, token_data.offset)
+            await asyncio.to_thread(staging.seek, token_data.offset)
+            async for chunk in _request_body_chunks(request):
+                if token_data.offset + len(chunk) > token_data.size:
+                    return _error(
+                        "Upload exceeds the size given in the prepare request",
+                        status=413,
+                    )
+                await asyncio.to_thread(staging.write, chunk)
+                await asyncio.to_thread(staging.flush)
+                # Record progress per chunk so a dropped connection keeps
+                # everything written so far
+                token_data.offset += len(chunk)
+                if token_data.staging_sha256 is not None:
+                    token_data.staging_sha256.update(chunk)
+        except _ClientDisconnected:
+            # Keep what arrived; the client will ask for the offset with HEAD
+            return Response(body=b"", status=400)
+        finally:
+            await asyncio.to_thread(staging.close)
+
+        if token_data.offset == token_data.size:
+            await _finish_resumable_upload(storage, token_data)
+        return Response(body=b"", status=204, headers=_resumable_headers(token_data))
+    finally:
+        if token_data is not None:
+            # Persist the offset even when the request was cut short
+            await tokens.save(token_value, token_data)
+        await tokens.release(token_value)
+
+
+async def _finish_resumable_upload(storage, token_data):
+    staging_path = token_data.staging_path
+    content_hash = None
+    if token_data.staging_sha256 is not None:
+        content_hash = "sha256:" + token_data.staging_sha256.hexdigest()
+    # The backend may move the staging file into place rather than copy it
+    file_meta = await storage.receive_file(
+        token_data.path, staging_path, token_data.content_type, content_hash
+    )
+    await asyncio.to_thread(_unlink_staging_file, staging_path)
+    token_data.staging_path = None
+    token_data.staging_sha256 = None
+    token_data.content_received = True
+    token_data.file_meta = file_meta
+    token_data.actual_size = file_meta.size
+
+
+async def upload_complete(request, datasette):
+    """POST /-/files/upload/{source_slug}/-/complete - finalize upload and register file."""
+    source_slug = request.url_vars["source_slug"]
+    if source_slug not in _sources:
+        raise NotFound(f"Source not found: {source_slug}")
+
+    error = await _check_upload_permission_json(datasette, request, source_slug)
+    if error:
+        return error
+
+    meta = _source_meta[source_slug]
+
+    try:
+        body = json.loads(await request.post_body())
+    except (json.JSONDecodeError, ValueError):
+        return _error("Invalid JSON")
+
+    token_value = body.get("upload_token") if isinstance(body, dict) else None
+    if not token_value:
+        return _error("upload_token is required")
+
+    tokens = _token_store(datasette)
+    token_data, message = await _completable_token(tokens, source_slug, token_value)
+    if message:
+        return _error(message)
+
+    # Mark token as used - atomically, so two complete requests can't both
+    # register the file
+    if not await tokens.mark_used(token_value):
+        return _error("This upload token has already been used")
 
     # Record in internal database
     db = datasette.get_internal_database()
     await db.execute_write(
-        """
-        INSERT INTO datasette_files
-            (id, source_id, path, filename, content_type, content_hash, size, uploaded_by)
-        VALUES
-            (:id, :source_id, :path, :filename, :content_type, :content_hash, :size, :uploaded_by)
-        """,
-        {
-            "id": file_id,
-            "source_id": meta["source_id"],
-            "path": path,
-            "filename": filename,
-            "content_type": file_meta.content_type or content_type,
-            "content_hash": file_meta.content_hash,
-            "size": file_meta.size or token_data.actual_size,
-            "uploaded_by": (actor or {}).get("id"),
-        },
+        _INSERT_FILE_SQL, _file_row_params(token_data, meta["source_id"])
     )
 
     # Clean up token
-    del _upload_tokens[token_value]
+    await tokens.remove(token_value)
 
     # Fetch the created record for the response
+    file_id = token_data.file_id
     row = await _get_file_record(datasette, file_id)
+    _file_registered(datasette, file_id, row)
+
+    return Response.json(
+        {"ok": True, "file": _uploaded_file_json(datasette, row)}, status=201
+    )
+
+
+async def upload_complete_batch(request, datasette):
+    """POST /-/files/upload/{source_slug}/-/complete-batch - register many uploads.
+
+    Takes ``{"upload_tokens": [...]}``. Every upload that can be completed is
+    registered in a single internal database transaction. The response has one
+    entry per token in ``uploads``, in the same order, each either with the
+    registered ``file`` or an ``error``; ``ok`` is true only if all succeeded.
+    """
+    source_slug = request.url_vars["source_slug"]
+    if source_slug not in _sources:
+        raise NotFound(f"Source not found: {source_slug}")
+
+    error = await _check_upload_permission_json(datasette, request, source_slug)
+    if error:
+        return error
+
+    meta = _source_meta[source_slug]
 
+    try:
+        body = json.loads(await request.post_body())
+    except (json.JSONDecodeError, ValueError):
+        return _error("Invalid JSON")
+
+    token_values = body.get("upload_tokens") if isinstance(body, dict) else None
+    if (
+        not isinstance(token_values, list)
+        or not token_values
+        or not all(isinstance(t, str) and t for t in token_values)
+    ):
+        return _error("upload_tokens must be a non-empty list of tokens")
+    if len(token_values) > _MAX_UPLOAD_BATCH:
+        return _error(f"A batch can contain at most {_MAX_UPLOAD_BATCH} files")
+    token_values = list(dict.fromkeys(token_values))
+
+    tokens = _token_store(datasette)
+    errors = {}
+    completable = {}
+    for token_value in token_values:
+        token_data, message = await _completable_token(tokens, source_slug, token_value)
+        if message:
+            errors[token_value] = message
+        else:
+            completable[token_value] = token_data
+
+    marked = set(await tokens.mark_used_many(list(completable)))
+    completed = [t for t in completable if t in marked]
+    for token_value in completable:
+        if token_value not in marked:
+            errors[token_value] = "This upload token has already been used"
+
+    rows = {}
+    if completed:
+        db = datasette.get_internal_database()
+        await db.execute_write_many(
+            _INSERT_FILE_SQL,
+            [_file_row_params(completable[t], meta["source_id"]) for t in completed],
+        )
+        await tokens.remove_many(completed)
+        rows = await _get_file_records(
+            datasette, [completable[t].file_id for t in completed]
+        )
+
+    uploads = []
+    for token_value in token_values:
+        if token_value in errors:
+            uploads.append(
+                {"upload_token": token_value, "ok": False, "error": errors[token_value]}
+            )
+            continue
+        file_id = completable[token_value].file_id
+        row = rows[file_id]
+        _file_registered(datasette, file_id, row)
+        uploads.append(
+            {
+                "upload_token": token_value,
+                "ok": True,
+                "file": _uploaded_file_json(datasette, row),
+            }
+        )
+    return Response.json({"ok": not errors, "uploads": uploads})
+
+
+_INSERT_FILE_SQL = """
+INSERT INTO datasette_files
+    (id, source_id, path, filename, content_type, content_hash, size, uploaded_by)
+VALUES
+    (:id, :source_id, :path, :filename, :content_type, :content_hash, :size, :uploaded_by)
+"""
+
+
+async def _completable_token(tokens, source_slug, token_value):
+    """Look up a token that is about to be completed.
+
+    Returns ``(token_data, None)``, or ``(None, error_message)``.
+    """
+    token_data = await tokens.get(token_value)
+    if not token_data:
+        return None, "Invalid or expired upload token"
+
+    if token_data.source_slug != source_slug:
+        return None, "Token does not match this source"
+
+    if not token_data.content_received:
+        return None, "File content has not been uploaded yet"
+
+    if token_data.used:
+        return None, "This upload token has already been used"
+
+    return token_data, None
+
+
+def _file_row_params(token_data, source_id):
+    """Parameters for ``_INSERT_FILE_SQL`` registering a received upload."""
+    file_meta = token_data.file_meta
+    return {
+        "id": token_data.file_id,
+        "source_id": source_id,
+        "path": token_data.path,
+        "filename": token_data.filename,
+        "content_type": file_meta.content_type or token_data.content_type,
+        "content_hash": file_meta.content_hash,
+        "size": file_meta.size or token_data.actual_size,
+        "uploaded_by": (token_data.actor or {}).get("id"),
+    }
+
+
+def _file_registered(datasette, file_id, row):
     # Eager generation happens in the background: the upload response must not
     # queue behind the shared generation slot.
     if _thumbnail_state(datasette).settings.eager:
         _schedule_eager_thumbnail(datasette, file_id, row)
 
-    return Response.json(
-        {
-            "ok": True,
-            "file": {
-                "id": file_id,
-                "filename": row["filename"],
-                "content_type": row["content_type"],
-                "content_hash": row["content_hash"],
-                "size": row["size"],
-                "width": row["width"],
-                "height": row["height"],
-                "source_slug": row["source_slug"],
-                "uploaded_by": row["uploaded_by"],
-                "created_at": row["created_at"],
-                "url": datasette.urls.path(f"/-/files/{file_id}"),
-                "download_url": datasette.urls.path(f"/-/files/{file_id}/download"),
-                "thumbnail_url": datasette.urls.path(f"/-/files/{file_id}/thumbnail"),
-            },
-        },
-        status=201,
-    )
+
+def _uploaded_file_json(datasette, row):
+    file_id = row["id"]
+    return {
+        "id": file_id,
+        "filename": row["filename"],
+        "content_type": row["content_type"],
+        "content_hash": row["content_hash"],
+        "size": row["size"],
+        "width": row["width"],
+        "height": row["height"],
+        "source_slug": row["source_slug"],
+        "uploaded_by": row["uploaded_by"],
+        "created_at": row["created_at"],
+        "url": datasette.urls.path(f"/-/files/{file_id}"),
+        "download_url": datasette.urls.path(f"/-/files/{file_id}/download"),
+        "thumbnail_url": datasette.urls.path(f"/-/files/{file_id}/thumbnail"),
+    }
 
 
 async def file_delete(request, datasette):
@@ -1178,15 +2156,172 @@ async def file_delete(request, datasette):
 
     # Delete from internal database
     db = datasette.get_internal_database()
-    await db.execute_write(
-        "DELETE FROM datasette_files_thumbnails WHERE file_id = ?", [file_id]
+    await _delete_file_records(datasette, [file_id])
+    await _release_unreferenced_content(db, storage, [row])
+
+    return Response.json({"ok": True})
+
+
+async def file_delete_batch(request, datasette):
+    """POST /-/files/-/delete-batch - delete many files.
+
+    Takes ``{"file_ids": [...]}``. ``files-delete`` is checked with one query
+    per source, storage objects are deleted concurrently and the catalog rows
+    of every deleted file are removed in a single transaction. The response
+    has one entry per ID in ``files``, in the same order, with an ``error``
+    for any that could not be deleted; ``ok`` is true only if all were.
+    """
+    try:
+        body = json.loads(await request.post_body())
+    except (json.JSONDecodeError, ValueError):
+        return _error("Invalid JSON")
+
+    file_ids = body.get("file_ids") if isinstance(body, dict) else None
+    if (
+        not isinstance(file_ids, list)
+        or not file_ids
+        or not all(isinstance(i, str) for i in file_ids)
+    ):
+        return _error("file_ids must be a non-empty list of file IDs")
+    if len(file_ids) > _MAX_DELETE_BATCH:
+        return _error(f"A batch can contain at most {_MAX_DELETE_BATCH} files")
+    file_ids = list(dict.fromkeys(file_ids))
+
+    rows = await _get_file_records(
+        datasette, [i for i in file_ids if _FILE_ID_RE.match(i)]
     )
-    await db.execute_write(
-        "DELETE FROM datasette_files_thumbnail_failures WHERE file_id = ?", [file_id]
+    errors = {i: "File not found" for i in file_ids if i not in rows}
+
+    by_source = {}
+    for file_id, row in rows.items():
+        by_source.setdefault(row["source_slug"], []).append(row)
+
+    db = datasette.get_internal_database()
+    to_delete = []
+    for source_slug, source_rows in by_source.items():
+        allowed = await _deletable_file_ids(
+            datasette, db, request.actor, source_slug, [r["id"] for r in source_rows]
+        )
+        storage = _sources.get(source_slug)
+        for row in source_rows:
+            if row["id"] not in allowed:
+                errors[row["id"]] = "Permission denied"
+            elif storage is None:
+                errors[row["id"]] = f"Source not found: {source_slug}"
+            elif not storage.capabilities.can_delete:
+                errors[row["id"]] = "This storage backend does not support deletion"
+            else:
+                to_delete.append(row)
+
+    # Delete from storage backends, a bounded number at a time
+    semaphore = asyncio.Semaphore(_DELETE_CONCURRENCY)
+
+    async def _delete(row):
+        async with semaphore:
+            await _sources[row["source_slug"]].delete_file(row["path"])
+
+    outcomes = await asyncio.gather(
+        *(_delete(row) for row in to_delete), return_exceptions=True
     )
-    await db.execute_write("DELETE FROM datasette_files WHERE id = ?", [file_id])
+    deleted = []
+    for row, outcome in zip(to_delete, outcomes):
+        if isinstance(outcome, Exception):
+            errors[row["id"]] = f"Could not delete from storage: {outcome}"
+        else:
+            deleted.append(row)
 
-    return Response.json({"ok": True})
+    # Delete from internal database
+    if deleted:
+        await _delete_file_records(datasette, [row["id"] for row in deleted])
+        for source_slug in {row["source_slug"] for row in deleted}:
+            await _release_unreferenced_content(
+                db,
+                _sources[source_slug],
+                [row for row in deleted if row["source_slug"] == source_slug],
+            )
+
+    files = []
+    for file_id in file_ids:
+        if file_id in errors:
+            files.append({"id": file_id, "ok": False, "error": errors[file_id]})
+        else:
+            files.append({"id": file_id, "ok": True})
+    return Response.json({"ok": not errors, "files": files})
+
+
+async def _deletable_file_ids(datasette, db, actor, source_slug, file_ids):
+    """Return which of ``file_ids`` in a source the actor may delete, using a
+    single permission query for the whole source."""
+    resources_sql = await datasette.allowed_resources_sql(
+        action="files-delete", actor=actor, parent=source_slug
+    )
+    rows = (
+        await db.execute(
+            f"""
+            SELECT child FROM ({resources_sql.sql})
+            WHERE child IN (SELECT value FROM json_each(:_dfd_file_ids))
+            """,
+            {**resources_sql.params, "_dfd_file_ids": json.dumps(file_ids)},
+        )
+    ).rows
+    return {row["child"] for row in rows}
+
+
+async def _delete_file_records(datasette, file_ids):
+    """Remove files from the catalog in one transaction, then their cached
+    thumbnails."""
+    db = datasette.get_internal_database()
+    ids = json.dumps(file_ids)
+
+    def _delete(conn):
+        for table, column in (
+            ("datasette_files_thumbnails", "file_id"),
+            ("datasette_files_thumbnail_failures", "file_id"),
+            ("datasette_files", "id"),
+        ):
+            conn.execute(
+                f"DELETE FROM {table} WHERE {column} IN (SELECT value FROM json_each(?))",
+                [ids],
+            )
+
+    await db.execute_write_fn(_delete)
+    await _forget_thumbnails(datasette, file_ids)
+
+
+async def _forget_thumbnails(datasette, file_ids):
+    """Discard the cached thumbnails of files that changed or are gone."""
+    if not file_ids:
+        return
+    state = _thumbnail_state(datasette)
+    state.recent.discard(file_ids)
+    await state.cache.delete(file_ids)
+
+
+async def _release_unreferenced_content(db, storage, rows):
+    """Content-addressed sources share one stored copy between files with the
+    same hash: release it once the last catalog reference is gone."""
+    if not storage.capabilities.content_addressed:
+        return
+    source_id = rows[0]["source_id"]
+    hashes = list({row["content_hash"] for row in rows if row["content_hash"]})
+    if not hashes:
+        return
+    still_referenced = {
+        row["content_hash"]
+        for row in (
+            await db.execute(
+                """
+                SELECT DISTINCT content_hash FROM datasette_files
+                WHERE source_id = ?
+                  AND content_hash IN (SELECT value FROM json_each(?))
+                """,
+                [source_id, json.dumps(hashes)],
+            )
+        ).rows
+    }
+    for content_hash in hashes:
+        if content_hash not in still_referenced:
+            await storage.release_content(content_hash)
 
 
 async def file_update(request, datasette):
@@ -1260,6 +2395,23 @@ async def _get_file_record(datasette, file_id):
     return row
 
 
+async def _get_file_records(datasette, file_ids):
+    """Look up several file records at once, returning ``{file_id: row}``."""
+    db = datasette.get_internal_database()
+    rows = (
+        await db.execute(
+            """
+            SELECT f.*, s.slug as source_slug
+            FROM datasette_files f
+            JOIN datasette_files_sources s ON f.source_id = s.id
+            WHERE f.id IN (SELECT value FROM json_each(?))
+            """,
+            [json.dumps(file_ids)],
+        )
+    ).rows
+    return {row["id"]: row for row in rows}
+
+
 def _parse_created_at(value):
     """Parse stored timestamps into UTC-aware datetimes.
 
@@ -1369,6 +2521,80 @@ async def get_file(datasette, file_id):
     return File(row, _sources[source_slug])
 
 
+async def sync_source(
+    datasette, source_slug, page_size=DEFAULT_SYNC_PAGE_SIZE, max_pages=None
+) -> SyncResult:
+    """Bring the catalog for a source in line with the files in its storage.
+
+    Files found in storage but not in the catalog are registered, files whose
+    size or version changed are updated, and catalog entries for files that
+    are no longer there are tombstoned. Progress is saved after every page of
+    ``page_size`` files, so an interrupted sync resumes where it stopped;
+    ``max_pages`` stops deliberately after that many pages.
+
+    Args:
+        datasette: The Datasette instance.
+        source_slug: The source to sync.
+
+    Returns:
+        A :class:`SyncResult` with counts of added, updated, removed and
+        unchanged files.
+    """
+    if source_slug not in _sources:
+        raise NotFound(f"Source not found: {source_slug}")
+    storage = _sources[source_slug]
+    if not storage.capabilities.can_list:
+        raise ValueError(f"Source '{source_slug}' does not support listing files")
+    # One sync per source at a time: two would share one sync token
+    async with _sync_lock(datasette, source_slug):
+        result = await sync_catalog(
+            datasette.get_internal_database(),
+            storage,
+            _source_meta[source_slug]["source_id"],
+            _paths_in_use(datasette, source_slug),
+            page_size=page_size,
+            max_pages=max_pages,
+        )
+    await _forget_thumbnails(datasette, result.updated_ids + result.removed_ids)
+    return result
+
+
+async def reconcile_source(
+    datasette, source_slug, reclaim=False, page_size=DEFAULT_SYNC_PAGE_SIZE
+):
+    """Find files in a source's storage and catalog that don't match up.
+
+    An async generator yielding a :class:`Drift` for each file in storage
+    with no catalog entry (``kind="orphan"``) and each catalog entry whose
+    file is gone (``kind="missing"``). Files belonging to uploads that are
+    still in progress are not orphans. With ``reclaim=True`` orphans are
+    deleted from storage as they are found, and once the walk finishes
+    ``Storage.release_unused_content()`` frees any content they were the
+    last to share. The catalog itself is never
+    changed: ``sync_source()`` does that.
+
+    Args:
+        datasette: The Datasette instance.
+        source_slug: The source to check.
+    """
+    if source_slug not in _sources:
+        raise NotFound(f"Source not found: {source_slug}")
+    storage = _sources[source_slug]
+    if not storage.capabilities.can_list:
+        raise ValueError(f"Source '{source_slug}' does not support listing files")
+    if reclaim and not storage.capabilities.can_delete:
+        raise ValueError(f"Source '{source_slug}' does not support deleting files")
+    async for drift in reconcile_catalog(
+        datasette.get_internal_database(),
+        storage,
+        _source_meta[source_slug]["source_id"],
+        _paths_in_use(datasette, source_slug),
+        reclaim=reclaim,
+        page_size=page_size,
+    ):
+        yield drift
+
+
 async def file_info(request, datasette):
     """GET /-/files/{file_id} - HTML info page about a file."""
     if request.method != "GET":
@@ -1429,15 +2655,105 @@ async def file_json(request, datasette):
     return Response.json(dict(row))
 
 
+_MAX_RANGES = 16
+_RANGE_RE = re.compile(r"^(\d*)-(\d*)$")
+
+
+def _parse_range_header(header, size):
+    """Parse a ``Range: bytes=...`` header into ``[(offset, length), ...]``.
+
+    Returns ``None`` if the header should be ignored (malformed, a unit other
+    than bytes, or too many ranges) and an empty list if no range overlaps
+    the file, which the caller answers with 416.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+    specs = [spec.strip() for spec in specs.split(",") if spec.strip()]
+    if not specs or len(specs) > _MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        match = _RANGE_RE.match(spec)
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if not first:
+            # Suffix range: the final N bytes
+            suffix = int(last)
+            if suffix == 0 or size == 0:
+                continue
+            start = max(size - suffix, 0)
+            end = size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+            end = min(int(last), size - 1) if last else size - 1
+        ranges.append((start, end - start + 1))
+    return ranges
+
+
+def _if_range_matches(if_range, etag):
+    """Should a Range header be honoured given this If-Range value?
+
+    Downloads carry no Last-Modified, so only a strong match against the
+    current ETag counts; any other validator means "send the whole file".
+    """
+    if if_range is None:
+        return True
+    return etag is not None and if_range.strip() == etag
+
+
 class _StreamingFileResponse:
-    """ASGI response that streams file content in chunks via storage.stream_file()."""
+    """ASGI response that streams file content in chunks via storage.stream_file().
+
+    Pass ``ranges`` (a list of ``(offset, length)`` tuples) to send a 206
+    Partial Content response, as ``multipart/byteranges`` if there is more
+    than one.
+
+    ``extensions`` is the ASGI scope's extensions dict. If the server offers
+    ``http.response.pathsend`` or ``http.response.zerocopysend`` and the
+    storage exposes a local path, the server sends the file itself (usually
+    with ``sendfile()``) instead of the content passing through Python.
+    """
 
-    def __init__(self, storage, path, content_type, filename, size=None):
+    def __init__(
+        self,
+        storage,
+        path,
+        content_type,
+        filename,
+        size=None,
+        etag=None,
+        ranges=None,
+        extensions=None,
+    ):
         self.storage = storage
         self.path = path
         self.content_type = content_type
         self.filename = filename
         self.size = size
+        self.etag = etag
+        self.ranges = ranges
+        self.extensions = extensions or {}
+
+    async def _zero_copy(self):
+        """Return (extension, local_path) for a zero-copy send, or (None, None)."""
+        if self.ranges and len(self.ranges) > 1:
+            return None, None
+        if not self.ranges and "http.response.pathsend" in self.extensions:
+            extension = "http.response.pathsend"
+        elif "http.response.zerocopysend" in self.extensions:
+            extension = "http.response.zerocopysend"
+        else:
+            return None, None
+        local_path = await self.storage.local_path(self.path)
+        if local_path is None:
+            return None, None
+        return extension, local_path
 
     async def asgi_send(self, send):
         disposition = f'attachment; filename="{_safe_download_filename(self.filename, self.content_type)}"'
@@ -1447,18 +2763,92 @@ class _StreamingFileResponse:
             "x-content-type-options": "nosniff",
         }
         if self.size is not None:
+            headers["accept-ranges"] = "bytes"
+        if self.etag is not None:
+            headers["etag"] = self.etag
+        status = 200
+        parts = None
+        if self.ranges:
+            status = 206
+            if len(self.ranges) == 1:
+                offset, length = self.ranges[0]
+                headers["content-range"] = (
+                    f"bytes {offset}-{offset + length - 1}/{self.size}"
+                )
+                headers["content-length"] = str(length)
+            else:
+                boundary = secrets.token_hex(16)
+                headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+                parts = [
+                    (
+                        (
+                            f"--{boundary}\r\n"
+                            f"Content-Type: {self.content_type}\r\n"
+                            f"Content-Range: bytes {offset}-{offset + length - 1}/{self.size}\r\n"
+                            "\r\n"
+                        ).encode("latin1"),
+                        offset,
+                        length,
+                    )
+                    for offset, length in self.ranges
+                ]
+                trailer = f"--{boundary}--\r\n".encode("latin1")
+                headers["content-length"] = str(
+                    sum(len(head) + length + 2 for head, _, length in parts)
+                    + len(trailer)
+                )
+        elif self.size is not None:
             headers["content-length"] = str(self.size)
+        extension, local_path = await self._zero_copy()
         await send(
             {
                 "type": "http.response.start",
-                "status": 200,
+                "status": status,
                 "headers": [
                     [k.encode("latin1"), v.encode("latin1")] for k, v in headers.items()
                 ],
             }
         )
-        async for chunk in self.storage.stream_file(self.path):
-            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+        if extension == "http.response.pathsend":
+            await send({"type": "http.response.pathsend", "path": local_path})
+            return
+        if extension == "http.response.zerocopysend":
+            message = {"type": "http.response.zerocopysend", "more_body": False}
+            if self.ranges:
+                message["offset"], message["count"] = self.ranges[0]
+            fileobj = await asyncio.to_thread(open, local_path, "rb")
+            try:
+                await send({**message, "file": fileobj})
+            finally:
+                await asyncio.to_thread(fileobj.close)
+            return
+
+        async def send_chunks(chunks):
+            async for chunk in chunks:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+
+        if parts is not None:
+            for head, offset, length in parts:
+                await send(
+                    {"type": "http.response.body", "body": head, "more_body": True}
+                )
+                await send_chunks(
+                    self.storage.stream_file_range(self.path, offset, length)
+                )
+                await send(
+                    {"type": "http.response.body", "body": b"\r\n", "more_body": True}
+                )
+            await send(
+                {"type": "http.response.body", "body": trailer, "more_body": True}
+            )
+        elif self.ranges:
+            offset, length = self.ranges[0]
+            await send_chunks(self.storage.stream_file_range(self.path, offset, length))
+        else:
+            await send_chunks(self.storage.stream_file(self.path))
         await send({"type": "http.response.body", "body": b"", "more_body": False})
 
 
@@ -1471,75 +2861,168 @@ async def file_thumbnail(request, datasette):
 
     await _check_browse_permission(datasette, request, row["source_slug"])
 
-    content_type = row["content_type"] or ""
+    state = _thumbnail_state(datasette)
+    settings = state.settings
+    size = _requested_thumbnail_size(request, settings.sizes)
+    if size is None:
+        return _error(
+            "Thumbnail size not available, choose from: "
+            + ", ".join(_rendition(size) for size in settings.sizes)
+        )
+    formats = _thumbnail_formats(settings)
+    format = _negotiate_thumbnail_format(request.headers.get("accept"), formats)
+    # Shared caches must keep a copy per encoding
+    headers = {"Vary": "Accept"} if formats else None
+
+    # Keyed like the thumbnail cache, so changed content or a changed policy
+    # is never answered from memory
+    key = (
+        file_id,
+        _rendition(size, format),
+        _thumbnail_cache_key(settings),
+        _thumbnail_version(row),
+    )
+    cached = state.recent.get(key)
+    # Files no generator can handle go straight to their icon, without
+    # looking up a recorded outcome
+    if cached is None and await _matching_thumbnail_generators(
+        settings, row["content_type"] or "", row["filename"]
+    ):
+        result = await _get_or_generate_thumbnail(datasette, file_id, row, size, format)
+        if result:
+            cached = CachedResponse(
+                result.thumb_bytes,
+                result.content_type,
+                _etag_for_bytes(result.thumb_bytes),
+            )
+            state.recent.put(key, cached)
+    if cached is None:
+        # For non-image files (or if generation failed), return SVG icon.
+        # Failures are looked up every time, as they may be retried; the
+        # icon only depends on its label and the file's type, so files
+        # sharing an extension share one cached copy.
+        content_type = row["content_type"] or ""
+        icon_key = (None, _file_icon_label(row["filename"], content_type), content_type)
+        cached = state.recent.get(icon_key)
+        if cached is None:
+            svg = _generate_file_icon_svg(row["filename"], content_type).encode("utf-8")
+            cached = CachedResponse(svg, "image/svg+xml", _etag_for_bytes(svg))
+            state.recent.put(icon_key, cached)
+    return _response_with_etag(
+        request, cached.body, cached.content_type, headers, cached.etag
+    )
+
+
+def _requested_thumbnail_size(request, sizes):
+    """The configured size a thumbnail request picks with ``?w=`` and ``?h=``.
+
+    Either may be left out to match any size. Returns None if no configured
+    size matches.
+    """
+    width = request.args.get("w")
+    height = request.args.get("h")
+    for size in sizes:
+        if width in (None, str(size[0])) and height in (None, str(size[1])):
+            return size
+    return None
+
 
-    result = await _get_or_generate_thumbnail(datasette, file_id, row)
-    if result:
-        return _response_with_etag(request, result.thumb_bytes, result.content_type)
+async def _generate_renditions(
+    generator, source, content_type, filename, sizes, format
+):
+    # A generator that can't encode the format makes its default encoding,
+    # which any client accepts
+    options = (
+        {"format": format} if format in getattr(generator, "output_formats", ()) else {}
+    )
+    if hasattr(generator, "generate_from_source"):
+        return await generator.generate_from_source(
+            source, content_type, filename, sizes, **options
+        )
+    # Generators needn't subclass ThumbnailGenerator: those that only
+    # implement generate() get its default generate_renditions()
+    file_bytes = await source.read()
+    if hasattr(generator, "generate_renditions"):
+        return await generator.generate_renditions(
+            file_bytes, content_type, filename, sizes, **options
+        )
+    return await ThumbnailGenerator.generate_renditions(
+        generator, file_bytes, content_type, filename, sizes
+    )
 
-    # For non-image files (or if generation failed), return SVG icon
-    svg = _generate_file_icon_svg(row["filename"], content_type).encode("utf-8")
-    return _response_with_etag(request, svg, "image/svg+xml")
 
+async def _matching_thumbnail_generators(settings, content_type, filename):
+    """The registered generators that say they can handle this file."""
+    matching = []
+    for generator in _thumbnail_generators:
+        try:
+            if await asyncio.wait_for(
+                generator.can_generate(content_type, filename),
+                timeout=settings.timeout_seconds,
+            ):
+                matching.append(generator)
+        except Exception:
+            continue
+    return matching
 
-async def _get_or_generate_thumbnail(datasette, file_id, row):
-    """Return ThumbnailResult or None. Checks cache, generates on miss."""
-    from .base import ThumbnailResult
 
+async def _get_or_generate_thumbnail(datasette, file_id, row, size=None, format=None):
+    """Return ThumbnailResult or None. Checks cache, generates on miss.
+
+    ``size`` is one of the configured sizes, the first if not given, and
+    ``format`` a negotiated encoding or None for the generator's default. A
+    miss generates every configured size the cache lacks in that encoding
+    from a single read of the file.
+    """
     db = datasette.get_internal_database()
     state = _thumbnail_state(datasette)
     settings = state.settings
     cache_key = _thumbnail_cache_key(settings)
+    version = _thumbnail_version(row)
+    size = size or settings.sizes[0]
+    rendition = _rendition(size, format)
 
     async def cache_state():
         """Return (hit, result): (True, ThumbnailResult) for a cached thumbnail,
         (True, None) for a cached failure, (False, None) on a miss."""
+        cached = await state.cache.get(file_id, version, cache_key, rendition)
+        if cached is not None:
+            return True, cached
         rows = (
             await db.execute(
                 """
-                SELECT 'thumbnail' AS kind, thumbnail, content_type, width, height,
-                       cache_key, NULL AS status, NULL AS age_seconds
-                FROM datasette_files_thumbnails WHERE file_id = :file_id
-                UNION ALL
-                SELECT 'failure', NULL, NULL, NULL, NULL, cache_key, status,
+                SELECT cache_key, status,
                        (julianday('now') - julianday(created_at)) * 86400
-                FROM datasette_files_thumbnail_failures WHERE file_id = :file_id
+                           AS age_seconds
+                FROM datasette_files_thumbnail_failures
+                WHERE file_id = ? AND rendition = ?
                 """,
-                {"file_id": file_id},
+                [file_id, rendition],
             )
         ).rows
-        for cached in rows:
-            if cached["kind"] == "thumbnail":
-                if cached["cache_key"] == cache_key:
-                    return True, ThumbnailResult(
-                        thumb_bytes=cached["thumbnail"],
-                        content_type=cached["content_type"],
-                        width=cached["width"],
-                        height=cached["height"],
-                    )
-                await db.execute_write(
-                    "DELETE FROM datasette_files_thumbnails WHERE file_id = ?",
-                    [file_id],
-                )
-            else:
-                retryable = cached["status"] == "failed" and (
-                    cached["age_seconds"] is None
-                    or cached["age_seconds"] > _THUMBNAIL_FAILURE_RETRY_SECONDS
-                )
-                if cached["cache_key"] == cache_key and not retryable:
-                    return True, None
-                await db.execute_write(
-                    "DELETE FROM datasette_files_thumbnail_failures WHERE file_id = ?",
-                    [file_id],
-                )
+        for failure in rows:
+            retryable = failure["status"] == "failed" and (
+                failure["age_seconds"] is None
+                or failure["age_seconds"] > _THUMBNAIL_FAILURE_RETRY_SECONDS
+            )
+            if failure["cache_key"] == cache_key and not retryable:
+                return True, None
+            # Stale: cleared here, so a thumbnail made next never has a
+            # failure recorded alongside it
+            await db.execute_write(
+                """DELETE FROM datasette_files_thumbnail_failures
+                   WHERE file_id = ? AND rendition = ?""",
+                [file_id, rendition],
+            )
         return False, None
 
     async def cache_failure(status, reason, generator=None):
         await db.execute_write(
             """INSERT OR REPLACE INTO datasette_files_thumbnail_failures
-               (file_id, status, reason, generator, cache_key, created_at)
-               VALUES (?, ?, ?, ?, ?, datetime('now'))""",
-            [file_id, status, reason, generator, cache_key],
+               (file_id, rendition, status, reason, generator, cache_key,
+                created_at)
+               VALUES (?, ?, ?, ?, ?, ?, datetime('now'))""",
+            [file_id, rendition, status, reason, generator, cache_key],
         )
 
     hit, cached_result = await cache_state()
@@ -1557,17 +3040,9 @@ async def _get_or_generate_thumbnail(datasette, file_id, row):
 
     storage = _sources[source_slug]
 
-    matching_generators = []
-    for generator in _thumbnail_generators:
-        try:
-            if await asyncio.wait_for(
-                generator.can_generate(content_type, filename),
-                timeout=settings.timeout_seconds,
-            ):
-                matching_generators.append(generator)
-        except Exception:
-            continue
-
+    matching_generators = await _matching_thumbnail_generators(
+        settings, content_type, filename
+    )
     if not matching_generators:
         await cache_failure("skipped", "unsupported")
         return None
@@ -1583,16 +3058,18 @@ async def _get_or_generate_thumbnail(datasette, file_id, row):
         if hit:
             return cached_result
 
-        try:
-            file_bytes = await storage.read_file_limited(
-                row["path"], settings.max_source_bytes
-            )
-        except FileTooLarge:
-            await cache_failure("skipped", "too_large")
-            return None
-        except Exception:
-            await cache_failure("failed", "read_failed")
-            return None
+        # Read by each generator as it needs it: the built-in one has its
+        # worker read a local file itself, or streams the file to it
+        source = ThumbnailSource(storage, row["path"], settings.max_source_bytes)
+
+        cached_renditions = await state.cache.renditions(file_id, version, cache_key)
+        missing = [
+            missing_size
+            for missing_size in settings.sizes
+            if _rendition(missing_size, format) not in cached_renditions
+        ]
+        if size not in missing:
+            missing.insert(0, size)
 
         last_reason = "generation_failed"
         last_skipped = False
@@ -1600,34 +3077,25 @@ async def _get_or_generate_thumbnail(datasette, file_id, row):
         for generator in matching_generators:
             last_generator = generator.name
             try:
-                result = await asyncio.wait_for(
-                    generator.generate(
-                        file_bytes,
-                        content_type,
-                        filename,
-                        max_width=200,
-                        max_height=200,
+                results = await asyncio.wait_for(
+                    _generate_renditions(
+                        generator, source, content_type, filename, missing, format
                     ),
                     timeout=settings.timeout_seconds,
                 )
+                generated = dict(zip(missing, results))
+                result = generated.get(size)
                 if result:
-                    await db.execute_write(
-                        """INSERT OR REPLACE INTO datasette_files_thumbnails
-                           (file_id, thumbnail, content_type, width, height, generator, cache_key)
-                           VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                        [
-                            file_id,
-                            result.thumb_bytes,
-                            result.content_type,
-                            result.width,
-                            result.height,
-                            generator.name,
-                            cache_key,
-                        ],
-                    )
-                    await db.execute_write(
-                        "DELETE FROM datasette_files_thumbnail_failures WHERE file_id = ?",
-                        [file_id],
+                    await state.cache.put(
+                        file_id,
+                        version,
+                        cache_key,
+                        generator.name,
+                        {
+                            _rendition(generated_size, format): generated_result
+                            for generated_size, generated_result in generated.items()
+                            if generated_result
+                        },
                     )
                     return result
             except asyncio.TimeoutError:
@@ -1669,12 +3137,33 @@ async def file_download(request, datasette):
 
     # Stream the file content without loading it all into memory
     content_type = row["content_type"] or "application/octet-stream"
+    size = row["size"]
+    etag = f'"{row["content_hash"]}"' if row["content_hash"] else None
+
+    ranges = None
+    range_header = request.headers.get("range")
+    if (
+        range_header
+        and size is not None
+        and _if_range_matches(request.headers.get("if-range"), etag)
+    ):
+        ranges = _parse_range_header(range_header, size)
+        if ranges == []:
+            return Response.text(
+                "Range Not Satisfiable",
+                status=416,
+                headers={"Content-Range": f"bytes */{size}", "Accept-Ranges": "bytes"},
+            )
+
     return _StreamingFileResponse(
         storage=storage,
         path=row["path"],
         content_type=content_type,
         filename=row["filename"],
-        size=row["size"],
+        size=size,
+        etag=etag,
+        ranges=ranges,
+        extensions=request.scope.get("extensions"),
     )
 
 
@@ -1743,6 +3232,7 @@ async def sources_json(request, datasette):
                     "can_list": caps.can_list,
                     "can_generate_signed_urls": caps.can_generate_signed_urls,
                     "requires_proxy_download": caps.requires_proxy_download,
+                    "content_addressed": caps.content_addressed,
                 },
             }
         )
@@ -2086,8 +3576,20 @@ def register_routes():
         (r"^/-/files/sources\.json$", sources_json),
         # New unified upload API (prepare/upload/complete)
         (r"^/-/files/upload/(?P<source_slug>[^/]+)/-/prepare$", upload_prepare),
+        (
+            r"^/-/files/upload/(?P<source_slug>[^/]+)/-/prepare-batch$",
+            upload_prepare_batch,
+        ),
         (r"^/-/files/upload/(?P<source_slug>[^/]+)/-/upload$", upload_content),
+        (
+            r"^/-/files/upload/(?P<source_slug>[^/]+)/-/upload/(?P<upload_token>tok_[a-z0-9]+)$",
+            upload_resumable,
+        ),
         (r"^/-/files/upload/(?P<source_slug>[^/]+)/-/complete$", upload_complete),
+        (
+            r"^/-/files/upload/(?P<source_slug>[^/]+)/-/complete-batch$",
+            upload_complete_batch,
+        ),
         (r"^/-/files/upload/(?P<source_slug>[^/]+)$", upload_page),
         (
             r"^/-/files/import/(?P<file_id>df-[a-z0-9]+)/(?P<import_id>\d+)\.json$",
@@ -2099,6 +3601,7 @@ def register_routes():
         ),
         (r"^/-/files/import/(?P<file_id>df-[a-z0-9]+)$", import_file_view),
         # File operations (delete, update)
+        (r"^/-/files/-/delete-batch$", file_delete_batch),
         (r"^/-/files/(?P<file_id>df-[a-z0-9]+)/-/delete$", file_delete),
         (r"^/-/files/(?P<file_id>df-[a-z0-9]+)/-/update$", file_update),
         (r"^/-/files/(?P<file_id>df-[a-z0-9]+)\.json$", file_json),
@@ -2528,5 +4031,8 @@ def register_thumbnail_generators(datasette):
         PillowThumbnailGenerator(
             max_pixels=settings.max_pixels,
             memory_limit_bytes=settings.memory_limit_bytes,
+            workers=settings.concurrency,
+            worker_max_jobs=settings.worker_max_jobs,
+            worker_launch=settings.worker_launch,
         )
     ]
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import asyncio
+import os
+import sys
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
 from typing import Optional, AsyncIterator
@@ -11,6 +14,20 @@ DEFAULT_THUMBNAIL_MAX_PIXELS = 12_000_000
 DEFAULT_THUMBNAIL_CONCURRENCY = 1
 DEFAULT_THUMBNAIL_TIMEOUT_SECONDS = 10.0
 DEFAULT_THUMBNAIL_MEMORY_LIMIT_BYTES = 128 * 1024 * 1024
+DEFAULT_THUMBNAIL_WORKER_MAX_JOBS = 100
+# (max_width, max_height) boxes thumbnails are rendered to. The first is
+# served when a request does not ask for a size.
+DEFAULT_THUMBNAIL_SIZES = ((200, 200),)
+# Encodings a thumbnail request can ask for with its Accept header, most
+# preferred first. Without one of these a generator's default encoding is used.
+THUMBNAIL_FORMATS = ("webp", "avif")
+# How the built-in generator starts its worker processes: "forkserver" forks
+# them from a process that has already imported Pillow, "subprocess" starts
+# a new Python for each
+THUMBNAIL_WORKER_LAUNCH_MODES = ("forkserver", "subprocess")
+DEFAULT_THUMBNAIL_WORKER_LAUNCH = (
+    "forkserver" if sys.platform.startswith("linux") else "subprocess"
+)
 
 
 class FileTooLarge(Exception):
@@ -48,6 +65,9 @@ class FileMetadata:
     height: Optional[int] = None
     created_at: Optional[str] = None
     metadata: dict = field(default_factory=dict)
+    # Opaque version identifier that changes whenever the content does, such
+    # as an S3 ETag. Lets source syncs spot changed files without reading them.
+    etag: Optional[str] = None
 
 
 @dataclass
@@ -70,6 +90,7 @@ class StorageCapabilities:
     can_generate_signed_urls: bool = False
     requires_proxy_download: bool = False
     max_file_size: Optional[int] = None
+    content_addressed: bool = False
 
 
 class Storage(ABC):
@@ -140,16 +161,73 @@ class Storage(ABC):
     async def read_bytes(self, path: str, num_bytes: int = 2048) -> bytes:
         """Return up to num_bytes from the start of a file.
 
-        Storage backends can override this to avoid reading the full file
-        (e.g. using HTTP Range headers for S3).
+        The default reads through ``stream_file_range()``, which stops once
+        enough bytes have arrived. That is only as bounded as the backend's
+        ``stream_file()``: with the default one, which yields all of
+        ``read_file()`` as a single chunk, the whole file is loaded to return
+        its first bytes. Storage backends can override this to request
+        exactly the prefix (e.g. using HTTP Range headers for S3).
         """
-        content = await self.read_file(path)
-        return content[:num_bytes]
+        chunks = []
+        async for chunk in self.stream_file_range(path, 0, num_bytes):
+            chunks.append(chunk)
+        return b"".join(chunks)
 
     async def stream_file(self, path: str) -> AsyncIterator[bytes]:
-        """Yield file content in chunks."""
+        """Yield file content in chunks.
+
+        The default yields the whole of ``read_file()`` as one chunk, so
+        everything built on it, including ``stream_file_range()`` and
+        ``read_bytes()``, holds the entire file in memory.
+        """
         yield await self.read_file(path)
 
+    async def stream_file_range(
+        self, path: str, offset: int, length: int
+    ) -> AsyncIterator[bytes]:
+        """Yield ``length`` bytes of content starting at byte ``offset``.
+
+        Used to answer HTTP ``Range`` requests. The default skips through
+        ``stream_file()``; backends should override this to seek (or send a
+        ranged request) instead of reading the bytes before ``offset``.
+        """
+        if length <= 0:
+            return
+        end = offset + length
+        position = 0
+        stream = self.stream_file(path)
+        try:
+            async for chunk in stream:
+                chunk_start = position
+                position += len(chunk)
+                if position <= offset:
+                    continue
+                yield chunk[max(offset - chunk_start, 0) : end - chunk_start]
+                if position >= end:
+                    break
+        finally:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+
+    async def local_path(self, path: str) -> Optional[str]:
+        """Return an absolute local filesystem path for the file, or None.
+
+        Backends whose files live on a local disk can return a path here so
+        downloads can be handed to the ASGI server for a zero-copy
+        ``sendfile()``. Remote backends should leave this returning None.
+        """
+        return None
+
+    async def staging_directory(self) -> Optional[str]:
+        """Return a local directory to stage resumable uploads in, or None.
+
+        Every process serving the source should see the same directory, and
+        on the same filesystem as the stored files ``receive_file()`` can
+        rename staged files into place. None stages them in the system's
+        temporary directory.
+        """
+        return None
+
     async def prepare_upload(
         self, filename: str, content_type: str, size: int
     ) -> UploadInstructions:
@@ -169,12 +247,130 @@ class Storage(ABC):
             f"{self.__class__.__name__} does not support proxy uploads"
         )
 
+    async def receive_file(
+        self,
+        path: str,
+        source,
+        content_type: str,
+        content_hash: Optional[str] = None,
+    ) -> FileMetadata:
+        """Store a file whose content is already on local disk.
+
+        ``source`` is either the path of a file the backend may move into
+        place (the caller will not use it again), or a binary file object
+        with a ``fileno()``. ``content_hash`` is passed when the caller has
+        already hashed the content. Local backends can override this to
+        rename or clone the file instead of copying it; the default streams
+        it through ``receive_upload()``.
+        """
+        if isinstance(source, (str, os.PathLike)):
+            fileobj = await asyncio.to_thread(open, source, "rb")
+        else:
+            fileobj = source
+            await asyncio.to_thread(fileobj.seek, 0)
+
+        async def chunks():
+            while True:
+                chunk = await asyncio.to_thread(fileobj.read, 65536)
+                if not chunk:
+                    break
+                yield chunk
+
+        try:
+            return await self.receive_upload(path, chunks(), content_type)
+        finally:
+            if fileobj is not source:
+                await asyncio.to_thread(fileobj.close)
+
     async def delete_file(self, path: str) -> None:
         """Delete a file from the backend."""
         raise NotImplementedError(
             f"{self.__class__.__name__} does not support deletion"
         )
 
+    async def release_content(self, content_hash: str) -> None:
+        """Called after a delete once no catalog entry in this source has
+        ``content_hash`` any more.
+
+        Content-addressed backends (``capabilities.content_addressed``) use
+        this to remove the shared copy of the content. The default does
+        nothing.
+        """
+
+    async def release_unused_content(self) -> None:
+        """Called by ``reconcile_source(reclaim=True)`` once its walk is done.
+
+        Content-addressed backends use this to remove shared copies that no
+        file refers to any more, such as those of reclaimed orphans. The
+        default does nothing.
+        """
+
+    async def close(self) -> None:
+        """Release anything ``configure()`` set up, such as thread pools.
+
+        Called when Datasette starts up again and replaces this source. The
+        default does nothing.
+        """
+
+
+class ThumbnailSource:
+    """A file to make thumbnails from, read only when a generator asks.
+
+    ``read()`` returns the whole file. Generators that can avoid holding it
+    all in memory should use ``local_path()`` or ``chunks()`` instead. Files
+    over ``max_bytes`` raise ``ThumbnailGenerationError("too_large",
+    skipped=True)``, and storage errors ``ThumbnailGenerationError("read_failed")``.
+    """
+
+    def __init__(self, storage: "Storage", path: str, max_bytes: int):
+        self.storage = storage
+        self.path = path
+        self.max_bytes = max_bytes
+        self._content: Optional[bytes] = None
+
+    async def local_path(self) -> Optional[str]:
+        """The file's path on local disk, or None for remote storage.
+
+        The caller must apply ``max_bytes`` itself.
+        """
+        try:
+            return await self.storage.local_path(self.path)
+        except Exception:
+            raise ThumbnailGenerationError("read_failed")
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """Yield the file's content a chunk at a time."""
+        stream = self.storage.stream_file(self.path)
+        total = 0
+        try:
+            while True:
+                try:
+                    chunk = await anext(stream)
+                except StopAsyncIteration:
+                    return
+                except Exception:
+                    raise ThumbnailGenerationError("read_failed")
+                total += len(chunk)
+                if total > self.max_bytes:
+                    raise ThumbnailGenerationError("too_large", skipped=True)
+                yield chunk
+        finally:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+
+    async def read(self) -> bytes:
+        """Return the whole file, reading it only the first time."""
+        if self._content is None:
+            try:
+                self._content = await self.storage.read_file_limited(
+                    self.path, self.max_bytes
+                )
+            except FileTooLarge:
+                raise ThumbnailGenerationError("too_large", skipped=True)
+            except Exception:
+                raise ThumbnailGenerationError("read_failed")
+        return self._content
+
 
 @dataclass
 class ThumbnailResult:
@@ -191,6 +387,8 @@ class ThumbnailGenerator(ABC):
 
     name: str
     version: str = "1"
+    # Which of THUMBNAIL_FORMATS generate_renditions() can encode to
+    output_formats: tuple = ()
 
     @abstractmethod
     async def can_generate(self, content_type: str, filename: str) -> bool:
@@ -208,3 +406,48 @@ class ThumbnailGenerator(ABC):
     ) -> Optional[ThumbnailResult]:
         """Generate a thumbnail, or return None."""
         ...
+
+    async def generate_renditions(
+        self,
+        file_bytes: bytes,
+        content_type: str,
+        filename: str,
+        sizes: list[tuple[int, int]],
+        format: Optional[str] = None,
+    ) -> list[Optional[ThumbnailResult]]:
+        """Generate a thumbnail for each ``(max_width, max_height)`` in ``sizes``.
+
+        ``format`` is one of ``output_formats``, or None for the generator's
+        default encoding. The default calls ``generate()`` once per size.
+        Generators that can decode a file once and scale it to every size
+        should override this.
+        """
+        return [
+            await self.generate(
+                file_bytes, content_type, filename, max_width=width, max_height=height
+            )
+            for width, height in sizes
+        ]
+
+    async def generate_from_source(
+        self,
+        source: ThumbnailSource,
+        content_type: str,
+        filename: str,
+        sizes: list[tuple[int, int]],
+        format: Optional[str] = None,
+    ) -> list[Optional[ThumbnailResult]]:
+        """Like ``generate_renditions()``, reading the file from ``source``.
+
+        The default reads the whole file and calls ``generate_renditions()``.
+        Generators that can work from a local path or a stream should
+        override this so large files never sit in Datasette's memory.
+        """
+        file_bytes = await source.read()
+        if format is None:
+            return await self.generate_renditions(
+                file_bytes, content_type, filename, sizes
+            )
+        return await self.generate_renditions(
+            file_bytes, content_type, filename, sizes, format=format
+        )
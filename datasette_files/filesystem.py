@@ -1,9 +1,233 @@
+import asyncio
+import base64
+import binascii
 import dataclasses
+import functools
 import hashlib
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from stat import S_ISREG
 from typing import AsyncIterator, Optional
 
 from .base import FileMetadata, FileTooLarge, Storage, StorageCapabilities
+from .watch import InotifyWatcher
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Size of the per-source thread pool that performs blocking disk I/O, so slow
+# disks and large transfers never stall the event loop.
+DEFAULT_IO_THREADS = 4
+_CHUNK_SIZE = 65536
+# How much of a write to sync to disk before reporting it stored:
+# "none" leaves it to the OS, "fsync-file" syncs the file's content before
+# it is renamed into place, "fsync-file-and-dir" also syncs the directory
+# entries so the rename survives a crash, and "group-commit" does the
+# latter in batches shared by concurrent writes.
+DURABILITY_MODES = ("none", "fsync-file", "fsync-file-and-dir", "group-commit")
+DEFAULT_GROUP_COMMIT_MS = 5
+# Reserved directory under the root for blobs and in-progress writes. It is
+# never returned by list_files().
+_INTERNAL_DIR = ".datasette-files"
+_SHA256_HEX_RE = re.compile(r"^[0-9a-f]{64}$")
+# ioctl from <linux/fs.h> that makes one file share another's extents
+# (btrfs, XFS, bcachefs), turning a copy into a metadata-only operation
+_FICLONE = 0x40049409
+_COPY_FILE_RANGE_CHUNK = 1024 * 1024 * 1024
+
+
+def _close_and_unlink(fileobj) -> None:
+    fileobj.close()
+    try:
+        os.unlink(fileobj.name)
+    except FileNotFoundError:
+        pass
+
+
+def _unlink_unshared_blob(blob: Path) -> None:
+    """Remove a blob unless a stored file is still a hard link to it."""
+    # A file linked to the blob between the stat and the unlink keeps its
+    # bytes; it just stops sharing them with later uploads
+    try:
+        if blob.stat().st_nlink == 1:
+            blob.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _sha256_of(fileobj) -> str:
+    sha256 = hashlib.sha256()
+    fileobj.seek(0)
+    while chunk := fileobj.read(_CHUNK_SIZE):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _make_dirs(directory: Path) -> list:
+    """Create ``directory`` and any missing parents, returning the
+    directories that gained an entry."""
+    missing = []
+    while not directory.exists():
+        missing.append(directory)
+        directory = directory.parent
+    for path in reversed(missing):
+        path.mkdir(exist_ok=True)
+    return [path.parent for path in missing]
+
+
+def _fsync_path(path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_paths(paths) -> None:
+    for path in dict.fromkeys(paths):
+        _fsync_path(path)
+
+
+class _GroupCommit:
+    """Batches fsync calls from concurrent writes.
+
+    Paths passed to ``sync()`` within ``window`` seconds of each other are
+    synced by a single job on the I/O pool, and a directory shared by many
+    files in the batch is only synced once.
+    """
+
+    def __init__(self, run, window: float):
+        self._run = run
+        self._window = window
+        self._paths: dict = {}
+        self._done: Optional[asyncio.Future] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def sync(self, paths) -> None:
+        if not paths:
+            return
+        if self._done is None:
+            self._done = asyncio.get_running_loop().create_future()
+            self._flush_task = asyncio.create_task(self._flush())
+        self._paths.update(dict.fromkeys(paths))
+        await asyncio.shield(self._done)
+
+    async def _flush(self) -> None:
+        done = self._done
+        try:
+            await asyncio.sleep(self._window)
+            paths = list(self._paths)
+            self._paths, self._done = {}, None
+            await self._run(_fsync_paths, paths)
+        except asyncio.CancelledError:
+            done.cancel()
+            raise
+        except Exception as ex:
+            done.set_exception(ex)
+        else:
+            done.set_result(None)
+        finally:
+            if self._done is done:
+                self._paths, self._done = {}, None
+
+
+def _try_rename(source, destination) -> bool:
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # Most likely EXDEV: the source is on a different filesystem
+        return False
+    return True
+
+
+def _clone_file(src, dst) -> None:
+    """Copy all of ``src`` into the empty file ``dst`` without passing the
+    bytes through Python: a reflink where the filesystem supports one, then
+    an in-kernel ``copy_file_range()``, then a plain copy."""
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is not None:
+        offset = 0
+        try:
+            while copied := copy_file_range(
+                src.fileno(),
+                dst.fileno(),
+                _COPY_FILE_RANGE_CHUNK,
+                offset_src=offset,
+                offset_dst=offset,
+            ):
+                offset += copied
+            return
+        except OSError:
+            # e.g. EXDEV across filesystem types on older kernels
+            dst.truncate(0)
+    src.seek(0)
+    dst.seek(0)
+    shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+
+
+def _encode_cursor(path: str) -> str:
+    return base64.urlsafe_b64encode(path.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        path = base64.b64decode(padded, altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    # The sort keys _walk() compares against: every part but the file's own
+    # name is a directory
+    parts = path.split("/")
+    return tuple(part + "/" for part in parts[:-1]) + (parts[-1],)
+
+
+def _sort_key(entry):
+    # Sorting directories as "name/" puts the files below them where their
+    # full paths fall in plain string order, the order the catalog's path
+    # index uses
+    return entry.name + "/" if entry.is_dir(follow_symlinks=False) else entry.name
+
+
+def _walk(directory, parts: tuple, after: Optional[tuple]):
+    """Yield ``(path_parts, DirEntry)`` for files below ``directory``.
+
+    Files come out in the string order of their paths. ``after`` holds the
+    sort keys of the path to resume after: anything at or before it is
+    skipped without descending into it, which is what makes cursors cheap
+    to resume.
+    """
+    try:
+        with os.scandir(directory) as iterator:
+            entries = sorted(iterator, key=_sort_key)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    depth = len(parts)
+    for entry in entries:
+        entry_parts = parts + (entry.name,)
+        if entry_parts == (_INTERNAL_DIR,):
+            continue
+        on_cursor_path = False
+        if after is not None and depth < len(after):
+            key = _sort_key(entry)
+            if key < after[depth]:
+                continue
+            on_cursor_path = key == after[depth]
+        if entry.is_dir(follow_symlinks=False):
+            yield from _walk(entry.path, entry_parts, after if on_cursor_path else None)
+        elif entry.is_file() and not on_cursor_path:
+            yield entry_parts, entry
 
 
 class FilesystemStorage(Storage):
@@ -19,12 +243,40 @@ class FilesystemStorage(Storage):
     )
 
     async def configure(self, config: dict, get_secret) -> None:
+        io_threads = int(config.get("io_threads", DEFAULT_IO_THREADS))
+        if io_threads <= 0:
+            raise ValueError("io_threads must be greater than zero")
         self.root = Path(config["root"]).resolve()
+        self.content_addressed = bool(config.get("content_addressed", False))
+        self.durability = config.get("durability", "none")
+        if self.durability not in DURABILITY_MODES:
+            raise ValueError(
+                "durability must be one of: " + ", ".join(DURABILITY_MODES)
+            )
+        group_commit_ms = float(config.get("group_commit_ms", DEFAULT_GROUP_COMMIT_MS))
+        if group_commit_ms < 0:
+            raise ValueError("group_commit_ms must not be negative")
         self.capabilities = dataclasses.replace(
             FilesystemStorage.capabilities,
             max_file_size=config.get("max_file_size"),
+            content_addressed=self.content_addressed,
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=io_threads, thread_name_prefix="datasette-files-io"
+        )
+        self._group_commit = _GroupCommit(self._run, group_commit_ms / 1000)
+        await self._run(self.root.mkdir, parents=True, exist_ok=True)
+
+    async def close(self) -> None:
+        # Waits for writes already queued on the pool to finish
+        await asyncio.to_thread(self._executor.shutdown)
+
+    async def _run(self, fn, *args, **kwargs):
+        """Run a blocking filesystem call on this source's I/O thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
         )
-        self.root.mkdir(parents=True, exist_ok=True)
 
     def _safe_path(self, path: str) -> Path:
         target = (self.root / path).resolve()
@@ -32,45 +284,118 @@ class FilesystemStorage(Storage):
             raise ValueError(f"Path {path!r} resolves outside storage root")
         return target
 
-    async def get_file_metadata(self, path: str) -> Optional[FileMetadata]:
+    def _existing_path(self, path: str) -> Path:
         target = self._safe_path(path)
         if not target.exists():
-            return None
-        stat = target.stat()
-        return FileMetadata(
-            path=path,
-            filename=target.name,
-            size=stat.st_size,
-        )
+            raise FileNotFoundError(f"File not found: {path}")
+        return target
+
+    async def get_file_metadata(self, path: str) -> Optional[FileMetadata]:
+        def metadata():
+            target = self._safe_path(path)
+            if not target.exists():
+                return None
+            stat = target.stat()
+            return FileMetadata(
+                path=path,
+                filename=target.name,
+                size=stat.st_size,
+            )
+
+        return await self._run(metadata)
+
+    def watcher(self) -> InotifyWatcher:
+        """A watcher for changes under the root, skipping the reserved directory."""
+        return InotifyWatcher(self.root, exclude=[_INTERNAL_DIR])
+
+    async def stat_files(self, paths: list[str]) -> dict[str, Optional[FileMetadata]]:
+        """Look up several paths at once, reported the way ``list_files()`` would.
+
+        Paths that don't exist, aren't regular files or are inside the
+        reserved directory map to ``None``.
+        """
+
+        def stat_files():
+            found = {}
+            for path in paths:
+                found[path] = None
+                parts = path.split("/")
+                if parts[0] in ("", _INTERNAL_DIR) or ".." in parts:
+                    continue
+                try:
+                    stat = os.stat(self.root.joinpath(*parts))
+                except OSError:
+                    continue
+                if S_ISREG(stat.st_mode):
+                    found[path] = FileMetadata(
+                        path=path,
+                        filename=parts[-1],
+                        size=stat.st_size,
+                        etag=f"{stat.st_mtime_ns}-{stat.st_size}",
+                    )
+            return found
+
+        return await self._run(stat_files)
 
     async def read_file(self, path: str) -> bytes:
-        target = self._safe_path(path)
-        if not target.exists():
-            raise FileNotFoundError(f"File not found: {path}")
-        return target.read_bytes()
+        return await self._run(lambda: self._existing_path(path).read_bytes())
 
     async def read_file_limited(self, path: str, max_bytes: int) -> bytes:
-        target = self._safe_path(path)
-        if not target.exists():
-            raise FileNotFoundError(f"File not found: {path}")
-        if target.stat().st_size > max_bytes:
-            raise FileTooLarge.for_limit(max_bytes)
-        with open(target, "rb") as fileobj:
-            content = fileobj.read(max_bytes + 1)
-        if len(content) > max_bytes:
-            raise FileTooLarge.for_limit(max_bytes)
-        return content
+        def read_limited():
+            target = self._existing_path(path)
+            if target.stat().st_size > max_bytes:
+                raise FileTooLarge.for_limit(max_bytes)
+            with open(target, "rb") as fileobj:
+                content = fileobj.read(max_bytes + 1)
+            if len(content) > max_bytes:
+                raise FileTooLarge.for_limit(max_bytes)
+            return content
+
+        return await self._run(read_limited)
+
+    async def read_bytes(self, path: str, num_bytes: int = 2048) -> bytes:
+        def read_prefix():
+            with open(self._existing_path(path), "rb") as fileobj:
+                return fileobj.read(num_bytes)
+
+        return await self._run(read_prefix)
 
     async def stream_file(self, path: str) -> AsyncIterator[bytes]:
-        target = self._safe_path(path)
-        if not target.exists():
-            raise FileNotFoundError(f"File not found: {path}")
-        with open(target, "rb") as f:
-            while True:
-                chunk = f.read(65536)
+        async for chunk in self._stream(path):
+            yield chunk
+
+    async def stream_file_range(
+        self, path: str, offset: int, length: int
+    ) -> AsyncIterator[bytes]:
+        async for chunk in self._stream(path, offset, length):
+            yield chunk
+
+    async def _stream(
+        self, path: str, offset: int = 0, length: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        f = await self._run(lambda: open(self._existing_path(path), "rb"))
+        try:
+            if offset:
+                await self._run(f.seek, offset)
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = _CHUNK_SIZE if remaining is None else min(_CHUNK_SIZE, remaining)
+                chunk = await self._run(f.read, size)
                 if not chunk:
                     break
+                if remaining is not None:
+                    remaining -= len(chunk)
                 yield chunk
+        finally:
+            await self._run(f.close)
+
+    async def local_path(self, path: str) -> Optional[str]:
+        return str(await self._run(self._existing_path, path))
+
+    async def staging_directory(self) -> Optional[str]:
+        temp_dir = self.root / _INTERNAL_DIR / "tmp"
+        await self._run(temp_dir.mkdir, parents=True, exist_ok=True)
+        return str(temp_dir)
 
     async def list_files(
         self,
@@ -78,35 +403,60 @@ class FilesystemStorage(Storage):
         cursor: Optional[str] = None,
         limit: int = 100,
     ) -> tuple[list[FileMetadata], Optional[str]]:
-        files = []
-        search_root = self._safe_path(prefix) if prefix else self.root
-        for file_path in sorted(search_root.rglob("*")):
-            if file_path.is_file():
-                rel_path = str(file_path.relative_to(self.root))
-                stat = file_path.stat()
+        """List files in path order, resuming after ``cursor`` if given.
+
+        The walk is lazy and only ever holds one directory listing per level,
+        so the first page of a huge tree costs the same as the first page of
+        a small one.
+        """
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        after = _decode_cursor(cursor) if cursor else None
+
+        def list_files():
+            search_root = self._safe_path(prefix) if prefix else self.root
+            walker = _walk(search_root, search_root.relative_to(self.root).parts, after)
+            files = []
+            for parts, entry in walker:
+                if len(files) >= limit:
+                    return files, _encode_cursor(files[-1].path)
+                stat = entry.stat()
                 files.append(
                     FileMetadata(
-                        path=rel_path,
-                        filename=file_path.name,
+                        path="/".join(parts),
+                        filename=entry.name,
                         size=stat.st_size,
+                        etag=f"{stat.st_mtime_ns}-{stat.st_size}",
                     )
                 )
-                if len(files) >= limit:
-                    break
-        return files, None
+            return files, None
+
+        return await self._run(list_files)
 
     async def receive_upload(
         self, path: str, stream, content_type: str
     ) -> FileMetadata:
-        target = self._safe_path(path)
-        target.parent.mkdir(parents=True, exist_ok=True)
+        def write_chunk(f, sha256, chunk):
+            f.write(chunk)
+            sha256.update(chunk)
+
+        # Written to a temp file and renamed into place, so the target path
+        # never holds a partial file. In content-addressed mode the blob
+        # location also depends on the hash, only known at the end.
+        target, changed_dirs, f = await self._run(self._open_temp, path)
         sha256 = hashlib.sha256()
         size = 0
-        with open(target, "wb") as f:
+        try:
             async for chunk in stream:
-                f.write(chunk)
-                sha256.update(chunk)
+                await self._run(write_chunk, f, sha256, chunk)
                 size += len(chunk)
+            await self._run(f.close)
+            await self._commit(f.name, target, sha256.hexdigest(), changed_dirs)
+        except BaseException:
+            # Never leave a truncated file behind, e.g. when the client
+            # disconnects part-way through
+            await self._run(_close_and_unlink, f)
+            raise
         content_hash = "sha256:" + sha256.hexdigest()
         return FileMetadata(
             path=path,
@@ -116,8 +466,171 @@ class FilesystemStorage(Storage):
             size=size,
         )
 
-    async def delete_file(self, path: str) -> None:
+    async def receive_file(
+        self,
+        path: str,
+        source,
+        content_type: str,
+        content_hash: Optional[str] = None,
+    ) -> FileMetadata:
+        # A path on the same filesystem is renamed to the temp location;
+        # anything else is cloned there, then committed like an upload. In
+        # content-addressed mode the hash is known before anything is
+        # written, so content that is already stored is linked instead.
+        algorithm, _, hexdigest = (content_hash or "").partition(":")
+        if algorithm != "sha256" or not _SHA256_HEX_RE.match(hexdigest):
+            hexdigest = None
+
+        def stage(temp):
+            digest = hexdigest
+            is_path = isinstance(source, (str, os.PathLike))
+            if digest is not None and self._link_blob(temp, digest):
+                # Already stored: nothing to move or copy
+                return digest, os.stat(temp.name).st_size
+            if is_path and _try_rename(source, temp.name):
+                temp.close()
+                if digest is None:
+                    with open(temp.name, "rb") as f:
+                        digest = _sha256_of(f)
+            else:
+                src = open(source, "rb") if is_path else source
+                try:
+                    if digest is None:
+                        digest = _sha256_of(src)
+                    # Content the source already holds is not copied again
+                    if not self._link_blob(temp, digest):
+                        _clone_file(src, temp)
+                finally:
+                    if is_path:
+                        src.close()
+                temp.close()
+            return digest, os.stat(temp.name).st_size
+
+        target, changed_dirs, temp = await self._run(self._open_temp, path)
+        try:
+            digest, size = await self._run(stage, temp)
+            await self._commit(temp.name, target, digest, changed_dirs)
+        except BaseException:
+            await self._run(_close_and_unlink, temp)
+            raise
+        return FileMetadata(
+            path=path,
+            filename=Path(path).name,
+            content_type=content_type,
+            content_hash="sha256:" + digest,
+            size=size,
+        )
+
+    def _open_temp(self, path: str):
+        """Return ``(target, changed_dirs, temp_file)`` for writing ``path``."""
         target = self._safe_path(path)
-        if not target.exists():
-            raise FileNotFoundError(f"File not found: {path}")
-        target.unlink()
+        changed_dirs = _make_dirs(target.parent)
+        temp_dir = self.root / _INTERNAL_DIR / "tmp"
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        temp = tempfile.NamedTemporaryFile(dir=temp_dir, delete=False)
+        return target, changed_dirs, temp
+
+    async def _commit(
+        self, temp_path: str, target: Path, hexdigest: str, changed_dirs: list
+    ) -> None:
+        """Move a fully written temp file to ``target``, syncing as much of
+        it to disk as the ``durability`` setting asks for."""
+        if self.durability == "group-commit":
+            await self._group_commit.sync([temp_path])
+        elif self.durability != "none":
+            await self._run(_fsync_path, temp_path)
+        changed_dirs = changed_dirs + await self._run(
+            self._install, temp_path, target, hexdigest
+        )
+        if self.durability == "group-commit":
+            await self._group_commit.sync(changed_dirs)
+        elif self.durability == "fsync-file-and-dir":
+            await self._run(_fsync_paths, changed_dirs)
+
+    def _install(self, temp_path: str, target: Path, hexdigest: str) -> list:
+        """Rename the temp file to ``target``, returning the directories whose
+        entries changed."""
+        if self.content_addressed:
+            return self._store_blob(temp_path, target, hexdigest)
+        os.replace(temp_path, target)
+        return [target.parent]
+
+    def _blob_path(self, hexdigest: str) -> Path:
+        return (
+            self.root
+            / _INTERNAL_DIR
+            / "blobs"
+            / hexdigest[:2]
+            / hexdigest[2:4]
+            / hexdigest
+        )
+
+    def _link_blob(self, temp, hexdigest: str) -> bool:
+        """Replace the empty ``temp`` file with a hard link to an existing blob
+        with this content. Returns False, leaving ``temp`` alone, if there is
+        no such blob or this is not a content-addressed source."""
+        if not self.content_addressed:
+            return False
+        link = temp.name + ".blob"
+        try:
+            os.link(self._blob_path(hexdigest), link)
+        except OSError:
+            return False
+        temp.close()
+        os.replace(link, temp.name)
+        return True
+
+    def _store_blob(self, temp_path: str, target: Path, hexdigest: str) -> list:
+        """Move a written temp file into the blob store and hard-link ``target``
+        to the blob, reusing an existing blob with identical content."""
+        blob = self._blob_path(hexdigest)
+        changed_dirs = _make_dirs(blob.parent)
+        while True:
+            try:
+                os.link(temp_path, blob)
+                changed_dirs.append(blob.parent)
+                break
+            except FileExistsError:
+                pass
+            except OSError:
+                # No hard link support on this filesystem: keep a plain copy
+                break
+            link = temp_path + ".blob"
+            try:
+                os.link(blob, link)
+            except FileNotFoundError:
+                # Released since it was seen: make this copy the blob instead
+                continue
+            if os.path.samefile(link, temp_path):
+                # Already linked when staged; renaming one link over another
+                # to the same file would leave both in place
+                os.unlink(link)
+            else:
+                os.replace(link, temp_path)
+            break
+        os.replace(temp_path, target)
+        return changed_dirs + [target.parent]
+
+    async def release_content(self, content_hash: str) -> None:
+        algorithm, _, hexdigest = content_hash.partition(":")
+        if not self.content_addressed or algorithm != "sha256":
+            return
+        if not _SHA256_HEX_RE.match(hexdigest):
+            return
+
+        await self._run(_unlink_unshared_blob, self._blob_path(hexdigest))
+
+    async def release_unused_content(self) -> None:
+        if not self.content_addressed:
+            return
+
+        def sweep():
+            blobs = self.root / _INTERNAL_DIR / "blobs"
+            for dirpath, _, filenames in os.walk(blobs):
+                for filename in filenames:
+                    _unlink_unshared_blob(Path(dirpath) / filename)
+
+        await self._run(sweep)
+
+    async def delete_file(self, path: str) -> None:
+        await self._run(lambda: self._existing_path(path).unlink())
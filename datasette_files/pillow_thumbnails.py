@@ -1,14 +1,24 @@
 import asyncio
+import importlib.util
 import json
+import os
+import signal
+import socket
+import struct
 import sys
 from typing import Optional
 
 from .base import (
+    DEFAULT_THUMBNAIL_CONCURRENCY,
     DEFAULT_THUMBNAIL_MAX_PIXELS,
     DEFAULT_THUMBNAIL_MEMORY_LIMIT_BYTES,
+    DEFAULT_THUMBNAIL_WORKER_MAX_JOBS,
+    THUMBNAIL_FORMATS,
+    THUMBNAIL_WORKER_LAUNCH_MODES,
     ThumbnailGenerationError,
     ThumbnailGenerator,
     ThumbnailResult,
+    ThumbnailSource,
 )
 
 SUPPORTED_CONTENT_TYPES = {
@@ -20,46 +30,401 @@ SUPPORTED_CONTENT_TYPES = {
     "image/tiff",
 }
 
+
+def _encoder_available(output_format: str) -> bool:
+    # Pillow builds its WebP and AVIF support as optional extension modules.
+    # Look for them without importing Pillow into Datasette's process.
+    try:
+        return importlib.util.find_spec(f"PIL._{output_format}") is not None
+    except ImportError:
+        return False
+
+
+# Length prefix of each chunk of a streamed job; a zero length ends it
+_FRAME = struct.Struct("!I")
+
 _WORKER_COMMAND = [sys.executable, "-m", "datasette_files.pillow_worker"]
 
 
-def _parse_worker_response(stdout: bytes, returncode) -> ThumbnailResult:
-    header, separator, thumbnail = stdout.partition(b"\n")
-    if returncode or not separator:
-        raise ThumbnailGenerationError("generation_failed")
-    try:
-        response = json.loads(header)
-    except (json.JSONDecodeError, UnicodeDecodeError):
-        raise ThumbnailGenerationError("generation_failed")
+def _parse_worker_response(response: dict, body: bytes) -> list[ThumbnailResult]:
     if not response.get("ok"):
         raise ThumbnailGenerationError(
             response.get("reason", "generation_failed"),
             skipped=bool(response.get("skipped")),
         )
-    return ThumbnailResult(
-        thumb_bytes=thumbnail,
-        content_type=response["content_type"],
-        width=response["width"],
-        height=response["height"],
-    )
+    results = []
+    offset = 0
+    for rendition in response["renditions"]:
+        length = rendition["length"]
+        results.append(
+            ThumbnailResult(
+                thumb_bytes=body[offset : offset + length],
+                content_type=rendition["content_type"],
+                width=rendition["width"],
+                height=rendition["height"],
+            )
+        )
+        offset += length
+    return results
+
+
+class _Worker:
+    """One long-lived ``pillow_worker`` process and the streams to talk to it.
+
+    ``process`` is set for workers started as subprocesses of Datasette;
+    workers forked by the fork server are the fork server's children, which
+    it leaves to the kernel to reap. Those are signalled through ``pidfd``
+    where the platform has them, which can't reach another process that
+    has since been given the same PID.
+    """
+
+    def __init__(self, reader, writer, pid, process=None, pidfd=None):
+        self.reader = reader
+        self.writer = writer
+        self.pid = pid
+        self.process = process
+        self.pidfd = pidfd
+        self.jobs = 0
+        self._finished = False
+
+    @classmethod
+    def for_process(cls, process):
+        return cls(process.stdout, process.stdin, process.pid, process)
+
+    def alive(self) -> bool:
+        if self.process is not None:
+            return self.process.returncode is None
+        return not self.reader.at_eof()
+
+    async def run(self, header: dict, body) -> tuple[dict, bytes]:
+        """Send a job and return the worker's reply.
+
+        ``body`` is bytes, or an async iterator of chunks to stream to the
+        worker without holding them all.
+        """
+        if isinstance(body, bytes):
+            header = {**header, "length": len(body)}
+        else:
+            header = {**header, "chunked": True}
+        header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        try:
+            if isinstance(body, bytes):
+                self.writer.write(header + b"\n" + body)
+            else:
+                self.writer.write(header + b"\n")
+                async for chunk in body:
+                    if chunk:
+                        self.writer.write(_FRAME.pack(len(chunk)) + chunk)
+                        await self.writer.drain()
+                self.writer.write(_FRAME.pack(0))
+            await self.writer.drain()
+            line = await self.reader.readline()
+            response = json.loads(line)
+            output = await self.reader.readexactly(int(response["length"]))
+        except (
+            OSError,
+            asyncio.IncompleteReadError,
+            ValueError,
+            KeyError,
+            TypeError,
+        ):
+            # Crashed, was killed by the memory limit, or sent garbage
+            raise ThumbnailGenerationError("generation_failed")
+        self.jobs += 1
+        return response, output
+
+    def kill(self):
+        if self.process is not None:
+            # asyncio knows when it has reaped the process, so never signals
+            # a PID that may since have been reused
+            if self.process.returncode is None:
+                try:
+                    self.process.kill()
+                except ProcessLookupError:
+                    pass
+            return
+        if self._finished:
+            return
+        if self.pidfd is not None:
+            try:
+                signal.pidfd_send_signal(self.pidfd, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        elif not self.reader.at_eof():
+            # Without a pidfd, only signal the PID while the worker's socket
+            # shows no sign of it having exited
+            _kill(self.pid)
+        self._finish()
+
+    def _finish(self):
+        self._finished = True
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    async def wait(self):
+        if self.process is not None:
+            await self.process.wait()
+        else:
+            # The kernel reaps the fork server's children
+            self.writer.close()
+            self._finish()
+
+    async def close(self):
+        """Let the worker exit by closing its end of the pipe."""
+        try:
+            self.writer.close()
+            await self.wait()
+        except Exception:
+            self.kill()
+
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _pidfd_open(pid) -> Optional[int]:
+    """A pidfd for ``pid``, or None where pidfds aren't available."""
+    if not hasattr(os, "pidfd_open") or not hasattr(signal, "pidfd_send_signal"):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def fork_server_available() -> bool:
+    """True if this platform can run the ``forkserver`` launch mode."""
+    return hasattr(os, "fork") and hasattr(socket, "send_fds")
+
+
+class _ForkServer:
+    """A ``pillow_worker --zygote`` process that has already imported Pillow.
+
+    Each new worker is a fork of it, so starting one costs a fork rather
+    than starting Python and importing Pillow again. The two talk over a
+    Unix socket: Datasette sends one end of a fresh socket pair, the fork
+    server forks a worker that serves jobs on it and replies with its PID.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._control = None
+        self._lock = asyncio.Lock()
+
+    async def _start(self):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                *_WORKER_COMMAND,
+                "--zygote",
+                stdin=theirs.fileno(),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except BaseException:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        ours.setblocking(False)
+        self._control = ours
+
+    def _stop(self):
+        if self._control is not None:
+            self._control.close()
+            self._control = None
+        if self._process is not None:
+            if self._process.returncode is None:
+                try:
+                    self._process.kill()
+                except ProcessLookupError:
+                    pass
+            self._process = None
+
+    async def spawn(self) -> _Worker:
+        async with self._lock:
+            for attempt in range(2):
+                if self._process is None or self._process.returncode is not None:
+                    self._stop()
+                    await self._start()
+                ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    socket.send_fds(self._control, [b"w"], [theirs.fileno()])
+                    pid = struct.unpack("=i", await self._receive_pid())[0]
+                except OSError:
+                    # The fork server died: start another and try once more
+                    ours.close()
+                    self._stop()
+                    if attempt:
+                        raise ThumbnailGenerationError("generation_failed")
+                    continue
+                except BaseException:
+                    # Cancelled part-way through: its reply could still be on
+                    # the way, so this fork server can't be trusted again. The
+                    # worker exits when it finds its socket closed.
+                    ours.close()
+                    self._stop()
+                    raise
+                finally:
+                    theirs.close()
+                # The worker can't exit before its socket closes, so this
+                # is still the worker's PID
+                pidfd = _pidfd_open(pid)
+                reader, writer = await asyncio.open_unix_connection(sock=ours)
+                return _Worker(reader, writer, pid, pidfd=pidfd)
+
+    async def _receive_pid(self) -> bytes:
+        loop = asyncio.get_running_loop()
+        data = b""
+        while len(data) < 4:
+            chunk = await loop.sock_recv(self._control, 4 - len(data))
+            if not chunk:
+                raise ConnectionResetError("Fork server exited")
+            data += chunk
+        return data
+
+    async def close(self):
+        if self._control is not None:
+            # The fork server exits when the control socket closes
+            self._control.close()
+            self._control = None
+        if self._process is not None:
+            process, self._process = self._process, None
+            try:
+                await asyncio.wait_for(process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                process.kill()
+
+
+class WorkerPool:
+    """Up to ``size`` worker processes, started on demand and then reused.
+
+    A worker serves ``max_jobs`` thumbnails before it is replaced. One that
+    crashes, is cancelled part-way through a job (the coordinator's timeout)
+    or asks to be recycled is discarded and a new one started next time.
+
+    ``launch`` is ``"subprocess"`` to start each worker as a new Python
+    process, or ``"forkserver"`` to fork it from a fork server.
+    """
+
+    def __init__(
+        self,
+        size: int = 1,
+        max_jobs: int = DEFAULT_THUMBNAIL_WORKER_MAX_JOBS,
+        launch: str = "subprocess",
+    ):
+        if launch not in THUMBNAIL_WORKER_LAUNCH_MODES:
+            raise ValueError(f"Unknown worker launch mode {launch!r}")
+        if launch == "forkserver" and not fork_server_available():
+            raise ValueError("The forkserver launch mode needs os.fork()")
+        self.size = size
+        self.max_jobs = max_jobs
+        self.launch = launch
+        self._idle: list[_Worker] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._fork_server: Optional[_ForkServer] = None
+        self._loop = None
+
+    def _bind_to_running_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        # Pipes belong to the event loop that started the worker
+        for worker in self._idle:
+            worker.kill()
+        self._idle = []
+        if self._fork_server is not None:
+            self._fork_server._stop()
+        self._fork_server = _ForkServer() if self.launch == "forkserver" else None
+        self._slots = asyncio.Semaphore(self.size)
+        self._loop = loop
+
+    async def _spawn(self) -> _Worker:
+        if self._fork_server is not None:
+            return await self._fork_server.spawn()
+        process = await asyncio.create_subprocess_exec(
+            *_WORKER_COMMAND,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        return _Worker.for_process(process)
+
+    async def run(self, header: dict, body) -> tuple[dict, bytes]:
+        self._bind_to_running_loop()
+        async with self._slots:
+            worker = None
+            while self._idle and worker is None:
+                worker = self._idle.pop()
+                if not worker.alive():
+                    # Died while idle, for example to the OOM killer
+                    worker = None
+            if worker is None:
+                worker = await self._spawn()
+            try:
+                response, output = await worker.run(header, body)
+            except BaseException:
+                # The coordinator's timeout (or a dropped request) cancelled
+                # this coroutine, or the worker failed. Either way it can't be
+                # trusted with another job, and a cancelled one must not
+                # outlive the concurrency slot that is about to be released.
+                worker.kill()
+                await worker.wait()
+                raise
+            if response.get("recycle") or worker.jobs >= self.max_jobs:
+                await worker.close()
+            else:
+                self._idle.append(worker)
+            return response, output
+
+    async def close(self):
+        """Stop the idle workers and the fork server."""
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(worker.close() for worker in idle))
+        if self._fork_server is not None:
+            await self._fork_server.close()
+            self._fork_server = None
+            self._loop = None
 
 
 class PillowThumbnailGenerator(ThumbnailGenerator):
     name = "pillow"
-    version = "2"
+    version = "3"
 
     def __init__(
         self,
         *,
         max_pixels: int = DEFAULT_THUMBNAIL_MAX_PIXELS,
         memory_limit_bytes: int = DEFAULT_THUMBNAIL_MEMORY_LIMIT_BYTES,
+        workers: int = DEFAULT_THUMBNAIL_CONCURRENCY,
+        worker_max_jobs: int = DEFAULT_THUMBNAIL_WORKER_MAX_JOBS,
+        worker_launch: str = "subprocess",
     ):
         self.max_pixels = max_pixels
         self.memory_limit_bytes = memory_limit_bytes
+        self.pool = WorkerPool(workers, worker_max_jobs, worker_launch)
+        self.output_formats = tuple(
+            output_format
+            for output_format in THUMBNAIL_FORMATS
+            if _encoder_available(output_format)
+        )
 
     async def can_generate(self, content_type: str, filename: str) -> bool:
         return content_type in SUPPORTED_CONTENT_TYPES
 
+    def _job(self, sizes, format) -> dict:
+        # One job decodes the image once and scales it to every size
+        return {
+            "sizes": [list(size) for size in sizes],
+            "format": format,
+            "max_pixels": self.max_pixels,
+            "memory_limit_bytes": self.memory_limit_bytes,
+        }
+
     async def generate(
         self,
         file_bytes: bytes,
@@ -68,28 +433,40 @@ class PillowThumbnailGenerator(ThumbnailGenerator):
         max_width: int = 200,
         max_height: int = 200,
     ) -> Optional[ThumbnailResult]:
-        header = json.dumps(
-            {
-                "max_width": max_width,
-                "max_height": max_height,
-                "max_pixels": self.max_pixels,
-                "memory_limit_bytes": self.memory_limit_bytes,
-            },
-            separators=(",", ":"),
-        ).encode("utf-8")
-        process = await asyncio.create_subprocess_exec(
-            *_WORKER_COMMAND,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+        (result,) = await self.generate_renditions(
+            file_bytes, content_type, filename, [(max_width, max_height)]
         )
-        try:
-            stdout, _ = await process.communicate(header + b"\n" + file_bytes)
-        except asyncio.CancelledError:
-            # The coordinator's timeout (or a dropped request) cancelled this
-            # coroutine. The worker must not outlive it: its memory belongs to
-            # the concurrency slot that is about to be released.
-            process.kill()
-            await process.wait()
-            raise
-        return _parse_worker_response(stdout, process.returncode)
+        return result
+
+    async def generate_renditions(
+        self,
+        file_bytes: bytes,
+        content_type: str,
+        filename: str,
+        sizes: list[tuple[int, int]],
+        format: Optional[str] = None,
+    ) -> list[Optional[ThumbnailResult]]:
+        response, body = await self.pool.run(self._job(sizes, format), file_bytes)
+        return _parse_worker_response(response, body)
+
+    async def generate_from_source(
+        self,
+        source: ThumbnailSource,
+        content_type: str,
+        filename: str,
+        sizes: list[tuple[int, int]],
+        format: Optional[str] = None,
+    ) -> list[Optional[ThumbnailResult]]:
+        header = self._job(sizes, format)
+        path = await source.local_path()
+        if path is not None:
+            # The worker opens the file itself and Pillow reads only what it
+            # needs, so the file never passes through Datasette
+            header.update(path=path, max_bytes=source.max_bytes)
+            response, body = await self.pool.run(header, b"")
+        else:
+            response, body = await self.pool.run(header, source.chunks())
+        return _parse_worker_response(response, body)
+
+    async def close(self):
+        await self.pool.close()
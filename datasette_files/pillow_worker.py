@@ -1,13 +1,37 @@
 """Resource-constrained Pillow thumbnail worker.
 
-This module is an internal subprocess entry point. It accepts one JSON header line
-followed by image bytes on stdin, then writes a JSON header and thumbnail bytes.
+This module is an internal subprocess entry point. It serves thumbnail jobs
+one after another for as long as its stdin stays open. Each job is a JSON
+header line followed by ``length`` bytes of image, asking for thumbnails
+fitting each of its ``sizes``, encoded as its ``format``. A ``"chunked"``
+job streams the image instead, as length-prefixed chunks ending with an
+empty one, and a job with a ``path`` has the worker open the file itself.
+Each reply is a JSON header line followed by ``length`` bytes: the
+thumbnails described by its ``renditions``, one after another. A reply
+with ``"recycle": true`` means the worker exits after sending it.
+
+Run with ``--zygote`` it is instead a fork server: it imports Pillow once,
+then forks a worker for each socket it is sent over the Unix socket on its
+stdin, replying with the new worker's PID.
 """
 
 import io
 import json
+import math
+import os
+import signal
+import socket
+import struct
 import sys
 
+# EXIF tag holding how the stored image must be rotated or flipped
+_ORIENTATION = 0x0112
+# Scale down by cheap reduction only to this multiple of the target size,
+# leaving the rest to a high quality resize, as Image.thumbnail() does
+_REDUCING_GAP = 2.0
+# Length prefix of each chunk of a streamed job; a zero length ends it
+_FRAME = struct.Struct("!I")
+
 
 def _set_memory_limit(limit: int) -> None:
     # RLIMIT_AS is reliable on Linux, where small Datasette deployments commonly
@@ -20,50 +44,201 @@ def _set_memory_limit(limit: int) -> None:
 
 
 def _respond(payload: dict, body: bytes = b"") -> None:
+    payload = {**payload, "length": len(body)}
     sys.stdout.buffer.write(
         json.dumps(payload, separators=(",", ":")).encode("utf-8") + b"\n" + body
     )
+    sys.stdout.buffer.flush()
 
 
-def main() -> None:
-    try:
-        options = json.loads(sys.stdin.buffer.readline())
-        _set_memory_limit(int(options["memory_limit_bytes"]))
-        file_bytes = sys.stdin.buffer.read()
+def _fit(width: int, height: int, box) -> tuple[int, int]:
+    """The size ``Image.thumbnail(box)`` shrinks a width x height image to."""
+    max_width, max_height = box
+    if max_width >= width and max_height >= height:
+        return width, height
+    aspect = width / height
+    if max_width / max_height >= aspect:
+        return max(round(max_height * aspect), 1), max_height
+    return max_width, max(round(max_width / aspect), 1)
 
-        from PIL import Image, ImageOps
 
-        image = Image.open(io.BytesIO(file_bytes))
-        if image.width * image.height > int(options["max_pixels"]):
-            _respond({"ok": False, "reason": "too_many_pixels", "skipped": True})
-            return
-        image = ImageOps.exif_transpose(image)
-        image.thumbnail(
-            (int(options["max_width"]), int(options["max_height"])), Image.LANCZOS
+def _encode(image, output_format):
+    """Return ``(content_type, bytes)`` for a thumbnail in ``output_format``.
+
+    Without a format, images with transparency become PNG and others JPEG.
+    """
+    has_alpha = image.mode in ("RGBA", "LA", "PA")
+    output = io.BytesIO()
+    if output_format == "webp":
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        image.save(output, format="WEBP", quality=80)
+        return "image/webp", output.getvalue()
+    if output_format == "avif":
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        image.save(output, format="AVIF", quality=60)
+        return "image/avif", output.getvalue()
+    if has_alpha:
+        image.save(output, format="PNG")
+        return "image/png", output.getvalue()
+    image.convert("RGB").save(output, format="JPEG", quality=85)
+    return "image/jpeg", output.getvalue()
+
+
+def _thumbnails(options: dict, fp) -> None:
+    from PIL import Image, ImageOps
+
+    image = Image.open(fp)
+    width, height = image.size
+    if image.getexif().get(_ORIENTATION) in (5, 6, 7, 8):
+        # Stored on its side: the boxes apply once it is turned upright
+        width, height = height, width
+    targets = [
+        _fit(width, height, (int(box_width), int(box_height)))
+        for box_width, box_height in options["sizes"]
+    ]
+    # Have the decoder scale down as it goes where it can: libjpeg decodes
+    # JPEGs straight to 1/2, 1/4 or 1/8 size, in less time and memory
+    scale = _REDUCING_GAP * max(
+        max(target[0] / width, target[1] / height) for target in targets
+    )
+    if scale < 1:
+        image.draft(
+            None,
+            (math.ceil(image.width * scale), math.ceil(image.height * scale)),
+        )
+    # The limit applies to the pixels that will actually be decoded
+    if image.width * image.height > int(options["max_pixels"]):
+        _respond({"ok": False, "reason": "too_many_pixels", "skipped": True})
+        return
+    image = ImageOps.exif_transpose(image)
+    # Decode once, then scale down largest first: each rendition is resized
+    # from the smallest one already made that is still big enough
+    rendered = {}
+    for target in sorted(
+        set(targets), key=lambda size: size[0] * size[1], reverse=True
+    ):
+        source = min(
+            (
+                done
+                for size, done in rendered.items()
+                if size[0] >= target[0] and size[1] >= target[1]
+            ),
+            key=lambda done: done.width * done.height,
+            default=image,
         )
-        if image.mode in ("RGBA", "LA", "PA"):
-            output_format = "PNG"
-            output_content_type = "image/png"
+        if source.size == target:
+            rendered[target] = source
         else:
-            image = image.convert("RGB")
-            output_format = "JPEG"
-            output_content_type = "image/jpeg"
-        output = io.BytesIO()
-        image.save(output, format=output_format, quality=85)
-        _respond(
+            rendered[target] = source.resize(
+                target, Image.LANCZOS, reducing_gap=_REDUCING_GAP
+            )
+    renditions = []
+    body = []
+    for target in targets:
+        output_content_type, output = _encode(rendered[target], options.get("format"))
+        renditions.append(
             {
-                "ok": True,
                 "content_type": output_content_type,
-                "width": image.width,
-                "height": image.height,
-            },
-            output.getvalue(),
+                "width": target[0],
+                "height": target[1],
+                "length": len(output),
+            }
         )
-    except MemoryError:
-        _respond({"ok": False, "reason": "memory_limit"})
-    except Exception:
-        _respond({"ok": False, "reason": "generation_failed"})
+        body.append(output)
+    _respond({"ok": True, "renditions": renditions}, b"".join(body))
+
+
+def _thumbnails_from_path(options: dict) -> None:
+    try:
+        fp = open(options["path"], "rb")
+    except OSError:
+        _respond({"ok": False, "reason": "read_failed"})
+        return
+    with fp:
+        if os.fstat(fp.fileno()).st_size > int(options["max_bytes"]):
+            _respond({"ok": False, "reason": "too_large", "skipped": True})
+            return
+        _thumbnails(options, fp)
+
+
+def _read_body(options: dict):
+    if not options.get("chunked"):
+        return sys.stdin.buffer.read(int(options["length"]))
+    body = bytearray()
+    while True:
+        (length,) = _FRAME.unpack(sys.stdin.buffer.read(_FRAME.size))
+        if not length:
+            return body
+        body += sys.stdin.buffer.read(length)
+
+
+def main() -> None:
+    memory_limited = False
+    while True:
+        line = sys.stdin.buffer.readline()
+        if not line:
+            # The parent closed the pipe, or went away
+            return
+        try:
+            options = json.loads(line)
+            file_bytes = _read_body(options)
+        except Exception:
+            # Without a length the next header can't be found
+            _respond({"ok": False, "reason": "generation_failed", "recycle": True})
+            return
+        try:
+            if not memory_limited:
+                _set_memory_limit(int(options["memory_limit_bytes"]))
+                memory_limited = True
+            if "path" in options:
+                _thumbnails_from_path(options)
+            else:
+                _thumbnails(options, io.BytesIO(file_bytes))
+        except MemoryError:
+            # The heap may be left fragmented or half-freed: start afresh
+            _respond({"ok": False, "reason": "memory_limit", "recycle": True})
+            return
+        except Exception:
+            _respond({"ok": False, "reason": "generation_failed"})
+
+
+def zygote() -> None:
+    from PIL import Image
+
+    # Load every format plugin now, so forked workers don't each do it
+    Image.init()
+    control = socket.socket(fileno=os.dup(0))
+    # Nothing waits for the workers: have the kernel reap them
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            message, fds, _, _ = socket.recv_fds(control, 1, 1)
+        except OSError:
+            return
+        if not message:
+            # Datasette closed the control socket, or went away
+            return
+        if not fds:
+            continue
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            control.close()
+            os.dup2(fds[0], 0)
+            os.dup2(fds[0], 1)
+            os.close(fds[0])
+            try:
+                # The memory limit is applied here, in the worker, on its
+                # first job
+                main()
+            finally:
+                os._exit(0)
+        os.close(fds[0])
+        control.sendall(struct.pack("=i", pid))
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["--zygote"]:
+        zygote()
+    else:
+        main()
@@ -0,0 +1,150 @@
+"""Find where a source's storage and its catalog disagree.
+
+Storage is read with ``Storage.list_files()`` and the catalog through its
+``(source_id, path)`` index, both in path order, and the two streams are
+merge-joined. Only a page from each side is held in memory at a time, so
+this works the same for a source of any size. Two kinds of drift are
+reported:
+
+- orphans: files in storage with no catalog row, for example left behind
+  by a crash between receiving an upload's bytes and completing it
+- missing files: catalog rows whose file is no longer in storage
+
+Orphans can be reclaimed, deleting them from storage along with any shared
+content nothing else refers to. Files that belong to an upload still in
+progress are never treated as orphans.
+"""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from typing import Optional
+
+from .sync import DEFAULT_SYNC_PAGE_SIZE
+
+ORPHAN = "orphan"
+MISSING = "missing"
+
+
+@dataclass
+class Drift:
+    kind: str  # ORPHAN or MISSING
+    path: str
+    size: Optional[int] = None
+    # The catalog row, for missing files
+    file_id: Optional[str] = None
+    # True once an orphan has been deleted from storage
+    reclaimed: bool = False
+
+
+async def reconcile_catalog(
+    db,
+    storage,
+    source_id,
+    paths_in_use,
+    reclaim=False,
+    page_size=DEFAULT_SYNC_PAGE_SIZE,
+):
+    """Yield a ``Drift`` for every difference between storage and the catalog.
+
+    ``paths_in_use(paths)`` returns the paths that belong to uploads in
+    progress. ``list_files()`` must return paths in plain string order,
+    the order SQLite sorts the catalog in.
+    """
+    stored = _stored_files(storage, page_size)
+    catalogued = _catalog_rows(db, source_id, page_size)
+    file = await anext(stored, None)
+    row = await anext(catalogued, None)
+    candidates = []
+    while file is not None or row is not None:
+        if row is None or (file is not None and file.path < row["path"]):
+            candidates.append(file)
+            if len(candidates) >= page_size:
+                for drift in await _orphans(
+                    db, storage, source_id, candidates, paths_in_use, reclaim
+                ):
+                    yield drift
+                candidates = []
+            file = await anext(stored, None)
+        elif file is None or row["path"] < file.path:
+            yield Drift(MISSING, row["path"], size=row["size"], file_id=row["id"])
+            row = await anext(catalogued, None)
+        else:
+            file = await anext(stored, None)
+            row = await anext(catalogued, None)
+    for drift in await _orphans(
+        db, storage, source_id, candidates, paths_in_use, reclaim
+    ):
+        yield drift
+    if reclaim:
+        # Reclaimed orphans may have been the last files sharing a blob
+        await storage.release_unused_content()
+
+
+async def _stored_files(storage, page_size):
+    cursor = None
+    while True:
+        files, cursor = await storage.list_files(cursor=cursor, limit=page_size)
+        for file in files:
+            yield file
+        if cursor is None:
+            return
+
+
+async def _catalog_rows(db, source_id, page_size):
+    after = ""
+    while True:
+        rows = (
+            await db.execute(
+                """
+                SELECT id, path, size FROM datasette_files
+                WHERE source_id = ? AND path > ?
+                ORDER BY path
+                LIMIT ?
+                """,
+                [source_id, after, page_size],
+            )
+        ).rows
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        after = rows[-1]["path"]
+
+
+async def _orphans(db, storage, source_id, files, paths_in_use, reclaim):
+    """Confirm which candidate files really are orphans, reclaiming them if asked."""
+    if not files:
+        return []
+    paths = [file.path for file in files]
+    # Uploads in progress have their bytes in storage but no catalog row
+    # yet. Tokens are checked before the catalog because completing an
+    # upload adds its row before it removes its token.
+    in_use = await paths_in_use(paths)
+    # The merge may have read that part of the catalog before a row arrived
+    registered = {
+        row["path"]
+        for row in (
+            await db.execute(
+                """
+                SELECT path FROM datasette_files
+                WHERE source_id = ? AND path IN (SELECT value FROM json_each(?))
+                """,
+                [source_id, json.dumps(paths)],
+            )
+        ).rows
+    }
+    drifts = []
+    for file in files:
+        if file.path in in_use or file.path in registered:
+            continue
+        drift = Drift(ORPHAN, file.path, size=file.size)
+        if reclaim:
+            try:
+                await storage.delete_file(file.path)
+            except FileNotFoundError:
+                pass
+            drift.reclaimed = True
+        drifts.append(drift)
+    return drifts
@@ -593,17 +593,12 @@ class DatasetteFilePicker extends HTMLElement {
       }
       const prepData = await prepResp.json();
 
-      // Step 2: Upload file bytes
-      const formData = new FormData();
-      for (const [key, value] of Object.entries(prepData.upload_fields || {})) {
-        formData.append(key, value);
-      }
-      formData.append("file", file);
-
-      const uploadResp = await fetch(prepData.upload_url, {
-        method: "POST",
+      // Step 2: Upload file bytes as the raw request body
+      const uploadUrl = `${prepData.upload_url}?token=${encodeURIComponent(prepData.upload_token)}`;
+      const uploadResp = await fetch(uploadUrl, {
+        method: "PUT",
         headers: prepData.upload_headers || {},
-        body: formData,
+        body: file,
       });
       if (!uploadResp.ok) {
         throw new Error(`Upload failed (${uploadResp.status})`);
@@ -1,6 +1,6 @@
 // <datasette-file-upload> web component
 // Drag-and-drop multi-file upload area with progress bars.
-// Uses the prepare/upload/complete API flow.
+// Uses the prepare-batch/upload/complete-batch API flow.
 
 const _FILE_ICON_STYLES = {
   CSV:  { badge: '#2E7D32', bg: '#EEF7EE', stroke: '#7AB87E', fold: '#C4E0C5' },
@@ -59,6 +59,106 @@ function _setXhrHeaders(xhr, headers) {
   }
 }
 
+// Send the whole file as a multipart POST in one request.
+function _formUpload(prepData, file, onProgress) {
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open('POST', prepData.upload_url);
+    _setXhrHeaders(xhr, prepData.upload_headers);
+
+    xhr.upload.addEventListener('progress', (e) => {
+      if (e.lengthComputable) {
+        onProgress(file.size * (e.loaded / e.total));
+      }
+    });
+
+    xhr.addEventListener('load', () => {
+      if (xhr.status >= 200 && xhr.status < 300) {
+        resolve();
+      } else {
+        reject(new Error(`Upload failed (${xhr.status})`));
+      }
+    });
+    xhr.addEventListener('error', () => reject(new Error('Network error')));
+
+    const formData = new FormData();
+    // Add upload_fields
+    for (const [key, value] of Object.entries(prepData.upload_fields || {})) {
+      formData.append(key, value);
+    }
+    formData.append('file', file);
+    xhr.send(formData);
+  });
+}
+
+// Files prepared and completed per prepare-batch/complete-batch request. Kept
+// well under the server's limit so tokens aren't left waiting too long.
+const _UPLOAD_BATCH_SIZE = 50;
+
+const _RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024;
+const _RESUMABLE_MAX_RETRIES = 6;
+
+// PATCH one slice of the file at the given offset. Resolves with the server's
+// new offset; rejects with err.retryable set for network and 5xx failures.
+function _patchChunk(url, file, offset, onProgress) {
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open('PATCH', url);
+    xhr.setRequestHeader('Content-Type', 'application/offset+octet-stream');
+    xhr.setRequestHeader('Upload-Offset', String(offset));
+    xhr.upload.addEventListener('progress', (e) => onProgress(offset + e.loaded));
+    xhr.addEventListener('load', () => {
+      if (xhr.status >= 200 && xhr.status < 300) {
+        resolve(parseInt(xhr.getResponseHeader('Upload-Offset'), 10));
+        return;
+      }
+      let message = `Upload failed (${xhr.status})`;
+      try {
+        message = JSON.parse(xhr.responseText).errors[0] || message;
+      } catch (e) {}
+      const err = new Error(message);
+      // 409 means our offset is stale: ask the server where to continue
+      err.retryable = xhr.status >= 500 || xhr.status === 409;
+      reject(err);
+    });
+    xhr.addEventListener('error', () => {
+      const err = new Error('Network error');
+      err.retryable = true;
+      reject(err);
+    });
+    xhr.send(file.slice(offset, Math.min(offset + _RESUMABLE_CHUNK_SIZE, file.size)));
+  });
+}
+
+async function _uploadOffset(url) {
+  const resp = await fetch(url, { method: 'HEAD', cache: 'no-store' });
+  if (!resp.ok) throw new Error(`Upload failed (${resp.status})`);
+  return parseInt(resp.headers.get('Upload-Offset'), 10);
+}
+
+// Upload the file in chunks, asking the server how much it already has after
+// a failure and continuing from there instead of starting again.
+async function _resumableUpload(url, file, onProgress) {
+  let offset = 0;
+  let retries = 0;
+  do {
+    try {
+      offset = await _patchChunk(url, file, offset, onProgress);
+      retries = 0;
+    } catch (err) {
+      if (!err.retryable || retries >= _RESUMABLE_MAX_RETRIES) throw err;
+      await new Promise((r) => setTimeout(r, 500 * 2 ** retries));
+      retries += 1;
+      try {
+        offset = await _uploadOffset(url);
+      } catch (headErr) {
+        // Still offline - keep the old offset and try again after the next wait
+      }
+    }
+    onProgress(offset);
+  } while (offset < file.size);
+}
+
 class DatasetteFileUpload extends HTMLElement {
   connectedCallback() {
     this._source = this.getAttribute('source');
@@ -340,100 +440,118 @@ class DatasetteFileUpload extends HTMLElement {
     }
   }
 
-  async _uploadAll() {
-    this._uploading = true;
-    const pending = this._files.filter(f => f.status === 'pending');
+  _failEntry(entry, message) {
+    entry.status = 'error';
+    entry.progress = 100;
+    entry.error = message;
     this._renderFileList();
+  }
 
-    for (const entry of pending) {
-      entry.status = 'uploading';
-      entry.progress = 0;
-      this._renderFileList();
+  async _postJson(url, body, what) {
+    const resp = await fetch(url, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify(body),
+    });
+    if (!resp.ok) {
+      const errData = await resp.json().catch(() => null);
+      throw new Error(errData?.errors?.[0] || `${what} failed (${resp.status})`);
+    }
+    return resp.json();
+  }
 
-      try {
-        // Step 1: Prepare
-        entry.progress = 10;
-        this._renderFileList();
+  // Prepare and complete a batch of files in one request each, uploading
+  // the files themselves one at a time in between.
+  async _uploadBatch(entries) {
+    for (const entry of entries) {
+      entry.status = 'uploading';
+      entry.progress = 10;
+    }
+    this._renderFileList();
 
-        const prepResp = await fetch(`/-/files/upload/${this._source}/-/prepare`, {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-          body: JSON.stringify({
+    // Step 1: Prepare
+    let uploads;
+    try {
+      const prepData = await this._postJson(
+        `/-/files/upload/${this._source}/-/prepare-batch`,
+        {
+          files: entries.map(entry => ({
             filename: entry.file.name,
             content_type: entry.file.type || 'application/octet-stream',
             size: entry.file.size,
-          }),
-        });
-        if (!prepResp.ok) {
-          const errData = await prepResp.json().catch(() => null);
-          throw new Error(errData?.errors?.[0] || `Prepare failed (${prepResp.status})`);
-        }
-        const prepData = await prepResp.json();
-        entry.progress = 20;
-        this._renderFileList();
-
-        // Step 2: Upload file bytes using XHR for progress tracking
-        await new Promise((resolve, reject) => {
-          const xhr = new XMLHttpRequest();
-          xhr.open('POST', prepData.upload_url);
-          _setXhrHeaders(xhr, prepData.upload_headers);
-
-          xhr.upload.addEventListener('progress', (e) => {
-            if (e.lengthComputable) {
-              entry.progress = 20 + Math.round((e.loaded / e.total) * 60);
-              this._renderFileList();
-            }
-          });
-
-          xhr.addEventListener('load', () => {
-            if (xhr.status >= 200 && xhr.status < 300) {
-              resolve();
-            } else {
-              reject(new Error(`Upload failed (${xhr.status})`));
-            }
-          });
-          xhr.addEventListener('error', () => reject(new Error('Network error')));
-
-          const formData = new FormData();
-          // Add upload_fields
-          for (const [key, value] of Object.entries(prepData.upload_fields || {})) {
-            formData.append(key, value);
-          }
-          formData.append('file', entry.file);
-          xhr.send(formData);
-        });
+          })),
+        },
+        'Prepare',
+      );
+      uploads = prepData.uploads;
+    } catch (err) {
+      entries.forEach(entry => this._failEntry(entry, err.message));
+      return;
+    }
 
-        entry.progress = 85;
+    // Step 2: Upload file bytes, resuming after dropped connections
+    // when the server offers a resumable URL
+    const uploaded = new Map();
+    for (let i = 0; i < entries.length; i++) {
+      const entry = entries[i];
+      const upload = uploads[i];
+      entry.progress = 20;
+      this._renderFileList();
+      const onProgress = (loaded) => {
+        entry.progress = 20 + Math.round((loaded / (entry.file.size || 1)) * 60);
         this._renderFileList();
-
-        // Step 3: Complete
-        const completeResp = await fetch(`/-/files/upload/${this._source}/-/complete`, {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-          body: JSON.stringify({ upload_token: prepData.upload_token }),
-        });
-        if (!completeResp.ok) {
-          const errData = await completeResp.json().catch(() => null);
-          throw new Error(errData?.errors?.[0] || `Complete failed (${completeResp.status})`);
+      };
+      try {
+        if (upload.resumable_url) {
+          await _resumableUpload(upload.resumable_url, entry.file, onProgress);
+        } else {
+          await _formUpload(upload, entry.file, onProgress);
         }
-        const completeData = await completeResp.json();
-
-        entry.status = 'done';
-        entry.progress = 100;
-        entry.fileId = completeData.file.id;
+        entry.progress = 85;
         this._renderFileList();
-
+        uploaded.set(upload.upload_token, entry);
       } catch (err) {
-        entry.status = 'error';
-        entry.progress = 100;
-        entry.error = err.message;
-        this._renderFileList();
+        this._failEntry(entry, err.message);
       }
     }
+    if (uploaded.size === 0) return;
+
+    // Step 3: Complete
+    let results;
+    try {
+      const completeData = await this._postJson(
+        `/-/files/upload/${this._source}/-/complete-batch`,
+        { upload_tokens: [...uploaded.keys()] },
+        'Complete',
+      );
+      results = completeData.uploads;
+    } catch (err) {
+      uploaded.forEach(entry => this._failEntry(entry, err.message));
+      return;
+    }
+    for (const result of results) {
+      const entry = uploaded.get(result.upload_token);
+      if (!result.ok) {
+        this._failEntry(entry, result.error);
+        continue;
+      }
+      entry.status = 'done';
+      entry.progress = 100;
+      entry.fileId = result.file.id;
+    }
+    this._renderFileList();
+  }
+
+  async _uploadAll() {
+    this._uploading = true;
+    const pending = this._files.filter(f => f.status === 'pending');
+    this._renderFileList();
+
+    for (let i = 0; i < pending.length; i += _UPLOAD_BATCH_SIZE) {
+      await this._uploadBatch(pending.slice(i, i + _UPLOAD_BATCH_SIZE));
+    }
 
     this._uploading = false;
     this._renderFileList();
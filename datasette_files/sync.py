@@ -0,0 +1,409 @@
+"""Bring the catalog in line with what a source's storage actually holds.
+
+A sync walks the source with ``Storage.list_files()`` one page at a time,
+in path order. Each page is merged with the catalog rows for the same range
+of paths: new files are registered, files whose size or ``etag`` changed
+are updated, and catalog rows in the range with no listed file are
+tombstoned. Unchanged files are not written to at all.
+
+Each page's changes are written in one transaction together with the sync
+token, ``{"cursor", "after"}`` in ``datasette_files_sources.last_sync_token``,
+where ``after`` is the last path the walk has covered, so an interrupted
+sync picks up from the last page it finished instead of starting again.
+
+``sync_paths()`` applies the same comparison to just the paths a watcher
+reported, without walking the rest of the source.
+
+Files that belong to an upload still in progress are left for the upload
+to register when it completes, under the ID it has already handed out.
+"""
+
+from __future__ import annotations
+
+import json
+import mimetypes
+from dataclasses import dataclass, field
+
+from ulid import ULID
+
+DEFAULT_SYNC_PAGE_SIZE = 500
+
+SYNC_SQL = """
+CREATE TABLE IF NOT EXISTS datasette_files_tombstones (
+    id TEXT PRIMARY KEY,
+    source_id INTEGER NOT NULL REFERENCES datasette_files_sources(id),
+    path TEXT NOT NULL,
+    removed_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+CREATE INDEX IF NOT EXISTS datasette_files_tombstones_source_path
+    ON datasette_files_tombstones(source_id, path);
+"""
+
+
+@dataclass
+class SyncResult:
+    added: int = 0
+    updated: int = 0
+    removed: int = 0
+    unchanged: int = 0
+    # False if the walk stopped early (max_pages) and will resume next time
+    complete: bool = True
+    # The files updated and removed, whose cached thumbnails are now stale
+    updated_ids: list = field(default_factory=list, repr=False)
+    removed_ids: list = field(default_factory=list, repr=False)
+    # Content hashes only tombstoned files referred to, released from
+    # content-addressed storage once their transaction has committed
+    _unreferenced: set = field(default_factory=set, repr=False, compare=False)
+
+
+async def _load_token(db, source_id):
+    value = (
+        await db.execute(
+            "SELECT last_sync_token FROM datasette_files_sources WHERE id = ?",
+            [source_id],
+        )
+    ).single_value()
+    token = json.loads(value) if value else {}
+    # Tokens from before walks were merged with the catalog have no "after":
+    # they start again
+    if token.get("cursor") and "after" in token:
+        # Resume the interrupted walk
+        return token
+    return {"cursor": None, "after": ""}
+
+
+async def sync_catalog(
+    db,
+    storage,
+    source_id,
+    paths_in_use,
+    page_size=DEFAULT_SYNC_PAGE_SIZE,
+    max_pages=None,
+):
+    """Sync one source's catalog rows with its storage. Returns a ``SyncResult``.
+
+    ``paths_in_use(paths)`` returns the paths that belong to uploads in
+    progress. ``max_pages`` stops after that many pages; calling again
+    continues the same walk. ``list_files()`` must return paths in plain
+    string order, the order SQLite sorts the catalog in.
+    """
+    token = await _load_token(db, source_id)
+    result = SyncResult()
+    pages = 0
+    while True:
+        listed_at = (await db.execute("SELECT datetime('now')")).single_value()
+        files, next_cursor = await storage.list_files(
+            cursor=token["cursor"], limit=page_size
+        )
+        # The catalog range this page covers: (after, until], to the end of
+        # the catalog for the last page
+        after = token["after"]
+        until = None if next_cursor is None else (files[-1].path if files else after)
+        token = {"cursor": next_cursor, "after": until}
+        page = await _page_changes(db, source_id, files, paths_in_use)
+        await db.execute_write_fn(
+            lambda conn: _apply_page(
+                conn, source_id, page, token, (after, until), listed_at, result
+            )
+        )
+        await _release_unreferenced(storage, result)
+        pages += 1
+        if next_cursor is None:
+            return result
+        if max_pages is not None and pages >= max_pages:
+            result.complete = False
+            return result
+
+
+async def _page_changes(db, source_id, files, paths_in_use):
+    """Split a page of listed files into new, changed and unchanged files,
+    and unchanged files whose ``etag`` is not recorded yet."""
+    paths = [f.path for f in files]
+    rows = (
+        await db.execute(
+            """
+            SELECT id, path, size, content_hash, sync_etag
+            FROM datasette_files
+            WHERE source_id = ? AND path IN (SELECT value FROM json_each(?))
+            """,
+            [source_id, json.dumps(paths)],
+        )
+    ).rows
+    existing = {row["path"]: row for row in rows}
+    tombstones = {
+        row["path"]: row["id"]
+        for row in (
+            await db.execute(
+                """
+                SELECT id, path FROM datasette_files_tombstones
+                WHERE source_id = ? AND path IN (SELECT value FROM json_each(?))
+                """,
+                [source_id, json.dumps(paths)],
+            )
+        ).rows
+    }
+    # An upload in progress registers its own file when it completes
+    in_use = await paths_in_use([f.path for f in files if f.path not in existing])
+    new, changed, unchanged, untagged = [], [], [], []
+    for file in files:
+        row = existing.get(file.path)
+        if row is None and file.path in in_use:
+            continue
+        if row is None:
+            # A file that comes back to a path keeps the ID it had there
+            file_id = tombstones.get(file.path) or "df-" + str(ULID()).lower()
+            new.append((file_id, file))
+        elif _has_changed(row, file):
+            changed.append((row["id"], file))
+        else:
+            unchanged.append((row["id"], file))
+            if file.etag and not row["sync_etag"]:
+                untagged.append((row["id"], file))
+    return new, changed, unchanged, untagged
+
+
+def _has_changed(row, file):
+    if file.size is not None and file.size != row["size"]:
+        return True
+    if (
+        file.content_hash
+        and row["content_hash"]
+        and file.content_hash != row["content_hash"]
+    ):
+        return True
+    # Files registered by an upload have no etag yet: their first sync only
+    # records one
+    return bool(row["sync_etag"] and file.etag and file.etag != row["sync_etag"])
+
+
+def _apply_page(conn, source_id, page, token, path_range, listed_at, result):
+    _write_changes(conn, source_id, page, result)
+    listed = [file.path for _, file in page[0] + page[1] + page[2]]
+    _tombstone_unlisted(conn, source_id, path_range, listed, listed_at, result)
+    conn.execute(
+        "UPDATE datasette_files_sources SET last_sync_token = ? WHERE id = ?",
+        [json.dumps(token), source_id],
+    )
+
+
+def _write_changes(conn, source_id, page, result):
+    """Register new files and update changed ones."""
+    new, changed, unchanged, untagged = page
+    conn.executemany(
+        """
+        INSERT INTO datasette_files
+            (id, source_id, path, filename, content_type, content_hash, size,
+             sync_etag)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        -- Uploaded since the page was compared with the catalog
+        ON CONFLICT(source_id, path) DO NOTHING
+        """,
+        [
+            (
+                file_id,
+                source_id,
+                file.path,
+                file.filename,
+                file.content_type or mimetypes.guess_type(file.filename)[0],
+                file.content_hash,
+                file.size,
+                file.etag,
+            )
+            for file_id, file in new
+        ],
+    )
+    if new:
+        conn.execute(
+            "DELETE FROM datasette_files_tombstones WHERE id IN (SELECT value FROM json_each(?))",
+            [json.dumps([file_id for file_id, _ in new])],
+        )
+    conn.executemany(
+        """
+        UPDATE datasette_files
+        SET size = ?, content_hash = ?, width = NULL, height = NULL,
+            sync_etag = ?
+        WHERE id = ?
+        """,
+        [
+            (file.size, file.content_hash, file.etag, file_id)
+            for file_id, file in changed
+        ],
+    )
+    if changed:
+        # Cached thumbnails were made from the old content
+        changed_ids = json.dumps([file_id for file_id, _ in changed])
+        for table in (
+            "datasette_files_thumbnails",
+            "datasette_files_thumbnail_failures",
+        ):
+            conn.execute(
+                f"DELETE FROM {table} WHERE file_id IN (SELECT value FROM json_each(?))",
+                [changed_ids],
+            )
+    conn.executemany(
+        "UPDATE datasette_files SET sync_etag = ? WHERE id = ?",
+        [(file.etag, file_id) for file_id, file in untagged],
+    )
+    result.added += len(new)
+    result.updated += len(changed)
+    result.updated_ids.extend(file_id for file_id, _ in changed)
+    result.unchanged += len(unchanged)
+
+
+def _tombstone_unlisted(conn, source_id, path_range, listed, listed_at, result):
+    """Tombstone catalog rows in ``path_range``, ``(after, until]`` with
+    ``until`` None for no upper bound, that are not in ``listed``.
+
+    Uploads registered since the page was listed are left alone: their file
+    may have arrived after the listing. Rows a sync has seen have an
+    ``etag`` recorded, unless the backend has none. ``created_at`` only has
+    one second resolution, so other rows registered in the second the page
+    was listed wait for the next sync.
+    """
+    after, until = path_range
+    unlisted = conn.execute(
+        """
+        SELECT id, path FROM datasette_files
+        WHERE source_id = :source_id
+          AND path > :after
+          AND (:until IS NULL OR path <= :until)
+          AND path NOT IN (SELECT value FROM json_each(:listed))
+          AND (sync_etag IS NOT NULL OR created_at < :listed_at)
+        """,
+        {
+            "source_id": source_id,
+            "after": after,
+            "until": until,
+            "listed": json.dumps(listed),
+            "listed_at": listed_at,
+        },
+    ).fetchall()
+    _tombstone(conn, source_id, unlisted, result)
+
+
+def _tombstone(conn, source_id, rows, result):
+    """Replace ``(id, path)`` catalog rows with tombstones."""
+    if not rows:
+        return
+    conn.executemany(
+        "INSERT OR REPLACE INTO datasette_files_tombstones (id, source_id, path) VALUES (?, ?, ?)",
+        [(file_id, source_id, path) for file_id, path in rows],
+    )
+    ids = json.dumps([file_id for file_id, _ in rows])
+    hashes = [
+        content_hash
+        for (content_hash,) in conn.execute(
+            """
+            SELECT DISTINCT content_hash FROM datasette_files
+            WHERE id IN (SELECT value FROM json_each(?)) AND content_hash IS NOT NULL
+            """,
+            [ids],
+        )
+    ]
+    for table, column in (
+        ("datasette_files_thumbnails", "file_id"),
+        ("datasette_files_thumbnail_failures", "file_id"),
+        ("datasette_files", "id"),
+    ):
+        conn.execute(
+            f"DELETE FROM {table} WHERE {column} IN (SELECT value FROM json_each(?))",
+            [ids],
+        )
+    still_referenced = {
+        content_hash
+        for (content_hash,) in conn.execute(
+            """
+            SELECT DISTINCT content_hash FROM datasette_files
+            WHERE source_id = ? AND content_hash IN (SELECT value FROM json_each(?))
+            """,
+            [source_id, json.dumps(hashes)],
+        )
+    }
+    result._unreferenced.update(set(hashes) - still_referenced)
+    result.removed += len(rows)
+    result.removed_ids.extend(file_id for file_id, _ in rows)
+
+
+async def _release_unreferenced(storage, result):
+    """Content-addressed sources share one stored copy between files with the
+    same hash: release the copies tombstoned files were the last users of."""
+    hashes, result._unreferenced = result._unreferenced, set()
+    if not storage.capabilities.content_addressed:
+        return
+    for content_hash in sorted(hashes):
+        await storage.release_content(content_hash)
+
+
+async def sync_paths(
+    db,
+    storage,
+    source_id,
+    paths_in_use,
+    paths=(),
+    added_dirs=(),
+    removed_dirs=(),
+    page_size=DEFAULT_SYNC_PAGE_SIZE,
+):
+    """Sync the catalog for particular paths only, as reported by a watcher.
+
+    ``paths`` are looked up with ``storage.stat_files()``: ones that exist
+    are registered or updated, ones that don't are tombstoned. Everything
+    under ``removed_dirs`` is tombstoned and everything under ``added_dirs``
+    is listed and registered. ``paths_in_use`` is as for ``sync_catalog()``.
+    Returns a ``SyncResult``.
+    """
+    result = SyncResult()
+    if removed_dirs:
+        await db.execute_write_fn(
+            lambda conn: _tombstone_dirs(conn, source_id, removed_dirs, result)
+        )
+        await _release_unreferenced(storage, result)
+    paths = set(paths)
+    for directory in sorted(added_dirs):
+        cursor = None
+        while True:
+            files, cursor = await storage.list_files(
+                prefix=directory, cursor=cursor, limit=page_size
+            )
+            paths.difference_update(f.path for f in files)
+            await _apply_paths(db, storage, source_id, files, [], paths_in_use, result)
+            if cursor is None:
+                break
+    paths = sorted(paths)
+    for start in range(0, len(paths), page_size):
+        found = await storage.stat_files(paths[start : start + page_size])
+        files = [file for file in found.values() if file is not None]
+        missing = [path for path, file in found.items() if file is None]
+        await _apply_paths(db, storage, source_id, files, missing, paths_in_use, result)
+    return result
+
+
+async def _apply_paths(db, storage, source_id, files, missing, paths_in_use, result):
+    page = await _page_changes(db, source_id, files, paths_in_use)
+
+    def apply(conn):
+        _write_changes(conn, source_id, page, result)
+        rows = conn.execute(
+            """
+            SELECT id, path FROM datasette_files
+            WHERE source_id = ? AND path IN (SELECT value FROM json_each(?))
+            """,
+            [source_id, json.dumps(missing)],
+        ).fetchall()
+        _tombstone(conn, source_id, rows, result)
+
+    await db.execute_write_fn(apply)
+    await _release_unreferenced(storage, result)
+
+
+def _tombstone_dirs(conn, source_id, directories, result):
+    for directory in directories:
+        rows = conn.execute(
+            """
+            SELECT id, path FROM datasette_files
+            WHERE source_id = ? AND substr(path, 1, length(?) + 1) = ? || '/'
+            """,
+            [source_id, directory, directory],
+        ).fetchall()
+        _tombstone(conn, source_id, rows, result)
@@ -0,0 +1,384 @@
+"""Where generated thumbnails are kept.
+
+Thumbnails are cached per file and rendition (a size, plus an encoding when
+one was negotiated, e.g. ``"200x200.webp"``) under the thumbnail policy's
+cache key. Two backends are available:
+
+- ``disk`` keeps each thumbnail in its own file under a directory sharded by
+  file ID. Reading and writing thumbnails never touches the internal
+  database, so they don't queue behind catalog writes or bloat it.
+- ``database`` keeps them as BLOBs in the ``datasette_files_thumbnails``
+  table of the internal database.
+
+Every cached thumbnail is also tagged with a version of its file's content,
+so a file that changes never has thumbnails of its old content served.
+
+In front of either backend, ``RecentThumbnails`` keeps the most recently
+served responses in memory, so popular thumbnails are served without
+reading them again.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from .base import ThumbnailResult
+
+# Default bound on the bytes of thumbnail responses kept in memory
+DEFAULT_THUMBNAIL_MEMORY_CACHE_BYTES = 16 * 1024 * 1024
+# File IDs are checked against the catalog this many at a time by prune()
+_PRUNE_BATCH = 500
+
+
+class ThumbnailCache(ABC):
+    """Stores thumbnails keyed by file ID, content version, cache key and
+    rendition."""
+
+    async def startup(self, datasette) -> None:
+        """Called once when Datasette starts."""
+
+    @abstractmethod
+    async def get(
+        self, file_id: str, version: str, cache_key: str, rendition: str
+    ) -> Optional[ThumbnailResult]:
+        """Return a cached thumbnail, or None."""
+
+    @abstractmethod
+    async def renditions(self, file_id: str, version: str, cache_key: str) -> set:
+        """Return the names of the renditions cached for a file."""
+
+    @abstractmethod
+    async def put(
+        self,
+        file_id: str,
+        version: str,
+        cache_key: str,
+        generator: str,
+        results: dict,
+    ) -> None:
+        """Cache ``{rendition: ThumbnailResult}`` for a file.
+
+        Thumbnails the file has under any other version or cache key are
+        discarded.
+        """
+
+    @abstractmethod
+    async def delete(self, file_ids: list) -> None:
+        """Discard every thumbnail of the given files."""
+
+    async def prune(self, cache_key: str, renditions, versions) -> None:
+        """Discard thumbnails nothing will ask for again.
+
+        ``renditions`` lists the rendition names still configured.
+        ``await versions(file_ids)`` returns ``{file_id: version}`` for the
+        given files that are still in the catalog.
+        """
+
+
+class DatabaseThumbnailCache(ThumbnailCache):
+    """Keeps thumbnails in the internal database.
+
+    Catalog changes delete a file's rows in the same transaction, so the
+    content version is not stored.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+
+    async def startup(self, datasette):
+        self.db = datasette.get_internal_database()
+
+    async def get(self, file_id, version, cache_key, rendition):
+        rows = (
+            await self.db.execute(
+                """
+                SELECT thumbnail, content_type, width, height, cache_key
+                FROM datasette_files_thumbnails
+                WHERE file_id = ? AND rendition = ?
+                """,
+                [file_id, rendition],
+            )
+        ).rows
+        for row in rows:
+            if row["cache_key"] == cache_key:
+                return ThumbnailResult(
+                    thumb_bytes=row["thumbnail"],
+                    content_type=row["content_type"],
+                    width=row["width"],
+                    height=row["height"],
+                )
+            # Every rendition was made under the same policy
+            await self.delete([file_id])
+        return None
+
+    async def renditions(self, file_id, version, cache_key):
+        rows = (
+            await self.db.execute(
+                """
+                SELECT rendition FROM datasette_files_thumbnails
+                WHERE file_id = ? AND cache_key = ?
+                """,
+                [file_id, cache_key],
+            )
+        ).rows
+        return {row["rendition"] for row in rows}
+
+    async def put(self, file_id, version, cache_key, generator, results):
+        await self.db.execute_write_many(
+            """INSERT OR REPLACE INTO datasette_files_thumbnails
+               (file_id, rendition, thumbnail, content_type, width, height,
+                generator, cache_key)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            [
+                [
+                    file_id,
+                    rendition,
+                    result.thumb_bytes,
+                    result.content_type,
+                    result.width,
+                    result.height,
+                    generator,
+                    cache_key,
+                ]
+                for rendition, result in results.items()
+            ],
+        )
+
+    async def delete(self, file_ids):
+        await self.db.execute_write(
+            """
+            DELETE FROM datasette_files_thumbnails
+            WHERE file_id IN (SELECT value FROM json_each(?))
+            """,
+            [json.dumps(list(file_ids))],
+        )
+
+    async def prune(self, cache_key, renditions, versions):
+        # Rows of deleted or changed files went with them, and rows made
+        # under an older cache key are replaced when next requested
+        await self.db.execute_write(
+            """
+            DELETE FROM datasette_files_thumbnails
+            WHERE rendition NOT IN (SELECT value FROM json_each(?))
+            """,
+            [json.dumps(list(renditions))],
+        )
+
+
+class DiskThumbnailCache(ThumbnailCache):
+    """Keeps each thumbnail in a file of its own under ``directory``.
+
+    The layout is ``<shard>/<file ID>/<key>/<rendition>``. The shard is the
+    last two characters of the file ID, the random end of a ULID, so files
+    spread evenly. The key is a hash of the cache key and content version.
+    Each file holds a JSON header line describing the thumbnail, then its
+    bytes. Files are written under a temporary name and renamed into place,
+    so readers never see half a thumbnail.
+
+    Without a ``directory`` thumbnails go next to the internal database
+    file, in a directory named after it with ``-thumbnails`` added. When the
+    internal database is temporary so are they: they go in a private
+    temporary directory, created when first needed and removed when the
+    process exits.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = os.path.abspath(directory) if directory else None
+
+    async def startup(self, datasette):
+        db = datasette.get_internal_database()
+        if self.directory is None and db.path and not (db.is_memory or db.is_temp_disk):
+            self.directory = os.path.splitext(db.path)[0] + "-thumbnails"
+
+    def _file_dir(self, file_id):
+        return os.path.join(self.directory, file_id[-2:], file_id)
+
+    def _key_dir(self, file_id, version, cache_key):
+        key = hashlib.sha256(f"{cache_key}\0{version}".encode("utf-8")).hexdigest()
+        return os.path.join(self._file_dir(file_id), key[:32])
+
+    async def get(self, file_id, version, cache_key, rendition):
+        if self.directory is None:
+            return None
+        path = os.path.join(self._key_dir(file_id, version, cache_key), rendition)
+        return await asyncio.to_thread(_read_thumbnail, path)
+
+    async def renditions(self, file_id, version, cache_key):
+        if self.directory is None:
+            return set()
+        key_dir = self._key_dir(file_id, version, cache_key)
+        try:
+            names = await asyncio.to_thread(os.listdir, key_dir)
+        except FileNotFoundError:
+            return set()
+        return {name for name in names if not name.startswith(".")}
+
+    async def put(self, file_id, version, cache_key, generator, results):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="datasette-files-thumbnails-")
+            atexit.register(shutil.rmtree, self.directory, True)
+        key_dir = self._key_dir(file_id, version, cache_key)
+        await asyncio.to_thread(_write_thumbnails, key_dir, generator, results)
+
+    async def delete(self, file_ids):
+        if self.directory is None:
+            return
+
+        def delete():
+            for file_id in file_ids:
+                shutil.rmtree(self._file_dir(file_id), ignore_errors=True)
+
+        await asyncio.to_thread(delete)
+
+    async def prune(self, cache_key, renditions, versions):
+        if self.directory is None:
+            return
+        renditions = set(renditions)
+        try:
+            shards = await asyncio.to_thread(os.listdir, self.directory)
+        except FileNotFoundError:
+            return
+        for shard in sorted(shards):
+            shard_dir = os.path.join(self.directory, shard)
+            try:
+                file_ids = sorted(await asyncio.to_thread(os.listdir, shard_dir))
+            except NotADirectoryError:
+                continue
+            for start in range(0, len(file_ids), _PRUNE_BATCH):
+                batch = file_ids[start : start + _PRUNE_BATCH]
+                current = await versions(batch)
+                await asyncio.to_thread(
+                    self._prune_files, batch, current, cache_key, renditions
+                )
+
+    def _prune_files(self, file_ids, current, cache_key, renditions):
+        for file_id in file_ids:
+            file_dir = self._file_dir(file_id)
+            if file_id not in current:
+                # Deleted, or removed from its source by a sync
+                shutil.rmtree(file_dir, ignore_errors=True)
+                continue
+            key_dir = self._key_dir(file_id, current[file_id], cache_key)
+            try:
+                keys = os.listdir(file_dir)
+            except NotADirectoryError:
+                continue
+            for key in keys:
+                if key != os.path.basename(key_dir):
+                    # Older content, or an older policy
+                    shutil.rmtree(os.path.join(file_dir, key), ignore_errors=True)
+                    continue
+                for name in os.listdir(key_dir):
+                    # Renditions no longer configured. Temporary files may
+                    # belong to a write in progress.
+                    if name not in renditions and not name.startswith("."):
+                        os.remove(os.path.join(key_dir, name))
+
+
+def _read_thumbnail(path) -> Optional[ThumbnailResult]:
+    try:
+        with open(path, "rb") as fp:
+            header = json.loads(fp.readline())
+            return ThumbnailResult(
+                thumb_bytes=fp.read(),
+                content_type=header["content_type"],
+                width=header["width"],
+                height=header["height"],
+            )
+    except FileNotFoundError:
+        return None
+
+
+def _write_thumbnails(key_dir, generator, results):
+    os.makedirs(key_dir, exist_ok=True)
+    for rendition, result in results.items():
+        header = {
+            "content_type": result.content_type,
+            "width": result.width,
+            "height": result.height,
+            "generator": generator,
+        }
+        temp_path = os.path.join(key_dir, f".{rendition}.{secrets.token_hex(8)}")
+        with open(temp_path, "wb") as fp:
+            fp.write(json.dumps(header).encode("utf-8") + b"\n")
+            fp.write(result.thumb_bytes)
+        os.replace(temp_path, os.path.join(key_dir, rendition))
+    # Thumbnails of older content, or made under an older policy
+    file_dir = os.path.dirname(key_dir)
+    for key in os.listdir(file_dir):
+        if key != os.path.basename(key_dir):
+            shutil.rmtree(os.path.join(file_dir, key), ignore_errors=True)
+
+
+THUMBNAIL_CACHES = {
+    "disk": DiskThumbnailCache,
+    "database": DatabaseThumbnailCache,
+}
+
+
+@dataclass
+class CachedResponse:
+    """A thumbnail or icon response body, ready to send."""
+
+    body: bytes
+    content_type: str
+    etag: str
+
+
+class RecentThumbnails:
+    """The most recently served thumbnail responses, least recently used
+    dropped first once their bodies total more than ``max_bytes``.
+
+    Keys are tuples starting with the file ID, so every response for a file
+    can be discarded when it is deleted, or None for responses shared by
+    many files.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_THUMBNAIL_MEMORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._keys_by_file = {}
+
+    def get(self, key: tuple) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, entry: CachedResponse) -> None:
+        if key in self._entries:
+            self._remove(key)
+        if len(entry.body) > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._keys_by_file.setdefault(key[0], set()).add(key)
+        self.size += len(entry.body)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def discard(self, file_ids) -> None:
+        """Forget every response for the given files."""
+        for file_id in file_ids:
+            for key in list(self._keys_by_file.get(file_id, ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.body)
+        keys = self._keys_by_file[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_file[key[0]]
@@ -0,0 +1,438 @@
+"""Upload token stores.
+
+An upload token carries an upload from the prepare request, through the
+request(s) that send the bytes, to the complete request. Where tokens live
+decides which processes can serve those requests: the in-memory store only
+works when they all reach the same process, the database store lets any
+process sharing the internal database handle any of them.
+"""
+
+from __future__ import annotations
+
+import collections
+import dataclasses
+import heapq
+import json
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from .base import FileMetadata
+
+DEFAULT_UPLOAD_TOKEN_TTL = 3600  # 1 hour
+DEFAULT_MAX_PENDING_UPLOADS_PER_ACTOR = 1000
+# A claim older than this is assumed to belong to a request that died with
+# its process, and may be taken over
+CLAIM_TIMEOUT_SECONDS = 600
+
+
+@dataclass
+class UploadToken:
+    source_slug: str
+    filename: str
+    content_type: str
+    size: Optional[int]
+    path: str
+    file_id: str
+    created_at: float
+    used: bool = False
+    content_received: bool = False
+    actor: Optional[dict] = None
+    file_meta: Optional[FileMetadata] = None
+    actual_size: Optional[int] = None
+    # Resumable uploads: bytes received so far and where they are staged
+    offset: int = 0
+    staging_path: Optional[str] = None
+    # Running hash of the staged bytes. Only kept in memory, so a store that
+    # loses it makes the backend hash the staged file instead.
+    staging_sha256: Optional[Any] = None
+
+
+class UploadTokenStore(ABC):
+    """Keeps upload tokens between requests.
+
+    Tokens are treated as missing once they are more than ``ttl`` seconds
+    old. ``get()`` returns a token's current state; changes made to it are
+    persisted by passing it to ``save()``. No actor may hold more than
+    ``max_per_actor`` unexpired tokens at once.
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_UPLOAD_TOKEN_TTL,
+        max_per_actor: int = DEFAULT_MAX_PENDING_UPLOADS_PER_ACTOR,
+    ):
+        self.ttl = ttl
+        self.max_per_actor = max_per_actor
+
+    async def startup(self, datasette) -> None:
+        """Called once when Datasette starts."""
+
+    @abstractmethod
+    async def add(self, token: str, data: UploadToken) -> bool:
+        """Store a new token.
+
+        Returns False, storing nothing, if the token's actor already holds
+        ``max_per_actor`` tokens.
+        """
+
+    @abstractmethod
+    async def get(self, token: str) -> Optional[UploadToken]:
+        """Return the token, or None if it does not exist or has expired."""
+
+    @abstractmethod
+    async def save(self, token: str, data: UploadToken) -> None:
+        """Persist changes to a token returned by ``get()``."""
+
+    @abstractmethod
+    async def remove(self, token: str) -> None:
+        """Delete a token."""
+
+    @abstractmethod
+    async def claim(self, token: str) -> bool:
+        """Mark the token as receiving content.
+
+        Returns False if another request already has it claimed.
+        """
+
+    @abstractmethod
+    async def release(self, token: str) -> None:
+        """Release a claim taken with ``claim()``."""
+
+    @abstractmethod
+    async def mark_used(self, token: str) -> bool:
+        """Mark the token as completed, returning False if it already was."""
+
+    async def mark_used_many(self, tokens: list[str]) -> list[str]:
+        """Mark several tokens as completed, returning those that weren't already."""
+        return [token for token in tokens if await self.mark_used(token)]
+
+    async def remove_many(self, tokens: list[str]) -> None:
+        """Delete several tokens."""
+        for token in tokens:
+            await self.remove(token)
+
+    @abstractmethod
+    async def remove_expired(self) -> list[UploadToken]:
+        """Delete expired tokens that are not claimed, returning them."""
+
+    @abstractmethod
+    async def paths_in_use(self, source_slug: str, paths: list[str]) -> set[str]:
+        """Which of these storage paths belong to a token that still exists."""
+
+
+class MemoryUploadTokenStore(UploadTokenStore):
+    """Keeps tokens in a dictionary in this process."""
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_UPLOAD_TOKEN_TTL,
+        max_per_actor: int = DEFAULT_MAX_PENDING_UPLOADS_PER_ACTOR,
+    ):
+        super().__init__(ttl, max_per_actor)
+        self._tokens: dict[str, UploadToken] = {}
+        self._claimed: set[str] = set()
+        # Heap of (created_at, token). Every token lives for the same ttl, so
+        # remove_expired() only has to look at the oldest. Tokens removed
+        # early stay here until they become the oldest.
+        self._expiry: list[tuple[float, str]] = []
+        # Expired tokens remove_expired() had to keep because they were claimed
+        self._expired_claimed: set[str] = set()
+        self._per_actor: collections.Counter[str] = collections.Counter()
+
+    def _expired(self, data: UploadToken, now: float) -> bool:
+        return now - data.created_at > self.ttl
+
+    def _pop(self, token: str) -> Optional[UploadToken]:
+        data = self._tokens.pop(token, None)
+        if data is not None:
+            key = _actor_key(data.actor)
+            self._per_actor[key] -= 1
+            if not self._per_actor[key]:
+                del self._per_actor[key]
+        return data
+
+    async def add(self, token, data):
+        key = _actor_key(data.actor)
+        if self._per_actor[key] >= self.max_per_actor:
+            return False
+        self._tokens[token] = data
+        heapq.heappush(self._expiry, (data.created_at, token))
+        self._per_actor[key] += 1
+        return True
+
+    async def get(self, token):
+        data = self._tokens.get(token)
+        if data is None or self._expired(data, time.time()):
+            return None
+        return data
+
+    async def save(self, token, data):
+        # get() hands out the stored object itself
+        if token in self._tokens:
+            self._tokens[token] = data
+
+    async def remove(self, token):
+        self._pop(token)
+
+    async def claim(self, token):
+        if token in self._claimed:
+            return False
+        self._claimed.add(token)
+        return True
+
+    async def release(self, token):
+        self._claimed.discard(token)
+
+    async def mark_used(self, token):
+        data = self._tokens.get(token)
+        if data is None or data.used:
+            return False
+        data.used = True
+        return True
+
+    async def remove_expired(self):
+        now = time.time()
+        expired = []
+        for token in list(self._expired_claimed):
+            if token not in self._claimed:
+                self._expired_claimed.discard(token)
+                data = self._pop(token)
+                if data is not None:
+                    expired.append(data)
+        while self._expiry:
+            token = self._expiry[0][1]
+            data = self._tokens.get(token)
+            if data is not None and not self._expired(data, now):
+                break
+            heapq.heappop(self._expiry)
+            if data is None:
+                continue
+            if token in self._claimed:
+                self._expired_claimed.add(token)
+            else:
+                expired.append(self._pop(token))
+        return expired
+
+    async def paths_in_use(self, source_slug, paths):
+        paths = set(paths)
+        return {
+            data.path
+            for data in self._tokens.values()
+            if data.source_slug == source_slug and data.path in paths
+        }
+
+
+def _add_token_path_columns(conn):
+    """Give tables created before tokens were indexed by path their columns."""
+    columns = {
+        row[1]
+        for row in conn.execute("PRAGMA table_info(datasette_files_upload_tokens)")
+    }
+    if "path" in columns:
+        return
+    for column in ("source_slug", "path"):
+        conn.execute(
+            f"ALTER TABLE datasette_files_upload_tokens "
+            f"ADD COLUMN {column} TEXT NOT NULL DEFAULT ''"
+        )
+    conn.execute("""
+        UPDATE datasette_files_upload_tokens SET
+            source_slug = json_extract(data, '$.source_slug'),
+            path = json_extract(data, '$.path')
+        """)
+
+
+class DatabaseUploadTokenStore(UploadTokenStore):
+    """Keeps tokens in Datasette's internal database.
+
+    Every process using the same internal database file (``--internal``)
+    sees the same tokens.
+    """
+
+    CREATE_SQL = """
+    CREATE TABLE IF NOT EXISTS datasette_files_upload_tokens (
+        token TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        claimed_at REAL,
+        used INTEGER NOT NULL DEFAULT 0,
+        actor_key TEXT NOT NULL DEFAULT '',
+        source_slug TEXT NOT NULL DEFAULT '',
+        path TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX IF NOT EXISTS datasette_files_upload_tokens_expires_at
+        ON datasette_files_upload_tokens(expires_at);
+    CREATE INDEX IF NOT EXISTS datasette_files_upload_tokens_actor_key
+        ON datasette_files_upload_tokens(actor_key, expires_at);
+    """
+    INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS datasette_files_upload_tokens_source_path
+        ON datasette_files_upload_tokens(source_slug, path);
+    """
+
+    async def startup(self, datasette):
+        self._db = datasette.get_internal_database()
+        await self._db.execute_write_script(self.CREATE_SQL)
+        await self._db.execute_write_fn(_add_token_path_columns)
+        await self._db.execute_write_script(self.INDEX_SQL)
+
+    async def add(self, token, data):
+        # Count and insert in one statement so concurrent prepares from other
+        # processes can't overshoot the limit
+        result = await self._db.execute_write(
+            """
+            INSERT INTO datasette_files_upload_tokens
+                (token, data, expires_at, used, actor_key, source_slug, path)
+            SELECT :token, :data, :expires_at, :used, :actor_key, :source_slug, :path
+            WHERE (
+                SELECT count(*) FROM datasette_files_upload_tokens
+                WHERE actor_key = :actor_key AND expires_at > :now
+            ) < :max_per_actor
+            """,
+            {
+                "token": token,
+                "data": _dump_token(data),
+                "expires_at": data.created_at + self.ttl,
+                "used": int(data.used),
+                "actor_key": _actor_key(data.actor),
+                "source_slug": data.source_slug,
+                "path": data.path,
+                "now": time.time(),
+                "max_per_actor": self.max_per_actor,
+            },
+        )
+        return result.rowcount == 1
+
+    async def get(self, token):
+        row = (
+            await self._db.execute(
+                """
+                SELECT data, used FROM datasette_files_upload_tokens
+                WHERE token = ? AND expires_at > ?
+                """,
+                [token, time.time()],
+            )
+        ).first()
+        if row is None:
+            return None
+        data = _load_token(row["data"])
+        data.used = bool(row["used"])
+        return data
+
+    async def save(self, token, data):
+        await self._db.execute_write(
+            "UPDATE datasette_files_upload_tokens SET data = ? WHERE token = ?",
+            [_dump_token(data), token],
+        )
+
+    async def remove(self, token):
+        await self._db.execute_write(
+            "DELETE FROM datasette_files_upload_tokens WHERE token = ?", [token]
+        )
+
+    async def claim(self, token):
+        now = time.time()
+        result = await self._db.execute_write(
+            """
+            UPDATE datasette_files_upload_tokens SET claimed_at = :now
+            WHERE token = :token
+              AND (claimed_at IS NULL OR claimed_at < :stale)
+            """,
+            {"token": token, "now": now, "stale": now - CLAIM_TIMEOUT_SECONDS},
+        )
+        return result.rowcount == 1
+
+    async def release(self, token):
+        await self._db.execute_write(
+            "UPDATE datasette_files_upload_tokens SET claimed_at = NULL WHERE token = ?",
+            [token],
+        )
+
+    async def mark_used(self, token):
+        result = await self._db.execute_write(
+            """
+            UPDATE datasette_files_upload_tokens SET used = 1
+            WHERE token = ? AND used = 0
+            """,
+            [token],
+        )
+        return result.rowcount == 1
+
+    async def mark_used_many(self, tokens):
+        result = await self._db.execute_write(
+            """
+            UPDATE datasette_files_upload_tokens SET used = 1
+            WHERE token IN (SELECT value FROM json_each(?)) AND used = 0
+            RETURNING token
+            """,
+            [json.dumps(tokens)],
+            return_all=True,
+        )
+        return [row[0] for row in result.fetchall()]
+
+    async def remove_many(self, tokens):
+        await self._db.execute_write(
+            """
+            DELETE FROM datasette_files_upload_tokens
+            WHERE token IN (SELECT value FROM json_each(?))
+            """,
+            [json.dumps(tokens)],
+        )
+
+    async def remove_expired(self):
+        now = time.time()
+        result = await self._db.execute_write(
+            """
+            DELETE FROM datasette_files_upload_tokens
+            WHERE expires_at <= :now
+              AND (claimed_at IS NULL OR claimed_at < :stale)
+            RETURNING data
+            """,
+            {"now": now, "stale": now - CLAIM_TIMEOUT_SECONDS},
+            return_all=True,
+        )
+        return [_load_token(row[0]) for row in result.fetchall()]
+
+    async def paths_in_use(self, source_slug, paths):
+        rows = (
+            await self._db.execute(
+                """
+                SELECT path FROM datasette_files_upload_tokens
+                WHERE source_slug = ? AND path IN (SELECT value FROM json_each(?))
+                """,
+                [source_slug, json.dumps(list(paths))],
+            )
+        ).rows
+        return {row[0] for row in rows}
+
+
+def _actor_key(actor: Optional[dict]) -> str:
+    """Tokens are counted per actor ID; anonymous uploads share one allowance."""
+    actor_id = (actor or {}).get("id")
+    return "" if actor_id is None else str(actor_id)
+
+
+def _dump_token(data: UploadToken) -> str:
+    fields = {
+        field.name: getattr(data, field.name)
+        for field in dataclasses.fields(data)
+        if field.name != "staging_sha256"
+    }
+    if data.file_meta is not None:
+        fields["file_meta"] = dataclasses.asdict(data.file_meta)
+    return json.dumps(fields)
+
+
+def _load_token(value: str) -> UploadToken:
+    fields = json.loads(value)
+    if fields["file_meta"] is not None:
+        fields["file_meta"] = FileMetadata(**fields["file_meta"])
+    return UploadToken(**fields)
+
+
+UPLOAD_TOKEN_STORES = {
+    "memory": MemoryUploadTokenStore,
+    "database": DatabaseUploadTokenStore,
+}
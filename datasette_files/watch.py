@@ -0,0 +1,254 @@
+"""Watch a filesystem source's root for changes made by other processes.
+
+On Linux this uses inotify, called through ``ctypes`` so no extra dependency
+is needed. inotify is not recursive, so every directory under the root gets
+its own watch, and directories that appear later are watched as they show
+up. Events are gathered for a short debounce window and handed over as one
+``WatchBatch``, so a burst of writes becomes a single catalog update.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import ctypes
+import errno
+import functools
+import os
+import struct
+import sys
+from dataclasses import dataclass, field
+
+# From <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_EXCL_UNLINK = 0x04000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+
+_WATCH_MASK = (
+    _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_ONLYDIR
+    | _IN_DONT_FOLLOW
+    | _IN_EXCL_UNLINK
+)
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+_EVENT = struct.Struct("iIII")
+_READ_SIZE = 65536
+
+
+@dataclass
+class WatchBatch:
+    """Changes seen during one debounce window, as paths relative to the root."""
+
+    # Files that were created, written, moved or deleted: look at them again
+    paths: set = field(default_factory=set)
+    # Directories that appeared: everything under them is new
+    added_dirs: set = field(default_factory=set)
+    # Directories that went away, along with everything under them
+    removed_dirs: set = field(default_factory=set)
+    # The kernel dropped events, so only a full sync can be trusted
+    overflowed: bool = False
+
+    def __bool__(self):
+        return bool(
+            self.paths or self.added_dirs or self.removed_dirs or self.overflowed
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def _libc():
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def inotify_available() -> bool:
+    """True if this platform supports inotify."""
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        _libc()
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+def _os_error():
+    number = ctypes.get_errno()
+    return OSError(number, os.strerror(number))
+
+
+class InotifyWatcher:
+    """Collect changes under ``root`` into batches.
+
+    ``exclude`` names top-level directories to leave alone, such as the
+    storage's own reserved directory.
+    """
+
+    def __init__(self, root, exclude=()):
+        self.root = str(root)
+        self._exclude = set(exclude)
+        self._fd = None
+        # Watch descriptor <-> directory relative to the root ("" is the root)
+        self._dirs: dict[int, str] = {}
+        self._wds: dict[str, int] = {}
+        self._batch = WatchBatch()
+        self._pending = asyncio.Event()
+        # Directories that appeared and are still being walked
+        self._watching: set = set()
+
+    async def start(self):
+        """Watch every directory under the root and start reading events.
+
+        Raises ``OSError`` if inotify cannot be used, for example when the
+        tree needs more watches than ``fs.inotify.max_user_watches`` allows.
+        """
+        fd = _libc().inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            raise _os_error()
+        self._fd = fd
+        try:
+            # Walking a large tree takes a while: keep it off the event loop
+            self._record_watches(await asyncio.to_thread(self._add_watches, ""))
+        except BaseException:
+            self.close()
+            raise
+        asyncio.get_running_loop().add_reader(fd, self._read)
+
+    def close(self):
+        if self._fd is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._fd)
+        except RuntimeError:
+            pass
+        for task in self._watching:
+            task.cancel()
+        os.close(self._fd)
+        self._fd = None
+        self._dirs.clear()
+        self._wds.clear()
+
+    async def batches(self, debounce):
+        """Yield a ``WatchBatch`` for every ``debounce`` seconds that saw changes."""
+        while True:
+            await self._pending.wait()
+            await asyncio.sleep(debounce)
+            # New directories are reported once they are being watched, so
+            # nothing written in them from then on can be missed
+            while self._watching:
+                await asyncio.wait(set(self._watching))
+            batch, self._batch = self._batch, WatchBatch()
+            self._pending.clear()
+            yield batch
+
+    def _add_watches(self, directory):
+        """Watch every directory under ``directory``, returning
+        ``[(wd, relative path)]``.
+
+        This runs in a thread, so it leaves the watch maps to
+        ``_record_watches()`` on the event loop.
+        """
+        watches = []
+        top = os.path.join(self.root, directory) if directory else self.root
+        for dirpath, dirnames, _ in os.walk(top):
+            relative = os.path.relpath(dirpath, self.root)
+            relative = "" if relative == "." else relative.replace(os.sep, "/")
+            if not relative:
+                dirnames[:] = [d for d in dirnames if d not in self._exclude]
+            wd = _libc().inotify_add_watch(self._fd, os.fsencode(dirpath), _WATCH_MASK)
+            if wd < 0:
+                error = _os_error()
+                if error.errno in (errno.ENOENT, errno.ENOTDIR):
+                    # Gone again before it could be watched
+                    continue
+                raise error
+            watches.append((wd, relative))
+        return watches
+
+    def _record_watches(self, watches):
+        for wd, relative in watches:
+            self._dirs[wd] = relative
+            self._wds[relative] = wd
+
+    def _watch_new_tree(self, directory):
+        async def watch():
+            try:
+                watches = await asyncio.to_thread(self._add_watches, directory)
+            except OSError:
+                # Out of watches: the tree can no longer be followed event
+                # by event
+                self._batch.overflowed = True
+                self._pending.set()
+                return
+            if self._fd is not None:
+                self._record_watches(watches)
+
+        task = asyncio.get_running_loop().create_task(watch())
+        self._watching.add(task)
+        task.add_done_callback(self._watching.discard)
+
+    def _unwatch_tree(self, directory):
+        for relative in [
+            d for d in self._wds if d == directory or d.startswith(directory + "/")
+        ]:
+            wd = self._wds.pop(relative)
+            self._dirs.pop(wd, None)
+            # Fails harmlessly if the kernel already dropped the watch
+            _libc().inotify_rm_watch(self._fd, wd)
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            self._handle(wd, mask, name)
+        if self._batch:
+            self._pending.set()
+
+    def _handle(self, wd, mask, name):
+        batch = self._batch
+        if mask & _IN_Q_OVERFLOW:
+            batch.overflowed = True
+            return
+        if mask & _IN_IGNORED:
+            directory = self._dirs.pop(wd, None)
+            if directory is not None and self._wds.get(directory) == wd:
+                del self._wds[directory]
+            return
+        directory = self._dirs.get(wd)
+        if directory is None or not name:
+            return
+        if not directory and name in self._exclude:
+            return
+        path = f"{directory}/{name}" if directory else name
+        if not mask & _IN_ISDIR:
+            batch.paths.add(path)
+        elif mask & (_IN_CREATE | _IN_MOVED_TO):
+            # Walked off the event loop, as moving in a large tree adds a
+            # watch for every directory in it
+            self._watch_new_tree(path)
+            batch.added_dirs.add(path)
+        elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+            self._unwatch_tree(path)
+            batch.removed_dirs.add(path)
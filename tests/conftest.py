@@ -2,6 +2,28 @@ from datasette.app import Datasette
 import asyncio
 import json
 import pytest
+import pytest_asyncio
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def drain_eager_thumbnails():
+    """Let background thumbnail tasks finish before the test's event loop closes.
+
+    Cancelling one while it is still starting its worker subprocess can leave
+    the loop waiting forever during teardown. Background source syncs never
+    finish on their own, so they are cancelled, and idle thumbnail workers are
+    stopped.
+    """
+    yield
+    from datasette_files import (
+        _close_thumbnail_generators,
+        _drain_eager_thumbnails,
+        _stop_sync_tasks,
+    )
+
+    await _drain_eager_thumbnails()
+    await _stop_sync_tasks()
+    await _close_thumbnail_generators()
 
 
 @pytest.fixture
@@ -0,0 +1,178 @@
+"""Tests for the prepare-batch and complete-batch upload endpoints."""
+
+import json
+
+import pytest
+
+from conftest import _make_datasette
+
+FILES = [
+    {"filename": "one.txt", "content_type": "text/plain", "size": 3},
+    {"filename": "two.txt", "content_type": "text/plain", "size": 3},
+    {"filename": "three.txt", "content_type": "text/plain", "size": 5},
+]
+
+
+async def _post_json(ds, path, body):
+    return await ds.client.post(
+        path,
+        content=json.dumps(body),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+async def _prepare_batch(ds, files=FILES):
+    response = await _post_json(
+        ds, "/-/files/upload/test-uploads/-/prepare-batch", {"files": files}
+    )
+    assert response.status_code == 200, response.text
+    return response.json()["uploads"]
+
+
+async def _put(ds, upload, content):
+    response = await ds.client.put(
+        f"{upload['upload_url']}?token={upload['upload_token']}", content=content
+    )
+    assert response.status_code == 200, response.text
+
+
+async def _complete_batch(ds, tokens):
+    return await _post_json(
+        ds, "/-/files/upload/test-uploads/-/complete-batch", {"upload_tokens": tokens}
+    )
+
+
+@pytest.mark.asyncio
+async def test_batch_upload(datasette_all_permissions):
+    ds = datasette_all_permissions
+    uploads = await _prepare_batch(ds)
+    assert len(uploads) == 3
+    assert len({u["upload_token"] for u in uploads}) == 3
+    assert all("resumable_url" in u for u in uploads)
+
+    contents = [b"one", b"two", b"three"]
+    for upload, content in zip(uploads, contents):
+        await _put(ds, upload, content)
+
+    response = await _complete_batch(ds, [u["upload_token"] for u in uploads])
+    assert response.status_code == 200, response.text
+    data = response.json()
+    assert data["ok"] is True
+    assert [u["upload_token"] for u in data["uploads"]] == [
+        u["upload_token"] for u in uploads
+    ]
+    files = [u["file"] for u in data["uploads"]]
+    assert [f["filename"] for f in files] == ["one.txt", "two.txt", "three.txt"]
+    for file, content in zip(files, contents):
+        assert file["size"] == len(content)
+        download = await ds.client.get(file["download_url"])
+        assert download.content == content
+
+
+@pytest.mark.asyncio
+async def test_complete_batch_uses_one_transaction(datasette_all_permissions):
+    ds = datasette_all_permissions
+    uploads = await _prepare_batch(ds)
+    for upload in uploads:
+        await _put(ds, upload, b"abc")
+
+    db = ds.get_internal_database()
+    original = db.execute_write_many
+    calls = []
+
+    async def execute_write_many(sql, params_seq, **kwargs):
+        params_seq = list(params_seq)
+        calls.append(len(params_seq))
+        return await original(sql, params_seq, **kwargs)
+
+    db.execute_write_many = execute_write_many
+    response = await _complete_batch(ds, [u["upload_token"] for u in uploads])
+    assert response.json()["ok"] is True
+    assert calls == [3]
+
+
+@pytest.mark.asyncio
+async def test_complete_batch_reports_per_token_errors(datasette_all_permissions):
+    ds = datasette_all_permissions
+    uploads = await _prepare_batch(ds)
+    # Only the first two get content
+    await _put(ds, uploads[0], b"abc")
+    await _put(ds, uploads[1], b"abc")
+
+    tokens = [u["upload_token"] for u in uploads] + ["tok_nope"]
+    data = (await _complete_batch(ds, tokens)).json()
+    assert data["ok"] is False
+    assert [u["ok"] for u in data["uploads"]] == [True, True, False, False]
+    assert data["uploads"][2]["error"] == "File content has not been uploaded yet"
+    assert data["uploads"][3]["error"] == "Invalid or expired upload token"
+
+    # Completed tokens can't be completed again
+    again = (await _complete_batch(ds, tokens[:1])).json()
+    assert again["uploads"][0]["ok"] is False
+
+    # The failed one can still be finished later
+    await _put(ds, uploads[2], b"later")
+    later = (await _complete_batch(ds, tokens[2:3])).json()
+    assert later["ok"] is True
+    assert later["uploads"][0]["file"]["size"] == 5
+
+
+@pytest.mark.asyncio
+async def test_complete_batch_with_database_token_store(upload_dir):
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        plugin_options={"upload_token_store": "database"},
+    )
+    uploads = await _prepare_batch(ds)
+    for upload in uploads:
+        await _put(ds, upload, b"abc")
+    tokens = [u["upload_token"] for u in uploads]
+    data = (await _complete_batch(ds, tokens + tokens[:1])).json()
+    assert data["ok"] is True
+    assert len(data["uploads"]) == 3
+    again = (await _complete_batch(ds, tokens)).json()
+    assert [u["ok"] for u in again["uploads"]] == [False, False, False]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "body,message",
+    [
+        ({}, "files must be a non-empty list"),
+        ({"files": []}, "files must be a non-empty list"),
+        ({"files": [{"filename": "a.txt"}, {}]}, "files[1]: filename is required"),
+    ],
+)
+async def test_prepare_batch_validation(datasette_all_permissions, body, message):
+    response = await _post_json(
+        datasette_all_permissions, "/-/files/upload/test-uploads/-/prepare-batch", body
+    )
+    assert response.status_code == 400
+    assert response.json()["errors"] == [message]
+
+
+@pytest.mark.asyncio
+async def test_prepare_batch_over_limit_issues_no_tokens(upload_dir):
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        plugin_options={"max_pending_uploads_per_actor": 2},
+    )
+    response = await _post_json(
+        ds, "/-/files/upload/test-uploads/-/prepare-batch", {"files": FILES}
+    )
+    assert response.status_code == 429
+    # Nothing from the rejected batch is left counting against the limit
+    assert len(await _prepare_batch(ds, FILES[:2])) == 2
+
+
+@pytest.mark.asyncio
+async def test_batch_endpoints_require_upload_permission(datasette_browse_only):
+    ds = datasette_browse_only
+    response = await _post_json(
+        ds, "/-/files/upload/test-uploads/-/prepare-batch", {"files": FILES}
+    )
+    assert response.status_code == 403
+    response = await _complete_batch(ds, ["tok_x"])
+    assert response.status_code == 403
@@ -60,3 +60,177 @@ async def test_delete_nonexistent_file(datasette_all_permissions):
         headers={"Content-Type": "application/json"},
     )
     assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_delete_content_addressed_releases_blob_with_last_reference(upload_dir):
+    from conftest import _make_datasette
+
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True, "files-delete": True},
+        extra_sources={
+            "test-uploads": {
+                "storage": "filesystem",
+                "config": {"root": upload_dir, "content_addressed": True},
+            }
+        },
+    )
+    first = await _upload_file(ds, filename="a.txt", content=b"same bytes")
+    second = await _upload_file(ds, filename="b.txt", content=b"same bytes")
+    assert first["file"]["content_hash"] == second["file"]["content_hash"]
+    hexdigest = first["file"]["content_hash"].split(":")[1]
+    blob = os.path.join(
+        upload_dir,
+        ".datasette-files",
+        "blobs",
+        hexdigest[:2],
+        hexdigest[2:4],
+        hexdigest,
+    )
+    assert os.path.exists(blob)
+
+    response = await ds.client.post(
+        f"/-/files/{first['file_id']}/-/delete",
+        content=json.dumps({}),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 200
+    assert os.path.exists(blob)
+    download = await ds.client.get(f"/-/files/{second['file_id']}/download")
+    assert download.content == b"same bytes"
+
+    response = await ds.client.post(
+        f"/-/files/{second['file_id']}/-/delete",
+        content=json.dumps({}),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 200
+    assert not os.path.exists(blob)
+
+
+async def _delete_batch(ds, file_ids):
+    return await ds.client.post(
+        "/-/files/-/delete-batch",
+        content=json.dumps({"file_ids": file_ids}),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+@pytest.mark.asyncio
+async def test_delete_batch(datasette_all_permissions, upload_dir):
+    ds = datasette_all_permissions
+    uploaded = [await _upload_file(ds, filename=f"f{i}.txt") for i in range(5)]
+    paths = [
+        os.path.join(upload_dir, u["file_id"][3:], f"f{i}.txt")
+        for i, u in enumerate(uploaded)
+    ]
+    assert all(os.path.exists(path) for path in paths)
+    file_ids = [u["file_id"] for u in uploaded]
+
+    response = await _delete_batch(ds, file_ids + ["df-00000000000000000000000000"])
+    assert response.status_code == 200
+    data = response.json()
+    assert data["ok"] is False
+    assert data["files"][:5] == [{"id": i, "ok": True} for i in file_ids]
+    assert data["files"][5]["error"] == "File not found"
+
+    assert not any(os.path.exists(path) for path in paths)
+    for file_id in file_ids:
+        response = await ds.client.get(f"/-/files/{file_id}.json")
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_delete_batch_checks_permission_once_per_source(
+    datasette_all_permissions,
+):
+    ds = datasette_all_permissions
+    file_ids = [(await _upload_file(ds))["file_id"] for _ in range(4)]
+    db = ds.get_internal_database()
+
+    calls = []
+    original_sql = ds.allowed_resources_sql
+    original_write_fn = db.execute_write_fn
+
+    async def allowed_resources_sql(**kwargs):
+        calls.append(("permission", kwargs["action"]))
+        return await original_sql(**kwargs)
+
+    async def execute_write_fn(fn, **kwargs):
+        calls.append(("write", None))
+        return await original_write_fn(fn, **kwargs)
+
+    ds.allowed_resources_sql = allowed_resources_sql
+    db.execute_write_fn = execute_write_fn
+    response = await _delete_batch(ds, file_ids)
+    assert response.json()["ok"] is True
+    assert calls == [("permission", "files-delete"), ("write", None)]
+
+
+@pytest.mark.asyncio
+async def test_delete_batch_keeps_catalog_row_when_storage_fails(
+    datasette_all_permissions, monkeypatch
+):
+    import datasette_files
+
+    ds = datasette_all_permissions
+    good = (await _upload_file(ds, filename="good.txt"))["file_id"]
+    bad = (await _upload_file(ds, filename="bad.txt"))["file_id"]
+    storage = datasette_files._sources["test-uploads"]
+    original = storage.delete_file
+
+    async def delete_file(path):
+        if path.endswith("bad.txt"):
+            raise OSError("disk on fire")
+        await original(path)
+
+    monkeypatch.setattr(storage, "delete_file", delete_file)
+    data = (await _delete_batch(ds, [good, bad])).json()
+    assert data["files"][0] == {"id": good, "ok": True}
+    assert "disk on fire" in data["files"][1]["error"]
+    assert (await ds.client.get(f"/-/files/{good}.json")).status_code == 404
+    assert (await ds.client.get(f"/-/files/{bad}.json")).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_delete_batch_content_addressed_releases_unreferenced_blobs(
+    upload_dir,
+):
+    from conftest import _make_datasette
+
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True, "files-delete": True},
+        extra_sources={
+            "test-uploads": {
+                "storage": "filesystem",
+                "config": {"root": upload_dir, "content_addressed": True},
+            }
+        },
+    )
+    same = [await _upload_file(ds, content=b"shared") for _ in range(3)]
+    other = await _upload_file(ds, content=b"other")
+    blobs = os.path.join(upload_dir, ".datasette-files", "blobs")
+
+    def blob_exists(data):
+        hexdigest = data["file"]["content_hash"].split(":")[1]
+        return os.path.exists(
+            os.path.join(blobs, hexdigest[:2], hexdigest[2:4], hexdigest)
+        )
+
+    await _delete_batch(ds, [same[0]["file_id"], same[1]["file_id"], other["file_id"]])
+    assert blob_exists(same[0])
+    assert not blob_exists(other)
+    await _delete_batch(ds, [same[2]["file_id"]])
+    assert not blob_exists(same[0])
+
+
+@pytest.mark.asyncio
+async def test_delete_batch_validation(datasette_all_permissions):
+    response = await datasette_all_permissions.client.post(
+        "/-/files/-/delete-batch",
+        content=json.dumps({"file_ids": []}),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 400
@@ -0,0 +1,188 @@
+"""Tests for HTTP Range / 206 Partial Content support on downloads."""
+
+import pytest
+from conftest import _upload_file
+from datasette_files import _parse_range_header
+from datasette_files.base import Storage, StorageCapabilities
+
+CONTENT = bytes(range(256)) * 4  # 1024 bytes
+
+
+async def _upload(ds):
+    return await _upload_file(
+        ds,
+        filename="data.bin",
+        content=CONTENT,
+        content_type="application/octet-stream",
+    )
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        ("bytes=0-9", [(0, 10)]),
+        ("bytes=10-", [(10, 90)]),
+        ("bytes=-10", [(90, 10)]),
+        ("bytes=-500", [(0, 100)]),
+        ("bytes=90-500", [(90, 10)]),
+        ("bytes=0-0, 5-9", [(0, 1), (5, 5)]),
+        ("bytes=100-", []),
+        ("bytes=-0", []),
+        ("bytes=5-1", None),
+        ("bytes=abc", None),
+        ("bytes=-", None),
+        ("items=0-9", None),
+        ("bytes=" + ",".join(["0-1"] * 17), None),
+    ],
+)
+def test_parse_range_header(header, expected):
+    assert _parse_range_header(header, 100) == expected
+
+
+@pytest.mark.asyncio
+async def test_download_advertises_accept_ranges(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload(ds)
+    response = await ds.client.get(f"/-/files/{data['file_id']}/download")
+    assert response.status_code == 200
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"] == '"{}"'.format(data["file"]["content_hash"])
+    assert response.content == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_download_single_range(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload(ds)
+    response = await ds.client.get(
+        f"/-/files/{data['file_id']}/download", headers={"Range": "bytes=100-199"}
+    )
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 100-199/1024"
+    assert response.headers["content-length"] == "100"
+    assert "attachment" in response.headers["content-disposition"]
+    assert response.content == CONTENT[100:200]
+
+
+@pytest.mark.asyncio
+async def test_download_suffix_range(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload(ds)
+    response = await ds.client.get(
+        f"/-/files/{data['file_id']}/download", headers={"Range": "bytes=-24"}
+    )
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 1000-1023/1024"
+    assert response.content == CONTENT[-24:]
+
+
+@pytest.mark.asyncio
+async def test_download_multiple_ranges(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload(ds)
+    response = await ds.client.get(
+        f"/-/files/{data['file_id']}/download",
+        headers={"Range": "bytes=0-3, 1020-"},
+    )
+    assert response.status_code == 206
+    content_type = response.headers["content-type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("boundary=")[1]
+    assert int(response.headers["content-length"]) == len(response.content)
+    assert (
+        response.content
+        == (
+            f"--{boundary}\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            "Content-Range: bytes 0-3/1024\r\n\r\n"
+        ).encode()
+        + CONTENT[:4]
+        + (
+            f"\r\n--{boundary}\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            "Content-Range: bytes 1020-1023/1024\r\n\r\n"
+        ).encode()
+        + CONTENT[1020:]
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+
+
+@pytest.mark.asyncio
+async def test_download_unsatisfiable_range(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload(ds)
+    response = await ds.client.get(
+        f"/-/files/{data['file_id']}/download", headers={"Range": "bytes=5000-"}
+    )
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */1024"
+
+
+@pytest.mark.asyncio
+async def test_download_malformed_range_sends_full_file(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload(ds)
+    response = await ds.client.get(
+        f"/-/files/{data['file_id']}/download", headers={"Range": "bytes=9-1"}
+    )
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_download_if_range(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload(ds)
+    url = f"/-/files/{data['file_id']}/download"
+    etag = (await ds.client.get(url)).headers["etag"]
+
+    matching = await ds.client.get(
+        url, headers={"Range": "bytes=0-9", "If-Range": etag}
+    )
+    assert matching.status_code == 206
+    assert matching.content == CONTENT[:10]
+
+    for stale in ('"sha256:stale"', "Wed, 21 Oct 2015 07:28:00 GMT"):
+        response = await ds.client.get(
+            url, headers={"Range": "bytes=0-9", "If-Range": stale}
+        )
+        assert response.status_code == 200
+        assert response.content == CONTENT
+
+
+class _ChunkedStorage(Storage):
+    storage_type = "chunked"
+    capabilities = StorageCapabilities()
+
+    async def configure(self, config, get_secret):
+        pass
+
+    async def get_file_metadata(self, path):
+        return None
+
+    async def read_file(self, path):
+        return CONTENT
+
+    async def stream_file(self, path):
+        for i in range(0, len(CONTENT), 100):
+            yield CONTENT[i : i + 100]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("offset,length", [(0, 10), (95, 10), (150, 300), (1000, 24)])
+async def test_default_stream_file_range(offset, length):
+    storage = _ChunkedStorage()
+    chunks = [c async for c in storage.stream_file_range("x", offset, length)]
+    assert b"".join(chunks) == CONTENT[offset : offset + length]
+
+
+@pytest.mark.asyncio
+async def test_filesystem_stream_file_range_seeks(tmp_path):
+    from datasette_files.filesystem import FilesystemStorage
+
+    storage = FilesystemStorage()
+    await storage.configure({"root": str(tmp_path)}, get_secret=None)
+    big = b"a" * 100_000 + b"TARGET" + b"b" * 100_000
+    (tmp_path / "big.bin").write_bytes(big)
+    chunks = [c async for c in storage.stream_file_range("big.bin", 100_000, 6)]
+    assert chunks == [b"TARGET"]
@@ -0,0 +1,115 @@
+"""Tests for zero-copy downloads via the ASGI pathsend/zerocopysend extensions."""
+
+import os
+
+import pytest
+from conftest import _upload_file
+from datasette_files import _StreamingFileResponse
+from datasette_files.filesystem import FilesystemStorage
+
+CONTENT = b"0123456789" * 10
+
+
+async def _call_download(ds, file_id, extensions, headers=()):
+    """Call the download view through Datasette's ASGI app with a custom scope."""
+    await ds.invoke_startup()
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    path = f"/-/files/{file_id}/download"
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "headers": [(b"host", b"localhost")]
+        + [(k.encode(), v.encode()) for k, v in headers],
+        "extensions": extensions,
+    }
+    await ds.app()(scope, receive, send)
+    return messages
+
+
+@pytest.mark.asyncio
+async def test_pathsend_used_when_supported(datasette_browse_allowed, upload_dir):
+    ds = datasette_browse_allowed
+    data = await _upload_file(ds, filename="data.txt", content=CONTENT)
+    messages = await _call_download(ds, data["file_id"], {"http.response.pathsend": {}})
+    start, body = messages
+    assert start["type"] == "http.response.start"
+    assert start["status"] == 200
+    assert body["type"] == "http.response.pathsend"
+    assert os.path.isabs(body["path"])
+    assert body["path"].startswith(os.path.realpath(upload_dir))
+    with open(body["path"], "rb") as fp:
+        assert fp.read() == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_zerocopysend_used_for_ranges(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload_file(ds, filename="data.txt", content=CONTENT)
+    messages = await _call_download(
+        ds,
+        data["file_id"],
+        {"http.response.pathsend": {}, "http.response.zerocopysend": {}},
+        headers=[("range", "bytes=10-19")],
+    )
+    start, body = messages
+    assert start["status"] == 206
+    assert body["type"] == "http.response.zerocopysend"
+    assert (body["offset"], body["count"]) == (10, 10)
+    assert body["file"].closed
+
+
+@pytest.mark.asyncio
+async def test_falls_back_to_chunks_without_extensions(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload_file(ds, filename="data.txt", content=CONTENT)
+    messages = await _call_download(ds, data["file_id"], {})
+    assert messages[0]["status"] == 200
+    assert {m["type"] for m in messages[1:]} == {"http.response.body"}
+    assert b"".join(m["body"] for m in messages[1:]) == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_multipart_ranges_are_not_zero_copy(tmp_path):
+    storage = FilesystemStorage()
+    await storage.configure({"root": str(tmp_path)}, get_secret=None)
+    (tmp_path / "data.txt").write_bytes(CONTENT)
+    response = _StreamingFileResponse(
+        storage,
+        "data.txt",
+        "text/plain",
+        "data.txt",
+        size=len(CONTENT),
+        ranges=[(0, 1), (5, 1)],
+        extensions={"http.response.zerocopysend": {}},
+    )
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    await response.asgi_send(send)
+    assert {m["type"] for m in messages[1:]} == {"http.response.body"}
+
+
+@pytest.mark.asyncio
+async def test_filesystem_local_path(tmp_path):
+    storage = FilesystemStorage()
+    await storage.configure({"root": str(tmp_path)}, get_secret=None)
+    (tmp_path / "a.txt").write_bytes(b"a")
+    assert await storage.local_path("a.txt") == str(tmp_path.resolve() / "a.txt")
+    with pytest.raises(FileNotFoundError):
+        await storage.local_path("missing.txt")
+    with pytest.raises(ValueError, match="outside"):
+        await storage.local_path("../a.txt")
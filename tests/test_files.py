@@ -267,6 +267,31 @@ async def test_startup_creates_fts_triggers(datasette_with_files):
     assert "datasette_files_ad" in trigger_names
     assert "datasette_files_au" in trigger_names
 
+    # Updates that don't touch indexed columns, like a sync recording an
+    # etag, leave the index alone
+    await db.execute_write(
+        "INSERT INTO datasette_files (id, source_id, path, filename) VALUES ('df-x', 1, 'x.txt', 'x.txt')"
+    )
+    fts_changes = []
+    await db.execute_write_fn(
+        lambda conn: conn.set_trace_callback(
+            lambda sql: (
+                fts_changes.append(sql) if "datasette_files_fts" in sql else None
+            )
+        )
+    )
+    try:
+        await db.execute_write(
+            "UPDATE datasette_files SET sync_etag = 'e' WHERE id = 'df-x'"
+        )
+        assert fts_changes == []
+        await db.execute_write(
+            "UPDATE datasette_files SET filename = 'y.txt' WHERE id = 'df-x'"
+        )
+        assert fts_changes
+    finally:
+        await db.execute_write_fn(lambda conn: conn.set_trace_callback(None))
+
 
 # --- Actions registration ---
 
@@ -0,0 +1,456 @@
+"""Tests for FilesystemStorage I/O behaviour."""
+
+import asyncio
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+import datasette_files
+from datasette_files import filesystem
+from datasette_files.filesystem import DEFAULT_IO_THREADS, FilesystemStorage
+
+
+async def _make_storage(tmp_path, **config):
+    storage = FilesystemStorage()
+    await storage.configure({"root": str(tmp_path / "uploads"), **config}, None)
+    return storage
+
+
+async def _chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_io_threads_configurable(tmp_path):
+    default = await _make_storage(tmp_path)
+    assert default._executor._max_workers == DEFAULT_IO_THREADS
+
+    configured = await _make_storage(tmp_path, io_threads=2)
+    assert configured._executor._max_workers == 2
+
+
+@pytest.mark.asyncio
+async def test_io_threads_must_be_positive(tmp_path):
+    with pytest.raises(ValueError, match="io_threads"):
+        await _make_storage(tmp_path, io_threads=0)
+
+
+@pytest.mark.asyncio
+async def test_restart_closes_previous_io_threads(tmp_path):
+    from datasette.app import Datasette
+
+    config = {
+        "plugins": {
+            "datasette-files": {
+                "sources": {
+                    "files": {
+                        "storage": "filesystem",
+                        "config": {"root": str(tmp_path / "uploads")},
+                    }
+                }
+            }
+        }
+    }
+    await Datasette(memory=True, config=config).invoke_startup()
+    first = datasette_files._sources["files"]
+    await first.receive_upload("a.txt", _chunks(b"data"), "text/plain")
+    await Datasette(memory=True, config=config).invoke_startup()
+    assert datasette_files._sources["files"] is not first
+    assert first._executor._shutdown
+    assert await datasette_files._sources["files"].read_file("a.txt") == b"data"
+
+
+@pytest.mark.asyncio
+async def test_blocking_calls_run_off_the_event_loop(tmp_path, monkeypatch):
+    storage = await _make_storage(tmp_path)
+    loop_thread = threading.current_thread().name
+    seen = []
+    original = FilesystemStorage._safe_path
+
+    def recording_safe_path(self, path):
+        seen.append(threading.current_thread().name)
+        return original(self, path)
+
+    monkeypatch.setattr(FilesystemStorage, "_safe_path", recording_safe_path)
+
+    await storage.receive_upload("a/b.txt", _chunks(b"hello ", b"world"), "text/plain")
+    assert await storage.read_file("a/b.txt") == b"hello world"
+    assert await storage.read_file_limited("a/b.txt", 100) == b"hello world"
+    assert (await storage.get_file_metadata("a/b.txt")).size == 11
+    assert [chunk async for chunk in storage.stream_file("a/b.txt")] == [b"hello world"]
+    files, _ = await storage.list_files()
+    assert [f.path for f in files] == ["a/b.txt"]
+    await storage.delete_file("a/b.txt")
+
+    assert seen
+    assert loop_thread not in seen
+    assert all(name.startswith("datasette-files-io") for name in seen)
+
+
+async def _write_tree(storage, paths):
+    for path in paths:
+        await storage.receive_upload(path, _chunks(path.encode()), "text/plain")
+
+
+async def _list_all(storage, limit, prefix=""):
+    pages = []
+    cursor = None
+    while True:
+        files, cursor = await storage.list_files(
+            prefix=prefix, cursor=cursor, limit=limit
+        )
+        pages.append([f.path for f in files])
+        if cursor is None:
+            return pages
+
+
+# In plain string order, as the catalog's path index sorts them
+TREE = [
+    "a.txt",
+    "a/1.txt",
+    "a/2.txt",
+    "a/b/deep.txt",
+    "a0.txt",
+    "b/1.txt",
+    "c/d/e/f.txt",
+    "z.txt",
+]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("limit", [1, 2, 3, 7, 100])
+async def test_list_files_cursor_pages_through_everything(tmp_path, limit):
+    storage = await _make_storage(tmp_path)
+    await _write_tree(storage, reversed(TREE))
+    pages = await _list_all(storage, limit)
+    assert [path for page in pages for path in page] == TREE
+    assert all(len(page) <= limit for page in pages)
+    assert len(pages) == max(1, -(-len(TREE) // limit))
+
+
+@pytest.mark.asyncio
+async def test_list_files_cursor_with_prefix(tmp_path):
+    storage = await _make_storage(tmp_path)
+    await _write_tree(storage, TREE)
+    pages = await _list_all(storage, 1, prefix="a")
+    assert pages == [["a/1.txt"], ["a/2.txt"], ["a/b/deep.txt"]]
+
+
+@pytest.mark.asyncio
+async def test_list_files_cursor_survives_deletion_and_insertion(tmp_path):
+    storage = await _make_storage(tmp_path)
+    await _write_tree(storage, TREE)
+    files, cursor = await storage.list_files(limit=3)
+    assert [f.path for f in files] == ["a.txt", "a/1.txt", "a/2.txt"]
+    # The cursor file disappears and new files appear on both sides of it
+    await storage.delete_file("a/2.txt")
+    await _write_tree(storage, ["a/0.txt", "a/3.txt"])
+    files, cursor = await storage.list_files(cursor=cursor, limit=2)
+    assert [f.path for f in files] == ["a/3.txt", "a/b/deep.txt"]
+
+
+@pytest.mark.asyncio
+async def test_list_files_reports_size(tmp_path):
+    storage = await _make_storage(tmp_path)
+    await _write_tree(storage, ["x/data.txt"])
+    files, cursor = await storage.list_files()
+    assert cursor is None
+    assert files[0].filename == "data.txt"
+    assert files[0].size == len(b"x/data.txt")
+
+
+@pytest.mark.asyncio
+async def test_list_files_invalid_cursor(tmp_path):
+    storage = await _make_storage(tmp_path)
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        await storage.list_files(cursor="!!!")
+
+
+@pytest.mark.asyncio
+async def test_content_addressed_stores_duplicates_once(tmp_path):
+    storage = await _make_storage(tmp_path, content_addressed=True)
+    assert storage.capabilities.content_addressed is True
+    first = await storage.receive_upload("1/a.txt", _chunks(b"dup", b"e"), "text/plain")
+    second = await storage.receive_upload("2/b.txt", _chunks(b"dupe"), "text/plain")
+    other = await storage.receive_upload("3/c.txt", _chunks(b"other"), "text/plain")
+    assert first.content_hash == second.content_hash != other.content_hash
+
+    root = tmp_path / "uploads"
+    a, b, c = (
+        (root / "1/a.txt").stat(),
+        (root / "2/b.txt").stat(),
+        (root / "3/c.txt").stat(),
+    )
+    assert a.st_ino == b.st_ino != c.st_ino
+    # Two catalog paths plus the blob itself
+    assert a.st_nlink == 3
+    assert await storage.read_file("2/b.txt") == b"dupe"
+    # Blob storage and temp files are never listed
+    files, _ = await storage.list_files()
+    assert [f.path for f in files] == ["1/a.txt", "2/b.txt", "3/c.txt"]
+    assert not list((root / ".datasette-files" / "tmp").iterdir())
+
+
+@pytest.mark.asyncio
+async def test_content_addressed_release_content(tmp_path):
+    storage = await _make_storage(tmp_path, content_addressed=True)
+    meta = await storage.receive_upload("1/a.txt", _chunks(b"data"), "text/plain")
+    await storage.delete_file("1/a.txt")
+    hexdigest = meta.content_hash.split(":")[1]
+    blob = storage._blob_path(hexdigest)
+    assert blob.exists()
+    await storage.release_content(meta.content_hash)
+    assert not blob.exists()
+    # Releasing twice, or releasing a malformed hash, is harmless
+    await storage.release_content(meta.content_hash)
+    await storage.release_content("sha256:../../../etc")
+
+
+@pytest.mark.asyncio
+async def test_release_content_keeps_blob_still_linked(tmp_path):
+    storage = await _make_storage(tmp_path, content_addressed=True)
+    meta = await storage.receive_upload("1/a.txt", _chunks(b"data"), "text/plain")
+    blob = storage._blob_path(meta.content_hash.split(":")[1])
+    # e.g. an abandoned upload of the same content, not in the catalog
+    await storage.release_content(meta.content_hash)
+    assert blob.exists()
+    await storage.delete_file("1/a.txt")
+    await storage.release_unused_content()
+    assert not blob.exists()
+
+
+@pytest.mark.asyncio
+async def test_content_addressed_upload_survives_blob_release(tmp_path, monkeypatch):
+    storage = await _make_storage(tmp_path, content_addressed=True)
+    meta = await storage.receive_upload("1/a.txt", _chunks(b"data"), "text/plain")
+    blob = storage._blob_path(meta.content_hash.split(":")[1])
+    real_link = os.link
+    released = []
+
+    def link(src, dst):
+        # Release the existing blob just after the new upload finds it
+        if Path(dst) == blob and not released:
+            released.append(True)
+            os.unlink(tmp_path / "uploads" / "1/a.txt")
+            os.unlink(blob)
+            raise FileExistsError(errno.EEXIST, "exists", str(dst))
+        return real_link(src, dst)
+
+    monkeypatch.setattr(filesystem.os, "link", link)
+    await storage.receive_upload("2/b.txt", _chunks(b"data"), "text/plain")
+    assert released
+    assert await storage.read_file("2/b.txt") == b"data"
+    assert blob.exists()
+    assert blob.stat().st_ino == (tmp_path / "uploads" / "2/b.txt").stat().st_ino
+
+
+@pytest.mark.asyncio
+async def test_content_addressed_failed_upload_leaves_no_temp_file(tmp_path):
+    storage = await _make_storage(tmp_path, content_addressed=True)
+
+    async def failing():
+        yield b"partial"
+        raise ConnectionError("client went away")
+
+    with pytest.raises(ConnectionError):
+        await storage.receive_upload("1/a.txt", failing(), "text/plain")
+    root = tmp_path / "uploads"
+    assert not (root / "1/a.txt").exists()
+    assert not list((root / ".datasette-files" / "tmp").iterdir())
+
+
+@pytest.mark.asyncio
+async def test_release_content_is_noop_without_content_addressing(tmp_path):
+    storage = await _make_storage(tmp_path)
+    meta = await storage.receive_upload("1/a.txt", _chunks(b"data"), "text/plain")
+    await storage.release_content(meta.content_hash)
+    assert await storage.read_file("1/a.txt") == b"data"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content_addressed", [False, True])
+async def test_receive_file_renames_path_into_place(tmp_path, content_addressed):
+    storage = await _make_storage(tmp_path, content_addressed=content_addressed)
+    source = tmp_path / "uploads" / "staged.part"
+    source.write_bytes(b"staged bytes")
+    inode = source.stat().st_ino
+
+    meta = await storage.receive_file("1/a.bin", str(source), "text/plain")
+    assert meta.content_hash == "sha256:" + hashlib.sha256(b"staged bytes").hexdigest()
+    assert meta.size == len(b"staged bytes")
+    target = tmp_path / "uploads" / "1" / "a.bin"
+    assert target.read_bytes() == b"staged bytes"
+    # Moved, not copied
+    assert not source.exists()
+    assert target.stat().st_ino == inode
+    assert not list((tmp_path / "uploads" / ".datasette-files" / "tmp").iterdir())
+
+
+@pytest.mark.asyncio
+async def test_receive_file_trusts_a_given_content_hash(tmp_path, monkeypatch):
+    storage = await _make_storage(tmp_path)
+    source = tmp_path / "staged.part"
+    source.write_bytes(b"data")
+    known = "sha256:" + hashlib.sha256(b"data").hexdigest()
+    hashed = []
+    monkeypatch.setattr(filesystem, "_sha256_of", hashed.append)
+    meta = await storage.receive_file("1/a.bin", str(source), "", known)
+    assert meta.content_hash == known
+    assert hashed == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("copy_file_range", [True, False])
+async def test_receive_file_clones_open_file(tmp_path, monkeypatch, copy_file_range):
+    if not copy_file_range:
+        monkeypatch.delattr(filesystem.os, "copy_file_range", raising=False)
+    storage = await _make_storage(tmp_path)
+    content = os.urandom(300_000)
+    with tempfile.TemporaryFile() as source:
+        source.write(content)
+        meta = await storage.receive_file("1/a.bin", source, "")
+    assert meta.content_hash == "sha256:" + hashlib.sha256(content).hexdigest()
+    assert meta.size == len(content)
+    assert (tmp_path / "uploads" / "1" / "a.bin").read_bytes() == content
+
+
+@pytest.mark.asyncio
+async def test_receive_file_copies_when_rename_fails(tmp_path, monkeypatch):
+    storage = await _make_storage(tmp_path, content_addressed=True)
+    source = tmp_path / "staged.part"
+    source.write_bytes(b"elsewhere")
+
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(filesystem.os, "rename", cross_device)
+    first = await storage.receive_file("1/a.bin", str(source), "")
+    second = await storage.receive_upload("2/b.bin", _chunks(b"elsewhere"), "")
+    assert first.content_hash == second.content_hash
+    root = tmp_path / "uploads"
+    assert (root / "1/a.bin").stat().st_ino == (root / "2/b.bin").stat().st_ino
+    assert (root / "1/a.bin").read_bytes() == b"elsewhere"
+
+
+@pytest.mark.asyncio
+async def test_receive_file_links_content_already_stored(tmp_path, monkeypatch):
+    storage = await _make_storage(tmp_path, content_addressed=True)
+    first = await storage.receive_upload("1/a.bin", _chunks(b"duplicate"), "")
+    copies = []
+    monkeypatch.setattr(filesystem, "_clone_file", lambda *args: copies.append(args))
+    monkeypatch.setattr(filesystem, "_try_rename", lambda *args: copies.append(args))
+
+    staged = tmp_path / "staged.part"
+    staged.write_bytes(b"duplicate")
+    second = await storage.receive_file("2/b.bin", str(staged), "", first.content_hash)
+    with tempfile.TemporaryFile() as spooled:
+        spooled.write(b"duplicate")
+        third = await storage.receive_file("3/c.bin", spooled, "")
+    assert copies == []
+    assert (second.size, third.size) == (9, 9)
+    assert first.content_hash == second.content_hash == third.content_hash
+    root = tmp_path / "uploads"
+    inodes = {(root / path).stat().st_ino for path in ("1/a.bin", "2/b.bin", "3/c.bin")}
+    assert len(inodes) == 1
+    assert (root / "3/c.bin").read_bytes() == b"duplicate"
+    assert not list((root / ".datasette-files" / "tmp").iterdir())
+
+
+@pytest.mark.asyncio
+async def test_upload_is_invisible_until_complete(tmp_path):
+    storage = await _make_storage(tmp_path)
+    target = tmp_path / "uploads" / "1" / "a.txt"
+    seen = []
+
+    async def stream():
+        yield b"first"
+        seen.append(target.exists())
+        yield b"second"
+
+    await storage.receive_upload("1/a.txt", stream(), "text/plain")
+    assert seen == [False]
+    assert target.read_bytes() == b"firstsecond"
+
+
+@pytest.mark.asyncio
+async def test_durability_must_be_known(tmp_path):
+    with pytest.raises(ValueError, match="durability must be one of"):
+        await _make_storage(tmp_path, durability="sometimes")
+
+
+def _record_fsyncs(monkeypatch):
+    synced = []
+    monkeypatch.setattr(filesystem, "_fsync_path", synced.append)
+    return synced
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "durability,expected",
+    [
+        ("none", []),
+        ("fsync-file", ["temp"]),
+        ("fsync-file-and-dir", ["temp", "uploads", "1"]),
+        ("group-commit", ["temp", "uploads", "1"]),
+    ],
+)
+async def test_durability_modes(tmp_path, monkeypatch, durability, expected):
+    storage = await _make_storage(tmp_path, durability=durability)
+    synced = _record_fsyncs(monkeypatch)
+    await storage.receive_upload("1/a.txt", _chunks(b"data"), "text/plain")
+    temp_dir = str(tmp_path / "uploads" / ".datasette-files" / "tmp")
+    names = [
+        "temp" if os.path.dirname(str(path)) == temp_dir else os.path.basename(path)
+        for path in synced
+    ]
+    assert names == expected
+    assert await storage.read_file("1/a.txt") == b"data"
+
+
+@pytest.mark.asyncio
+async def test_group_commit_batches_concurrent_writes(tmp_path, monkeypatch):
+    storage = await _make_storage(tmp_path, durability="group-commit")
+    batches = []
+    monkeypatch.setattr(filesystem, "_fsync_paths", lambda paths: batches.append(paths))
+    await asyncio.gather(
+        *(
+            storage.receive_upload(f"shared/{i}.txt", _chunks(b"x"), "text/plain")
+            for i in range(5)
+        )
+    )
+    # Writers landing in the same window share a sync. How they split
+    # between windows depends on scheduling, so only check that some did,
+    # and that everything needing a sync got one.
+    assert len(batches) < 10
+    temp_dir = tmp_path / "uploads" / ".datasette-files" / "tmp"
+    synced = [Path(path) for batch in batches for path in batch]
+    assert len([path for path in synced if path.parent == temp_dir]) == 5
+    assert {path for path in synced if path.parent != temp_dir} == {
+        tmp_path / "uploads",
+        tmp_path / "uploads" / "shared",
+    }
+
+
+@pytest.mark.asyncio
+async def test_group_commit_failure_reaches_every_writer(tmp_path, monkeypatch):
+    storage = await _make_storage(tmp_path, durability="group-commit")
+
+    def failing(paths):
+        raise OSError(errno.EIO, "I/O error")
+
+    monkeypatch.setattr(filesystem, "_fsync_paths", failing)
+    results = await asyncio.gather(
+        *(
+            storage.receive_upload(f"{i}/a.txt", _chunks(b"x"), "text/plain")
+            for i in range(3)
+        ),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, OSError) for result in results)
+    assert not (tmp_path / "uploads" / "0" / "a.txt").exists()
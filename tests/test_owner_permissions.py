@@ -279,3 +279,24 @@ async def test_anonymous_upload_no_owner(upload_dir):
         cookies=cookies,
     )
     assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_owner_delete_batch(upload_dir):
+    """Batch deletes apply owner permissions file by file."""
+    ds = _make_owner_datasette(upload_dir, owners_can_delete=True)
+    alices = await _upload_as(ds, "alice")
+    bobs = await _upload_as(ds, "bob")
+
+    response = await ds.client.post(
+        "/-/files/-/delete-batch",
+        content=json.dumps({"file_ids": [alices, bobs]}),
+        headers={"Content-Type": "application/json"},
+        cookies={"ds_actor": ds.sign({"a": {"id": "alice"}}, "actor")},
+    )
+    assert response.status_code == 200
+    assert response.json()["files"] == [
+        {"id": alices, "ok": True},
+        {"id": bobs, "ok": False, "error": "Permission denied"},
+    ]
+    assert (await ds.client.get(f"/-/files/{bobs}.json")).status_code == 200
@@ -0,0 +1,146 @@
+"""Tests for finding drift between a source's storage and its catalog."""
+
+import os
+
+import pytest
+
+import datasette_files
+from conftest import _make_datasette, _upload_file
+
+PERMISSIONS = {"files-browse": True, "files-upload": True}
+
+
+def _write(upload_dir, path, content=b"data"):
+    full = os.path.join(upload_dir, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, "wb") as f:
+        f.write(content)
+
+
+async def _drift(ds, **kwargs):
+    return [
+        drift
+        async for drift in datasette_files.reconcile_source(
+            ds, "test-uploads", **kwargs
+        )
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("token_store", ["memory", "database"])
+async def test_reconcile_reports_orphans_and_missing_files(upload_dir, token_store):
+    ds = _make_datasette(
+        upload_dir,
+        permissions=PERMISSIONS,
+        plugin_options={"upload_token_store": token_store},
+    )
+    kept = await _upload_file(ds, content=b"kept")
+    gone = await _upload_file(ds, content=b"gone")
+    gone_path = gone["file"]["id"][3:] + "/test.txt"
+    os.unlink(os.path.join(upload_dir, gone_path))
+    _write(upload_dir, "stray/left-behind.txt", b"orphan")
+
+    # Bytes received, upload not completed yet
+    prepare = await ds.client.post(
+        "/-/files/upload/test-uploads/-/prepare",
+        json={"filename": "pending.txt", "size": 7},
+    )
+    prep = prepare.json()
+    await ds.client.put(
+        f"{prep['upload_url']}?token={prep['upload_token']}", content=b"pending"
+    )
+
+    drift = await _drift(ds)
+    assert sorted((d.kind, d.path) for d in drift) == [
+        ("missing", gone_path),
+        ("orphan", "stray/left-behind.txt"),
+    ]
+    missing = next(d for d in drift if d.kind == "missing")
+    assert missing.file_id == gone["file_id"]
+    assert not any(d.reclaimed for d in drift)
+    assert os.path.exists(os.path.join(upload_dir, "stray", "left-behind.txt"))
+
+    drift = await _drift(ds, reclaim=True)
+    assert [d.path for d in drift if d.reclaimed] == ["stray/left-behind.txt"]
+    assert not os.path.exists(os.path.join(upload_dir, "stray", "left-behind.txt"))
+    # The catalog is left alone, and so are the pending upload and kept file
+    assert [(d.kind, d.path) for d in await _drift(ds)] == [("missing", gone_path)]
+    download = await ds.client.get(kept["file"]["download_url"])
+    assert download.content == b"kept"
+    complete = await ds.client.post(
+        "/-/files/upload/test-uploads/-/complete",
+        json={"upload_token": prep["upload_token"]},
+    )
+    assert complete.status_code == 201
+
+
+@pytest.mark.asyncio
+async def test_reclaim_frees_blob_of_abandoned_upload(upload_dir):
+    ds = _make_datasette(
+        upload_dir,
+        permissions=PERMISSIONS,
+        extra_sources={
+            "test-uploads": {
+                "storage": "filesystem",
+                "config": {"root": upload_dir, "content_addressed": True},
+            }
+        },
+    )
+    kept = await _upload_file(ds, content=b"kept")
+    prepare = await ds.client.post(
+        "/-/files/upload/test-uploads/-/prepare",
+        json={"filename": "abandoned.txt", "size": 9},
+    )
+    prep = prepare.json()
+    await ds.client.put(
+        f"{prep['upload_url']}?token={prep['upload_token']}", content=b"abandoned"
+    )
+    tokens = datasette_files._token_store(ds)
+    (await tokens.get(prep["upload_token"])).created_at -= tokens.ttl + 1
+    await datasette_files._clean_expired_tokens(ds)
+    blobs = os.path.join(upload_dir, ".datasette-files", "blobs")
+
+    def blob_count():
+        return sum(len(files) for _, _, files in os.walk(blobs))
+
+    assert blob_count() == 2
+
+    drift = await _drift(ds, reclaim=True)
+    assert [(d.kind, d.reclaimed) for d in drift] == [("orphan", True)]
+    assert blob_count() == 1
+    download = await ds.client.get(kept["file"]["download_url"])
+    assert download.content == b"kept"
+
+
+@pytest.mark.asyncio
+async def test_reconcile_merges_across_pages(datasette_all_permissions, upload_dir):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    # Paths chosen so that component order and string order differ
+    paths = ["a.txt", "a/1.txt", "a/b/2.txt", "a0.txt", "b.txt", "c/3.txt"]
+    for path in paths:
+        _write(upload_dir, path)
+    await datasette_files.sync_source(ds, "test-uploads")
+    assert await _drift(ds, page_size=2) == []
+
+    os.unlink(os.path.join(upload_dir, "a/1.txt"))
+    os.unlink(os.path.join(upload_dir, "c/3.txt"))
+    for path in ("a/0.txt", "a00.txt", "z.txt"):
+        _write(upload_dir, path)
+    drift = await _drift(ds, page_size=2)
+    assert sorted((d.kind, d.path) for d in drift) == [
+        ("missing", "a/1.txt"),
+        ("missing", "c/3.txt"),
+        ("orphan", "a/0.txt"),
+        ("orphan", "a00.txt"),
+        ("orphan", "z.txt"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_reconcile_unknown_source(datasette_all_permissions):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    with pytest.raises(datasette_files.NotFound):
+        async for _ in datasette_files.reconcile_source(ds, "nope"):
+            pass
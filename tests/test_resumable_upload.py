@@ -0,0 +1,268 @@
+"""Tests for resumable uploads via HEAD/PATCH on the upload token URL."""
+
+import hashlib
+import json
+import os
+
+import pytest
+
+import datasette_files
+
+CONTENT = b"0123456789" * 100
+PATCH_HEADERS = {"Content-Type": "application/offset+octet-stream"}
+
+
+async def _prepare(ds, size=len(CONTENT), filename="big.bin"):
+    response = await ds.client.post(
+        "/-/files/upload/test-uploads/-/prepare",
+        content=json.dumps(
+            {
+                "filename": filename,
+                "content_type": "application/octet-stream",
+                "size": size,
+            }
+        ),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+async def _patch(ds, url, offset, body):
+    return await ds.client.patch(
+        url,
+        content=body,
+        headers={**PATCH_HEADERS, "Upload-Offset": str(offset)},
+    )
+
+
+async def _complete(ds, token):
+    return await ds.client.post(
+        "/-/files/upload/test-uploads/-/complete",
+        content=json.dumps({"upload_token": token}),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+async def _patch_then_disconnect(ds, url, offset, body):
+    """Send part of a PATCH body, then drop the connection."""
+    await ds.invoke_startup()
+    messages = [
+        {"type": "http.request", "body": body, "more_body": True},
+        {"type": "http.disconnect"},
+    ]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        pass
+
+    headers = {**PATCH_HEADERS, "Upload-Offset": str(offset), "Host": "localhost"}
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "PATCH",
+        "scheme": "http",
+        "path": url,
+        "raw_path": url.encode(),
+        "query_string": b"",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+    }
+    await ds.app()(scope, receive, send)
+
+
+@pytest.mark.asyncio
+async def test_prepare_returns_resumable_url(datasette_all_permissions):
+    data = await _prepare(datasette_all_permissions)
+    assert data["resumable_url"] == (
+        f"/-/files/upload/test-uploads/-/upload/{data['upload_token']}"
+    )
+
+
+@pytest.mark.asyncio
+async def test_prepare_without_size_is_not_resumable(datasette_all_permissions):
+    response = await datasette_all_permissions.client.post(
+        "/-/files/upload/test-uploads/-/prepare",
+        content=json.dumps({"filename": "a.txt"}),
+        headers={"Content-Type": "application/json"},
+    )
+    assert "resumable_url" not in response.json()
+
+
+@pytest.mark.asyncio
+async def test_resumable_upload_in_chunks(datasette_all_permissions, upload_dir):
+    ds = datasette_all_permissions
+    data = await _prepare(ds)
+    url = data["resumable_url"]
+
+    head = await ds.client.head(url)
+    assert head.status_code == 200
+    assert head.headers["upload-offset"] == "0"
+    assert head.headers["upload-length"] == str(len(CONTENT))
+
+    for offset in range(0, len(CONTENT), 300):
+        response = await _patch(ds, url, offset, CONTENT[offset : offset + 300])
+        assert response.status_code == 204, response.text
+        assert response.headers["upload-offset"] == str(min(offset + 300, len(CONTENT)))
+
+    complete = await _complete(ds, data["upload_token"])
+    assert complete.status_code == 201, complete.text
+    file = complete.json()["file"]
+    assert file["size"] == len(CONTENT)
+    download = await ds.client.get(file["download_url"])
+    assert download.content == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_resume_after_dropped_connection(datasette_all_permissions):
+    ds = datasette_all_permissions
+    data = await _prepare(ds)
+    url = data["resumable_url"]
+
+    await _patch_then_disconnect(ds, url, 0, CONTENT[:400])
+    head = await ds.client.head(url)
+    assert head.headers["upload-offset"] == "400"
+
+    # Complete is refused until every byte has arrived
+    assert (await _complete(ds, data["upload_token"])).status_code == 400
+
+    response = await _patch(ds, url, 400, CONTENT[400:])
+    assert response.status_code == 204
+    complete = await _complete(ds, data["upload_token"])
+    assert complete.status_code == 201
+    download = await ds.client.get(complete.json()["file"]["download_url"])
+    assert download.content == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_offset_mismatch_returns_409(datasette_all_permissions):
+    ds = datasette_all_permissions
+    data = await _prepare(ds)
+    url = data["resumable_url"]
+    await _patch(ds, url, 0, CONTENT[:100])
+    response = await _patch(ds, url, 0, CONTENT[:100])
+    assert response.status_code == 409
+    assert response.headers["upload-offset"] == "100"
+
+
+@pytest.mark.asyncio
+async def test_patch_beyond_declared_size_is_rejected(datasette_all_permissions):
+    ds = datasette_all_permissions
+    data = await _prepare(ds, size=10)
+    response = await _patch(ds, data["resumable_url"], 0, b"x" * 11)
+    assert response.status_code == 413
+    head = await ds.client.head(data["resumable_url"])
+    assert head.headers["upload-offset"] == "0"
+
+
+@pytest.mark.asyncio
+async def test_patch_requires_offset_content_type(datasette_all_permissions):
+    ds = datasette_all_permissions
+    data = await _prepare(ds)
+    response = await ds.client.patch(
+        data["resumable_url"],
+        content=CONTENT,
+        headers={"Content-Type": "application/octet-stream", "Upload-Offset": "0"},
+    )
+    assert response.status_code == 415
+
+
+@pytest.mark.asyncio
+async def test_unknown_token_returns_404(datasette_all_permissions):
+    response = await datasette_all_permissions.client.head(
+        "/-/files/upload/test-uploads/-/upload/tok_nope"
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_staging_file_removed_once_complete(datasette_all_permissions):
+    ds = datasette_all_permissions
+    data = await _prepare(ds)
+    url = data["resumable_url"]
+    await _patch(ds, url, 0, CONTENT[:10])
+    token_data = await datasette_files._token_store(ds).get(data["upload_token"])
+    staging_path = token_data.staging_path
+    assert os.path.exists(staging_path)
+    await _patch(ds, url, 10, CONTENT[10:])
+    assert not os.path.exists(staging_path)
+
+
+@pytest.mark.asyncio
+async def test_patch_without_staging_file_returns_409(datasette_all_permissions):
+    ds = datasette_all_permissions
+    data = await _prepare(ds)
+    url = data["resumable_url"]
+    await _patch(ds, url, 0, CONTENT[:10])
+    token_data = await datasette_files._token_store(ds).get(data["upload_token"])
+    # As if this PATCH reached a different machine from the first
+    os.unlink(token_data.staging_path)
+    response = await _patch(ds, url, 10, CONTENT[10:])
+    assert response.status_code == 409
+    assert response.json()["errors"] == [
+        "The content received so far for this upload is not on this server: "
+        "send it again from the start"
+    ]
+    assert response.headers["upload-offset"] == "0"
+    # The client starts again from where HEAD says
+    head = await ds.client.head(url)
+    assert head.headers["upload-offset"] == "0"
+    assert (await _patch(ds, url, 0, CONTENT)).status_code == 204
+    complete = await _complete(ds, data["upload_token"])
+    assert complete.status_code == 201
+    download = await ds.client.get(f"/-/files/{complete.json()['file']['id']}/download")
+    assert download.content == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_staged_next_to_the_stored_files(datasette_all_permissions, upload_dir):
+    ds = datasette_all_permissions
+    data = await _prepare(ds)
+    await _patch(ds, data["resumable_url"], 0, CONTENT[:10])
+    token_data = await datasette_files._token_store(ds).get(data["upload_token"])
+    # Every process serving the source can find it
+    assert os.path.dirname(token_data.staging_path) == os.path.join(
+        upload_dir, ".datasette-files", "tmp"
+    )
+
+
+@pytest.mark.asyncio
+async def test_expired_token_removes_staging_file(datasette_all_permissions):
+    ds = datasette_all_permissions
+    data = await _prepare(ds)
+    await _patch(ds, data["resumable_url"], 0, CONTENT[:10])
+    tokens = datasette_files._token_store(ds)
+    token_data = await tokens.get(data["upload_token"])
+    staging_path = token_data.staging_path
+    token_data.created_at -= tokens.ttl + 1
+    await datasette_files._clean_expired_tokens(ds)
+    assert await tokens.get(data["upload_token"]) is None
+    assert not os.path.exists(staging_path)
+
+
+@pytest.mark.asyncio
+async def test_empty_file_resumable_upload(datasette_all_permissions):
+    ds = datasette_all_permissions
+    data = await _prepare(ds, size=0)
+    response = await _patch(ds, data["resumable_url"], 0, b"")
+    assert response.status_code == 204
+    complete = await _complete(ds, data["upload_token"])
+    assert complete.status_code == 201
+    assert complete.json()["file"]["size"] == 0
+
+
+@pytest.mark.asyncio
+async def test_staging_file_is_moved_into_place(datasette_all_permissions, upload_dir):
+    ds = datasette_all_permissions
+    data = await _prepare(ds)
+    url = data["resumable_url"]
+    await _patch(ds, url, 0, CONTENT[:10])
+    token_data = await datasette_files._token_store(ds).get(data["upload_token"])
+    inode = os.stat(token_data.staging_path).st_ino
+    await _patch(ds, url, 10, CONTENT[10:])
+    token_data = await datasette_files._token_store(ds).get(data["upload_token"])
+    file_meta = token_data.file_meta
+    assert file_meta.content_hash == "sha256:" + hashlib.sha256(CONTENT).hexdigest()
+    target = os.path.join(upload_dir, file_meta.path)
+    assert os.stat(target).st_ino == inode
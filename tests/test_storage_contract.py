@@ -0,0 +1,138 @@
+"""Contract tests that every storage implementation must satisfy."""
+
+import pytest
+
+from datasette_files import filesystem
+from datasette_files.base import FileMetadata, Storage, StorageCapabilities
+
+FILE_SIZE = 1024 * 1024
+CONTENT = bytes(range(256)) * (FILE_SIZE // 256)
+
+
+class _CountingFile:
+    """Wraps a file object, counting how many bytes are read from it."""
+
+    def __init__(self, fileobj, counter):
+        self._fileobj = fileobj
+        self._counter = counter
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._counter["bytes"] += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._fileobj.close()
+
+
+async def _filesystem_storage(tmp_path, monkeypatch, counter):
+    storage = filesystem.FilesystemStorage()
+    await storage.configure({"root": str(tmp_path)}, get_secret=None)
+    (tmp_path / "big.bin").write_bytes(CONTENT)
+
+    def counting_open(*args, **kwargs):
+        return _CountingFile(open(*args, **kwargs), counter)
+
+    monkeypatch.setattr(filesystem, "open", counting_open, raising=False)
+    return storage
+
+
+class _StreamOnlyStorage(Storage):
+    """A minimal backend relying on the base class defaults for reads."""
+
+    storage_type = "stream-only"
+    capabilities = StorageCapabilities()
+    chunk_size = 512
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    async def configure(self, config, get_secret):
+        pass
+
+    async def get_file_metadata(self, path):
+        return None
+
+    async def read_file(self, path):
+        self.counter["bytes"] += len(CONTENT)
+        return CONTENT
+
+    async def stream_file(self, path):
+        for i in range(0, len(CONTENT), self.chunk_size):
+            chunk = CONTENT[i : i + self.chunk_size]
+            self.counter["bytes"] += len(chunk)
+            yield chunk
+
+
+async def _stream_only_storage(tmp_path, monkeypatch, counter):
+    return _StreamOnlyStorage(counter)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("factory", [_filesystem_storage, _stream_only_storage])
+@pytest.mark.parametrize("num_bytes", [0, 512, 2048, 64 * 1024])
+async def test_read_bytes_never_reads_more_than_requested(
+    tmp_path, monkeypatch, factory, num_bytes
+):
+    counter = {"bytes": 0}
+    storage = await factory(tmp_path, monkeypatch, counter)
+    content = await storage.read_bytes("big.bin", num_bytes)
+    assert content == CONTENT[:num_bytes]
+    assert counter["bytes"] <= num_bytes
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("factory", [_filesystem_storage, _stream_only_storage])
+async def test_read_bytes_defaults_to_2048(tmp_path, monkeypatch, factory):
+    counter = {"bytes": 0}
+    storage = await factory(tmp_path, monkeypatch, counter)
+    assert await storage.read_bytes("big.bin") == CONTENT[:2048]
+    assert counter["bytes"] <= 2048
+
+
+class _ReadFileOnlyStorage(_StreamOnlyStorage):
+    """A backend with only read_file(), relying on the default stream_file()."""
+
+    stream_file = Storage.stream_file
+
+
+@pytest.mark.asyncio
+async def test_read_bytes_without_stream_file_reads_whole_file():
+    # The documented limitation of the defaults: correct, but not bounded
+    counter = {"bytes": 0}
+    storage = _ReadFileOnlyStorage(counter)
+    assert await storage.read_bytes("big.bin", 512) == CONTENT[:512]
+    assert counter["bytes"] == len(CONTENT)
+    chunks = [chunk async for chunk in storage.stream_file_range("big.bin", 10, 5)]
+    assert b"".join(chunks) == CONTENT[10:15]
+
+
+class _UploadOnlyStorage(_StreamOnlyStorage):
+    """Keeps received uploads in memory, relying on the default receive_file()."""
+
+    def __init__(self):
+        super().__init__({"bytes": 0})
+        self.received = {}
+
+    async def receive_upload(self, path, stream, content_type):
+        self.received[path] = b"".join([chunk async for chunk in stream])
+        return FileMetadata(path=path, filename=path, size=len(self.received[path]))
+
+
+@pytest.mark.asyncio
+async def test_default_receive_file_streams_through_receive_upload(tmp_path):
+    storage = _UploadOnlyStorage()
+    staged = tmp_path / "staged.part"
+    staged.write_bytes(CONTENT)
+    await storage.receive_file("from-path", str(staged), "")
+    with open(staged, "rb") as fileobj:
+        fileobj.read(10)
+        await storage.receive_file("from-fileobj", fileobj, "")
+        assert not fileobj.closed
+    assert storage.received == {"from-path": CONTENT, "from-fileobj": CONTENT}
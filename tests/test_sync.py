@@ -0,0 +1,347 @@
+"""Tests for syncing a source's catalog with the files in its storage."""
+
+import asyncio
+import json
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import datasette_files
+from conftest import _make_datasette, _upload_file
+
+
+def _write(upload_dir, path, content=b"data"):
+    full = os.path.join(upload_dir, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, "wb") as f:
+        f.write(content)
+
+
+def _jpeg(width, height):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), color="red").save(output, format="JPEG")
+    return output.getvalue()
+
+
+async def _catalog(ds):
+    db = ds.get_internal_database()
+    rows = (await db.execute("SELECT id, path, size FROM datasette_files")).rows
+    return {row["path"]: dict(row) for row in rows}
+
+
+@pytest.mark.asyncio
+async def test_sync_registers_updates_and_tombstones(
+    datasette_all_permissions, upload_dir
+):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    _write(upload_dir, "a.txt", b"aaa")
+    _write(upload_dir, "photos/b.png", b"bb")
+
+    result = await datasette_files.sync_source(ds, "test-uploads")
+    assert (result.added, result.updated, result.removed) == (2, 0, 0)
+    catalog = await _catalog(ds)
+    assert set(catalog) == {"a.txt", "photos/b.png"}
+    file_id = catalog["photos/b.png"]["id"]
+    info = (await ds.client.get(f"/-/files/{file_id}.json")).json()
+    assert info["filename"] == "b.png"
+    assert info["content_type"] == "image/png"
+    download = await ds.client.get(f"/-/files/{file_id}/download")
+    assert download.content == b"bb"
+
+    # Nothing changed: nothing is added or updated
+    result = await datasette_files.sync_source(ds, "test-uploads")
+    assert (result.added, result.updated, result.unchanged) == (0, 0, 2)
+
+    _write(upload_dir, "a.txt", b"longer")
+    os.unlink(os.path.join(upload_dir, "photos", "b.png"))
+    result = await datasette_files.sync_source(ds, "test-uploads")
+    assert (result.added, result.updated, result.removed) == (0, 1, 1)
+    catalog = await _catalog(ds)
+    assert set(catalog) == {"a.txt"}
+    assert catalog["a.txt"]["size"] == 6
+    assert (await ds.client.get(f"/-/files/{file_id}.json")).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_file_that_comes_back_keeps_its_id(datasette_all_permissions, upload_dir):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    _write(upload_dir, "doc.txt")
+    await datasette_files.sync_source(ds, "test-uploads")
+    file_id = (await _catalog(ds))["doc.txt"]["id"]
+
+    os.rename(os.path.join(upload_dir, "doc.txt"), os.path.join(upload_dir, "away"))
+    await datasette_files.sync_source(ds, "test-uploads")
+    assert "doc.txt" not in await _catalog(ds)
+
+    os.rename(os.path.join(upload_dir, "away"), os.path.join(upload_dir, "doc.txt"))
+    await datasette_files.sync_source(ds, "test-uploads")
+    assert (await _catalog(ds))["doc.txt"]["id"] == file_id
+
+
+@pytest.mark.asyncio
+async def test_uploaded_files_are_left_alone(datasette_all_permissions):
+    ds = datasette_all_permissions
+    data = await _upload_file(ds, content=b"uploaded")
+    result = await datasette_files.sync_source(ds, "test-uploads")
+    assert (result.added, result.updated, result.removed) == (0, 0, 0)
+    row = (await _catalog(ds))[data["file"]["id"][3:] + "/test.txt"]
+    assert row["id"] == data["file_id"]
+
+
+@pytest.mark.asyncio
+async def test_uploads_in_progress_are_left_to_the_upload(datasette_all_permissions):
+    ds = datasette_all_permissions
+    prep = (
+        await ds.client.post(
+            "/-/files/upload/test-uploads/-/prepare",
+            content=json.dumps({"filename": "up.txt", "size": 5}),
+            headers={"Content-Type": "application/json"},
+        )
+    ).json()
+    await ds.client.put(
+        f"{prep['upload_url']}?token={prep['upload_token']}", content=b"hello"
+    )
+    result = await datasette_files.sync_source(ds, "test-uploads")
+    assert result.added == 0
+    assert await _catalog(ds) == {}
+
+    complete = await ds.client.post(
+        "/-/files/upload/test-uploads/-/complete",
+        content=json.dumps({"upload_token": prep["upload_token"]}),
+        headers={"Content-Type": "application/json"},
+    )
+    assert complete.status_code == 201, complete.text
+    assert [row["id"] for row in (await _catalog(ds)).values()] == [
+        complete.json()["file"]["id"]
+    ]
+
+
+@pytest.mark.asyncio
+async def test_tombstoned_files_release_their_content(upload_dir):
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        extra_sources={
+            "test-uploads": {
+                "storage": "filesystem",
+                "config": {"root": upload_dir, "content_addressed": True},
+            }
+        },
+    )
+    first = await _upload_file(ds, filename="a.txt", content=b"same bytes")
+    second = await _upload_file(ds, filename="b.txt", content=b"same bytes")
+    # Uploads from the second a sync starts in are left for the next one
+    await ds.get_internal_database().execute_write(
+        "UPDATE datasette_files SET created_at = datetime('now', '-1 minute')"
+    )
+    hexdigest = first["file"]["content_hash"].split(":")[1]
+    blob = os.path.join(
+        upload_dir,
+        ".datasette-files",
+        "blobs",
+        hexdigest[:2],
+        hexdigest[2:4],
+        hexdigest,
+    )
+
+    os.unlink(os.path.join(upload_dir, first["file_id"][3:], "a.txt"))
+    result = await datasette_files.sync_source(ds, "test-uploads")
+    assert result.removed == 1
+    # Still used by the other file
+    assert os.path.exists(blob)
+
+    os.unlink(os.path.join(upload_dir, second["file_id"][3:], "b.txt"))
+    result = await datasette_files.sync_source(ds, "test-uploads")
+    assert result.removed == 1
+    assert not os.path.exists(blob)
+
+
+@pytest.mark.asyncio
+async def test_interrupted_sync_resumes(datasette_all_permissions, upload_dir):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    for i in range(5):
+        _write(upload_dir, f"f{i}.txt")
+
+    listed = []
+    storage = datasette_files._sources["test-uploads"]
+    original = storage.list_files
+
+    async def list_files(**kwargs):
+        files, cursor = await original(**kwargs)
+        listed.extend(f.path for f in files)
+        return files, cursor
+
+    storage.list_files = list_files
+    try:
+        first = await datasette_files.sync_source(
+            ds, "test-uploads", page_size=2, max_pages=2
+        )
+        assert first.complete is False
+        assert first.added == 4
+        db = ds.get_internal_database()
+        token = json.loads(
+            (
+                await db.execute(
+                    "SELECT last_sync_token FROM datasette_files_sources WHERE slug = ?",
+                    ["test-uploads"],
+                )
+            ).single_value()
+        )
+        assert token["cursor"] is not None
+
+        rest = await datasette_files.sync_source(ds, "test-uploads", page_size=2)
+        assert rest.complete is True
+        assert rest.added == 1
+    finally:
+        storage.list_files = original
+    # Each file was listed once across the two calls
+    assert sorted(listed) == [f"f{i}.txt" for i in range(5)]
+    assert len(await _catalog(ds)) == 5
+
+
+@pytest.mark.asyncio
+async def test_sync_page_is_one_transaction(datasette_all_permissions, upload_dir):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    for i in range(6):
+        _write(upload_dir, f"f{i}.txt")
+    db = ds.get_internal_database()
+    original = db.execute_write_fn
+    writes = []
+
+    async def execute_write_fn(fn, **kwargs):
+        writes.append(fn)
+        return await original(fn, **kwargs)
+
+    db.execute_write_fn = execute_write_fn
+    await datasette_files.sync_source(ds, "test-uploads", page_size=3)
+    # One write per page of three
+    assert len(writes) == 2
+
+
+@pytest.mark.asyncio
+async def test_resync_only_writes_what_changed(datasette_all_permissions, upload_dir):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    for i in range(7):
+        _write(upload_dir, f"d{i % 3}/f{i}.txt")
+    await datasette_files.sync_source(ds, "test-uploads", page_size=2)
+    db = ds.get_internal_database()
+
+    async def total_changes():
+        return await db.execute_write_fn(lambda conn: conn.total_changes)
+
+    before = await total_changes()
+    result = await datasette_files.sync_source(ds, "test-uploads", page_size=2)
+    assert (result.added, result.updated, result.removed) == (0, 0, 0)
+    assert result.unchanged == 7
+    # Only the sync token, once per page
+    assert await total_changes() - before == 4
+
+    # Files missing from the start, middle and end of the walk are found
+    for path in ("d0/f0.txt", "d1/f4.txt", "d2/f5.txt"):
+        os.unlink(os.path.join(upload_dir, path))
+    result = await datasette_files.sync_source(ds, "test-uploads", page_size=2)
+    assert result.removed == 3
+    assert sorted(await _catalog(ds)) == [
+        "d0/f3.txt",
+        "d0/f6.txt",
+        "d1/f1.txt",
+        "d2/f2.txt",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_changed_file_loses_cached_thumbnail(
+    datasette_all_permissions, upload_dir
+):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    _write(upload_dir, "a.txt", b"one")
+    await datasette_files.sync_source(ds, "test-uploads")
+    file_id = (await _catalog(ds))["a.txt"]["id"]
+    db = ds.get_internal_database()
+    await db.execute_write(
+        "INSERT INTO datasette_files_thumbnails (file_id, rendition, thumbnail) "
+        "VALUES (?, '200x200', ?)",
+        [file_id, b"png"],
+    )
+    _write(upload_dir, "a.txt", b"three")
+    await datasette_files.sync_source(ds, "test-uploads")
+    count = (
+        await db.execute(
+            "SELECT count(*) FROM datasette_files_thumbnails WHERE file_id = ?",
+            [file_id],
+        )
+    ).single_value()
+    assert count == 0
+
+
+@pytest.mark.asyncio
+async def test_changed_and_removed_files_lose_disk_thumbnails(
+    datasette_all_permissions, upload_dir
+):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    _write(upload_dir, "changed.jpg", _jpeg(400, 300))
+    _write(upload_dir, "removed.jpg", _jpeg(400, 300))
+    await datasette_files.sync_source(ds, "test-uploads")
+    catalog = await _catalog(ds)
+    state = datasette_files._thumbnail_state(ds)
+    file_dirs = []
+    for path in ("changed.jpg", "removed.jpg"):
+        file_id = catalog[path]["id"]
+        response = await ds.client.get(f"/-/files/{file_id}/thumbnail")
+        assert response.headers["content-type"] == "image/jpeg"
+        file_dirs.append(state.cache._file_dir(file_id))
+    assert all(os.path.isdir(file_dir) for file_dir in file_dirs)
+
+    _write(upload_dir, "changed.jpg", _jpeg(300, 400))
+    os.unlink(os.path.join(upload_dir, "removed.jpg"))
+    result = await datasette_files.sync_source(ds, "test-uploads")
+    assert (result.updated, result.removed) == (1, 1)
+    assert not any(os.path.exists(file_dir) for file_dir in file_dirs)
+    assert state.recent.size == 0
+
+
+@pytest.mark.asyncio
+async def test_sync_interval_runs_in_background(upload_dir):
+    _write(upload_dir, "background.txt")
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True},
+        extra_sources={
+            "test-uploads": {
+                "storage": "filesystem",
+                "config": {"root": upload_dir},
+                "sync_interval": 60,
+            }
+        },
+    )
+    await ds.invoke_startup()
+    for _ in range(100):
+        if "background.txt" in await _catalog(ds):
+            break
+        await asyncio.sleep(0.01)
+    assert "background.txt" in await _catalog(ds)
+
+
+@pytest.mark.asyncio
+async def test_sync_interval_must_be_positive(upload_dir):
+    ds = _make_datasette(
+        upload_dir,
+        extra_sources={
+            "test-uploads": {
+                "storage": "filesystem",
+                "config": {"root": upload_dir},
+                "sync_interval": 0,
+            }
+        },
+    )
+    with pytest.raises(ValueError, match="sync_interval"):
+        await ds.invoke_startup()
@@ -0,0 +1,317 @@
+"""Tests for where generated thumbnails are kept."""
+
+import io
+import os
+
+import pytest
+from datasette.app import Datasette
+from PIL import Image
+
+import datasette_files
+from datasette_files.base import ThumbnailResult
+from datasette_files.thumbnail_cache import (
+    CachedResponse,
+    DiskThumbnailCache,
+    RecentThumbnails,
+)
+from conftest import _make_datasette, _upload_file
+
+PERMISSIONS = {"files-browse": True, "files-upload": True}
+FILE_ID = "df-01hzzzzzzzzzzzzzzzzzzzzzab"
+
+
+def _result(thumb_bytes=b"jpeg", width=200):
+    return ThumbnailResult(
+        thumb_bytes=thumb_bytes, content_type="image/jpeg", width=width, height=150
+    )
+
+
+def _jpeg(width, height):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), color="red").save(output, format="JPEG")
+    return output.getvalue()
+
+
+def _files_under(directory):
+    return sorted(
+        os.path.relpath(os.path.join(root, name), directory)
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_layout(tmp_path):
+    cache = DiskThumbnailCache(str(tmp_path))
+    await cache.put(
+        FILE_ID,
+        "sha256:abc:4",
+        "key",
+        "pillow",
+        {"200x200": _result(), "64x64": _result(b"small", 64)},
+    )
+    files = _files_under(tmp_path)
+    assert len(files) == 2
+    shard, file_id, key, rendition = files[0].split(os.sep)
+    assert (shard, file_id, rendition) == ("ab", FILE_ID, "200x200")
+    assert files[1] == os.path.join(shard, file_id, key, "64x64")
+
+    assert await cache.get(FILE_ID, "sha256:abc:4", "key", "64x64") == _result(
+        b"small", 64
+    )
+    assert await cache.renditions(FILE_ID, "sha256:abc:4", "key") == {
+        "200x200",
+        "64x64",
+    }
+    assert await cache.get(FILE_ID, "sha256:abc:4", "key", "32x32") is None
+    assert await cache.get(FILE_ID, "sha256:abc:4", "other-key", "64x64") is None
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_discards_thumbnails_of_older_content(tmp_path):
+    cache = DiskThumbnailCache(str(tmp_path))
+    await cache.put(FILE_ID, "sha256:old:3", "key", "pillow", {"200x200": _result()})
+    await cache.put(
+        FILE_ID, "sha256:new:5", "key", "pillow", {"200x200": _result(b"new")}
+    )
+    assert await cache.get(FILE_ID, "sha256:old:3", "key", "200x200") is None
+    assert await cache.get(FILE_ID, "sha256:new:5", "key", "200x200") == _result(b"new")
+    assert len(_files_under(tmp_path)) == 1
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_prune(tmp_path):
+    cache = DiskThumbnailCache(str(tmp_path))
+    kept, gone = "df-kept00", "df-gone00"
+    for file_id in (kept, gone):
+        await cache.put(
+            file_id,
+            "v1",
+            "key",
+            "pillow",
+            {"200x200": _result(), "64x64": _result(width=64)},
+        )
+
+    async def versions(file_ids):
+        return {file_id: "v1" for file_id in file_ids if file_id == kept}
+
+    await cache.prune("key", ["200x200"], versions)
+    assert await cache.renditions(kept, "v1", "key") == {"200x200"}
+    assert not os.path.exists(os.path.join(tmp_path, "00", gone))
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_sits_next_to_internal_database(upload_dir, tmp_path):
+    ds = Datasette(
+        memory=True,
+        internal=str(tmp_path / "internal.db"),
+        config={
+            "permissions": PERMISSIONS,
+            "plugins": {
+                "datasette-files": {
+                    "sources": {
+                        "test-uploads": {
+                            "storage": "filesystem",
+                            "config": {"root": upload_dir},
+                        }
+                    },
+                }
+            },
+        },
+    )
+    data = await _upload_file(
+        ds, filename="photo.jpg", content=_jpeg(400, 300), content_type="image/jpeg"
+    )
+    await datasette_files._drain_eager_thumbnails()
+    files = _files_under(tmp_path / "internal-thumbnails")
+    assert [path.split(os.sep)[1] for path in files] == [data["file_id"]]
+
+
+@pytest.mark.asyncio
+async def test_thumbnails_served_without_internal_database_writes(
+    upload_dir, monkeypatch
+):
+    ds = _make_datasette(
+        upload_dir, permissions=PERMISSIONS, plugin_options={"thumbnail_eager": False}
+    )
+    data = await _upload_file(
+        ds, filename="photo.jpg", content=_jpeg(400, 300), content_type="image/jpeg"
+    )
+    db = ds.get_internal_database()
+    writes = []
+    for method in ("execute_write", "execute_write_many", "execute_write_fn"):
+        original = getattr(db, method)
+
+        async def spy(*args, _original=original, **kwargs):
+            writes.append(args)
+            return await _original(*args, **kwargs)
+
+        monkeypatch.setattr(db, method, spy)
+
+    for _ in range(2):
+        response = await ds.client.get(f"/-/files/{data['file_id']}/thumbnail")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/jpeg"
+    assert writes == []
+
+
+@pytest.mark.asyncio
+async def test_changed_file_gets_a_new_thumbnail(upload_dir):
+    ds = _make_datasette(upload_dir, permissions=PERMISSIONS)
+    await ds.invoke_startup()
+    path = os.path.join(upload_dir, "photo.jpg")
+    with open(path, "wb") as fp:
+        fp.write(_jpeg(400, 300))
+    await datasette_files.sync_source(ds, "test-uploads")
+    db = ds.get_internal_database()
+    file_id = (
+        await db.execute("SELECT id FROM datasette_files WHERE path = 'photo.jpg'")
+    ).single_value()
+    response = await ds.client.get(f"/-/files/{file_id}/thumbnail")
+    assert Image.open(io.BytesIO(response.content)).size == (200, 150)
+
+    with open(path, "wb") as fp:
+        fp.write(_jpeg(300, 400))
+    await datasette_files.sync_source(ds, "test-uploads")
+    response = await ds.client.get(f"/-/files/{file_id}/thumbnail")
+    assert Image.open(io.BytesIO(response.content)).size == (150, 200)
+
+
+@pytest.mark.asyncio
+async def test_unknown_thumbnail_cache(upload_dir):
+    ds = _make_datasette(upload_dir, plugin_options={"thumbnail_cache": "redis"})
+    with pytest.raises(ValueError, match="thumbnail_cache"):
+        await ds.invoke_startup()
+
+
+def _response(body):
+    return CachedResponse(body, "image/jpeg", '"etag"')
+
+
+def test_recent_thumbnails_are_bounded_by_bytes():
+    recent = RecentThumbnails(max_bytes=10)
+    recent.put(("a", "200x200"), _response(b"aaaa"))
+    recent.put(("b", "200x200"), _response(b"bbbb"))
+    # Using "a" makes "b" the least recently used
+    assert recent.get(("a", "200x200")).body == b"aaaa"
+    recent.put(("c", "200x200"), _response(b"cccc"))
+    assert recent.get(("b", "200x200")) is None
+    assert recent.get(("a", "200x200")) is not None
+    assert recent.size == 8
+    # Too big to keep at all
+    recent.put(("d", "200x200"), _response(b"d" * 11))
+    assert recent.get(("d", "200x200")) is None
+    assert recent.size == 8
+
+    recent.put(("a", "64x64"), _response(b"a"))
+    recent.discard(["a"])
+    assert recent.get(("a", "200x200")) is None
+    assert recent.get(("a", "64x64")) is None
+    assert recent.size == 4
+
+
+@pytest.mark.asyncio
+async def test_warm_thumbnail_requests_are_served_from_memory(upload_dir, monkeypatch):
+    ds = _make_datasette(
+        upload_dir,
+        permissions={**PERMISSIONS, "files-delete": True},
+        plugin_options={"thumbnail_eager": False},
+    )
+    data = await _upload_file(
+        ds, filename="photo.jpg", content=_jpeg(400, 300), content_type="image/jpeg"
+    )
+    url = f"/-/files/{data['file_id']}/thumbnail"
+    first = await ds.client.get(url)
+    assert first.status_code == 200
+
+    state = datasette_files._thumbnail_state(ds)
+    db = ds.get_internal_database()
+    executed = []
+    original_execute = db.execute
+
+    def spying_execute(sql, *args, **kwargs):
+        executed.append(sql)
+        return original_execute(sql, *args, **kwargs)
+
+    async def no_cache_reads(*args):
+        raise AssertionError("read the thumbnail cache")
+
+    monkeypatch.setattr(db, "execute", spying_execute)
+    monkeypatch.setattr(state.cache, "get", no_cache_reads)
+    monkeypatch.setattr(datasette_files, "_etag_for_bytes", None)
+    second = await ds.client.get(url)
+    assert second.content == first.content
+    assert second.headers["etag"] == first.headers["etag"]
+    assert not [sql for sql in executed if "datasette_files_thumbnail" in sql]
+    not_modified = await ds.client.get(
+        url, headers={"If-None-Match": first.headers["etag"]}
+    )
+    assert not_modified.status_code == 304
+    monkeypatch.undo()
+
+    # Deleting the file forgets it
+    assert state.recent.size > 0
+    response = await ds.client.post(f"/-/files/{data['file_id']}/-/delete")
+    assert response.status_code == 200
+    assert state.recent.size == 0
+
+
+@pytest.mark.asyncio
+async def test_file_type_icons_are_kept_in_memory(upload_dir, monkeypatch):
+    ds = _make_datasette(upload_dir, permissions=PERMISSIONS)
+    file_ids = [
+        (
+            await _upload_file(
+                ds, filename=filename, content=b"text", content_type="text/plain"
+            )
+        )["file_id"]
+        # Different names, same extension: one icon
+        for filename in ("notes.txt", "todo.txt")
+    ]
+    generated = []
+    original = datasette_files._generate_file_icon_svg
+
+    def spy(filename, content_type):
+        generated.append(filename)
+        return original(filename, content_type)
+
+    monkeypatch.setattr(datasette_files, "_generate_file_icon_svg", spy)
+    responses = [
+        await ds.client.get(f"/-/files/{file_id}/thumbnail") for file_id in file_ids
+    ]
+    assert [response.headers["content-type"] for response in responses] == [
+        "image/svg+xml",
+        "image/svg+xml",
+    ]
+    assert responses[0].content == responses[1].content
+    assert generated == ["notes.txt"]
+
+
+@pytest.mark.asyncio
+async def test_icons_for_unsupported_types_skip_the_database(upload_dir, monkeypatch):
+    ds = _make_datasette(
+        upload_dir, permissions=PERMISSIONS, plugin_options={"thumbnail_eager": False}
+    )
+    data = await _upload_file(
+        ds, filename="notes.txt", content=b"notes", content_type="text/plain"
+    )
+    db = ds.get_internal_database()
+    executed = []
+    original_execute = db.execute
+
+    def spying_execute(sql, *args, **kwargs):
+        executed.append(sql)
+        return original_execute(sql, *args, **kwargs)
+
+    monkeypatch.setattr(db, "execute", spying_execute)
+    for _ in range(2):
+        response = await ds.client.get(f"/-/files/{data['file_id']}/thumbnail")
+        assert response.headers["content-type"] == "image/svg+xml"
+    assert not [sql for sql in executed if "datasette_files_thumbnail" in sql]
+
+
+@pytest.mark.asyncio
+async def test_thumbnail_memory_cache_bytes_must_be_positive(upload_dir):
+    ds = _make_datasette(upload_dir, plugin_options={"thumbnail_memory_cache_bytes": 0})
+    with pytest.raises(ValueError, match="thumbnail_memory_cache_bytes"):
+        await ds.invoke_startup()
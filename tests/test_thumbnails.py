@@ -1,6 +1,7 @@
 import asyncio
 import io
 import os
+import sys
 import pytest
 from PIL import Image
 from conftest import _make_datasette, _upload_file
@@ -187,6 +188,21 @@ def _make_test_jpeg(width=400, height=300):
     return buf.getvalue()
 
 
+async def _cached_thumbnails(ds, file_id, row=None):
+    """Return ``{rendition: ThumbnailResult}`` for a file from whichever
+    thumbnail cache ``ds`` uses. Pass ``row`` once the file is deleted."""
+    import datasette_files
+
+    state = datasette_files._thumbnail_state(ds)
+    row = row or await datasette_files._get_file_record(ds, file_id)
+    version = datasette_files._thumbnail_version(row)
+    cache_key = datasette_files._thumbnail_cache_key(state.settings)
+    return {
+        rendition: await state.cache.get(file_id, version, cache_key, rendition)
+        for rendition in await state.cache.renditions(file_id, version, cache_key)
+    }
+
+
 def _make_test_png(width=64, height=48):
     img = Image.new("RGBA", (width, height), color=(0, 128, 255, 180))
     buf = io.BytesIO()
@@ -276,6 +292,7 @@ async def test_thumbnail_endpoint_uses_registered_non_image_generator(upload_dir
         ds = _make_datasette(
             upload_dir,
             permissions={"files-browse": True, "files-upload": True},
+            plugin_options={"thumbnail_cache": "database"},
         )
         data = await _upload_file(
             ds, filename="doc.pdf", content=b"%PDF-fake", content_type="application/pdf"
@@ -303,8 +320,12 @@ async def test_thumbnail_endpoint_uses_registered_non_image_generator(upload_dir
 
 
 @pytest.mark.asyncio
-async def test_thumbnail_is_cached_in_database(datasette_browse_allowed, upload_dir):
-    ds = datasette_browse_allowed
+async def test_thumbnail_is_cached_in_database(upload_dir):
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        plugin_options={"thumbnail_cache": "database"},
+    )
     jpeg_bytes = _make_test_jpeg()
     data = await _upload_file(
         ds, filename="cached.jpg", content=jpeg_bytes, content_type="image/jpeg"
@@ -347,15 +368,8 @@ async def test_thumbnail_generated_on_upload(datasette_browse_allowed, upload_di
     file_id = data["file_id"]
     await _drain_eager_thumbnails()
 
-    # Thumbnail should already be in the database (eager generation)
-    db = ds.get_internal_database()
-    row = (
-        await db.execute(
-            "SELECT file_id FROM datasette_files_thumbnails WHERE file_id = ?",
-            [file_id],
-        )
-    ).first()
-    assert row is not None
+    # Thumbnail should already be cached (eager generation)
+    assert set(await _cached_thumbnails(ds, file_id)) == {"200x200"}
 
 
 @pytest.mark.asyncio
@@ -398,6 +412,7 @@ async def test_thumbnail_generated_on_upload_for_non_image_generator(upload_dir)
         ds = _make_datasette(
             upload_dir,
             permissions={"files-browse": True, "files-upload": True},
+            plugin_options={"thumbnail_cache": "database"},
         )
         data = await _upload_file(
             ds,
@@ -430,10 +445,19 @@ async def test_thumbnail_generated_on_upload_for_non_image_generator(upload_dir)
 
 
 @pytest.mark.asyncio
-async def test_thumbnail_deleted_with_file(datasette_all_permissions, upload_dir):
-    from datasette_files import _drain_eager_thumbnails
+@pytest.mark.parametrize("thumbnail_cache", ["disk", "database"])
+async def test_thumbnail_deleted_with_file(upload_dir, thumbnail_cache):
+    from datasette_files import _drain_eager_thumbnails, _get_file_record
 
-    ds = datasette_all_permissions
+    ds = _make_datasette(
+        upload_dir,
+        permissions={
+            "files-browse": True,
+            "files-upload": True,
+            "files-delete": True,
+        },
+        plugin_options={"thumbnail_cache": thumbnail_cache},
+    )
     jpeg_bytes = _make_test_jpeg(100, 100)
     data = await _upload_file(
         ds, filename="todelete.jpg", content=jpeg_bytes, content_type="image/jpeg"
@@ -443,19 +467,15 @@ async def test_thumbnail_deleted_with_file(datasette_all_permissions, upload_dir
 
     # Generate thumbnail
     await ds.client.get(f"/-/files/{file_id}/thumbnail")
+    row = await _get_file_record(ds, file_id)
+    assert await _cached_thumbnails(ds, file_id, row)
 
     # Delete the file
-    await ds.client.post(f"/-/files/{file_id}/-/delete")
+    response = await ds.client.post(f"/-/files/{file_id}/-/delete")
+    assert response.status_code == 200
 
     # Thumbnail should be gone
-    db = ds.get_internal_database()
-    row = (
-        await db.execute(
-            "SELECT file_id FROM datasette_files_thumbnails WHERE file_id = ?",
-            [file_id],
-        )
-    ).first()
-    assert row is None
+    assert await _cached_thumbnails(ds, file_id, row) == {}
 
 
 # --- Group 7: Resource safety policies ---
@@ -543,13 +563,7 @@ async def test_thumbnail_eager_generation_can_be_disabled(upload_dir):
         content=_make_test_jpeg(),
         content_type="image/jpeg",
     )
-    row = (
-        await ds.get_internal_database().execute(
-            "SELECT file_id FROM datasette_files_thumbnails WHERE file_id = ?",
-            [data["file_id"]],
-        )
-    ).first()
-    assert row is None
+    assert await _cached_thumbnails(ds, data["file_id"]) == {}
 
 
 @pytest.mark.asyncio
@@ -811,13 +825,13 @@ async def test_cached_thumbnail_outcome_needs_a_single_cache_query(upload_dir):
     ds = _make_datasette(
         upload_dir,
         permissions={"files-browse": True, "files-upload": True},
-        plugin_options={"thumbnail_eager": False},
+        plugin_options={"thumbnail_eager": False, "thumbnail_max_source_bytes": 100},
     )
     data = await _upload_file(
-        ds, filename="doc.txt", content=b"hello", content_type="text/plain"
+        ds, filename="big.jpg", content=_make_test_jpeg(), content_type="image/jpeg"
     )
     url = f"/-/files/{data['file_id']}/thumbnail"
-    # First request caches the skipped/unsupported outcome
+    # First request caches the skipped/too_large outcome
     await ds.client.get(url)
 
     db = ds.get_internal_database()
@@ -886,12 +900,108 @@ async def test_generator_can_mark_failure_as_policy_skip(upload_dir):
         pm.unregister(name="undo_SkippingThumbnailPlugin")
 
 
+@pytest.mark.asyncio
+async def test_failed_rendition_leaves_other_renditions_alone(upload_dir):
+    from datasette import hookimpl
+    from datasette.plugins import pm
+    from datasette_files.base import ThumbnailGenerationError
+
+    class NoWebpPlugin:
+        __name__ = "NoWebpThumbnailPlugin"
+
+        @hookimpl
+        def register_thumbnail_generators(self, datasette):
+            class NoWebpGenerator:
+                name = "no-webp"
+                output_formats = ("webp",)
+
+                async def can_generate(self, content_type, filename):
+                    return content_type == "application/x-picture"
+
+                async def generate_renditions(
+                    self, file_bytes, content_type, filename, sizes, format=None
+                ):
+                    if format == "webp":
+                        raise ThumbnailGenerationError("no_encoder")
+                    return [
+                        ThumbnailResult(b"jpeg", "image/jpeg", *size) for size in sizes
+                    ]
+
+            return [NoWebpGenerator()]
+
+    pm.register(NoWebpPlugin(), name="undo_NoWebpThumbnailPlugin")
+    try:
+        ds = _make_datasette(
+            upload_dir,
+            permissions={"files-browse": True, "files-upload": True},
+            plugin_options={"thumbnail_eager": False},
+        )
+        data = await _upload_file(
+            ds,
+            filename="picture.bin",
+            content=b"picture",
+            content_type="application/x-picture",
+        )
+        url = f"/-/files/{data['file_id']}/thumbnail"
+        webp = await ds.client.get(url, headers={"Accept": "image/webp"})
+        assert webp.headers["content-type"] == "image/svg+xml"
+        jpeg = await ds.client.get(url, headers={"Accept": "*/*"})
+        assert jpeg.headers["content-type"] == "image/jpeg"
+        assert jpeg.content == b"jpeg"
+        rows = (
+            await ds.get_internal_database().execute(
+                "SELECT rendition, reason FROM datasette_files_thumbnail_failures WHERE file_id = ?",
+                [data["file_id"]],
+            )
+        ).rows
+        assert [dict(row) for row in rows] == [
+            {"rendition": "200x200.webp", "reason": "no_encoder"}
+        ]
+    finally:
+        pm.unregister(name="undo_NoWebpThumbnailPlugin")
+
+
+@pytest.mark.asyncio
+async def test_thumbnail_failures_migrated_to_renditions(upload_dir):
+    import datasette_files
+
+    ds = _make_datasette(upload_dir, permissions={"files-browse": True})
+    await ds.invoke_startup()
+    db = ds.get_internal_database()
+    # Simulate a database from before failures were kept per rendition
+    await db.execute_write_script("""
+        DROP TABLE datasette_files_thumbnail_failures;
+        CREATE TABLE datasette_files_thumbnail_failures (
+            file_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            generator TEXT,
+            cache_key TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        INSERT INTO datasette_files_thumbnail_failures
+            (file_id, status, reason, cache_key)
+        VALUES ('df-old', 'skipped', 'too_large', 'key');
+        """)
+    await datasette_files.startup(ds)()
+    rows = (
+        await db.execute(
+            "SELECT file_id, rendition, reason FROM datasette_files_thumbnail_failures"
+        )
+    ).rows
+    assert [dict(row) for row in rows] == [
+        {"file_id": "df-old", "rendition": "200x200", "reason": "too_large"}
+    ]
+
+
 @pytest.mark.asyncio
 async def test_existing_thumbnails_survive_upgrade_migration(upload_dir):
     import datasette_files
 
     ds = _make_datasette(
-        upload_dir, permissions={"files-browse": True, "files-upload": True}
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        plugin_options={"thumbnail_cache": "database"},
     )
     data = await _upload_file(
         ds,
@@ -913,12 +1023,19 @@ async def test_existing_thumbnails_survive_upgrade_migration(upload_dir):
         "UPDATE datasette_files SET size = 999999999 WHERE id = ?", [file_id]
     )
 
-    # Simulate a restart against the existing database
+    # Simulate a restart against the existing database, by a version that
+    # keeps thumbnails on disk
+    del ds.config["plugins"]["datasette-files"]["thumbnail_cache"]
     await datasette_files.startup(ds)()
 
     response = await ds.client.get(f"/-/files/{file_id}/thumbnail")
     assert response.status_code == 200
     assert response.headers["content-type"] == "image/jpeg"
+    # Moved out of the internal database
+    assert set(await _cached_thumbnails(ds, file_id)) == {"200x200"}
+    assert (
+        await db.execute("SELECT count(*) FROM datasette_files_thumbnails")
+    ).single_value() == 0
 
 
 @pytest.mark.asyncio
@@ -1054,13 +1171,7 @@ async def test_upload_response_not_blocked_by_thumbnail_queue(upload_dir):
 
     # The deferred eager generation still completes once the slot frees
     await datasette_files._drain_eager_thumbnails()
-    row = (
-        await ds.get_internal_database().execute(
-            "SELECT file_id FROM datasette_files_thumbnails WHERE file_id = ?",
-            [data["file_id"]],
-        )
-    ).first()
-    assert row is not None
+    assert await _cached_thumbnails(ds, data["file_id"])
 
 
 @pytest.mark.asyncio
@@ -1126,3 +1237,580 @@ async def test_pillow_generation_runs_in_an_isolated_process(monkeypatch):
     result = await generator.generate(_make_test_jpeg(), "image/jpeg", "isolated.jpg")
     assert result is not None
     assert spawned and "datasette_files.pillow_worker" in spawned[0]
+
+
+def _spy_on_spawns(monkeypatch):
+    spawned = []
+    real_exec = asyncio.create_subprocess_exec
+
+    async def spying_exec(*args, **kwargs):
+        process = await real_exec(*args, **kwargs)
+        process.args = args
+        spawned.append(process)
+        return process
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", spying_exec)
+    return spawned
+
+
+@pytest.mark.asyncio
+async def test_pillow_workers_are_reused_and_recycled(monkeypatch):
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    spawned = _spy_on_spawns(monkeypatch)
+    generator = PillowThumbnailGenerator(worker_max_jobs=2)
+    try:
+        for i in range(3):
+            result = await generator.generate(
+                _make_test_jpeg(), "image/jpeg", f"{i}.jpg"
+            )
+            assert result.width == 200
+    finally:
+        await generator.close()
+    # Two jobs on the first worker, which then made way for a fresh one
+    assert len(spawned) == 2
+    assert spawned[0].returncode == 0
+
+
+@pytest.mark.asyncio
+async def test_pillow_worker_survives_a_failed_job(monkeypatch):
+    from datasette_files.base import ThumbnailGenerationError
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    spawned = _spy_on_spawns(monkeypatch)
+    generator = PillowThumbnailGenerator()
+    try:
+        with pytest.raises(ThumbnailGenerationError):
+            await generator.generate(b"not an image", "image/jpeg", "bad.jpg")
+        assert await generator.generate(_make_test_jpeg(), "image/jpeg", "ok.jpg")
+    finally:
+        await generator.close()
+    assert len(spawned) == 1
+
+
+@pytest.mark.asyncio
+async def test_dead_pillow_worker_is_replaced(monkeypatch):
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    spawned = _spy_on_spawns(monkeypatch)
+    generator = PillowThumbnailGenerator()
+    try:
+        await generator.generate(_make_test_jpeg(), "image/jpeg", "one.jpg")
+        spawned[0].kill()
+        await spawned[0].wait()
+        result = await generator.generate(_make_test_jpeg(), "image/jpeg", "two.jpg")
+        assert result is not None
+    finally:
+        await generator.close()
+    assert len(spawned) == 2
+
+
+@pytest.mark.asyncio
+async def test_reaped_pillow_worker_is_never_signalled(monkeypatch):
+    from datasette_files import pillow_thumbnails
+
+    spawned = _spy_on_spawns(monkeypatch)
+    generator = pillow_thumbnails.PillowThumbnailGenerator()
+    try:
+        await generator.generate(_make_test_jpeg(), "image/jpeg", "one.jpg")
+        (worker,) = generator.pool._idle
+        spawned[0].kill()
+        await spawned[0].wait()
+
+        # Its PID may already belong to another process
+        def no_kill(pid, sig):
+            raise AssertionError(f"signalled PID {pid}")
+
+        monkeypatch.setattr(os, "kill", no_kill)
+        worker.kill()
+    finally:
+        monkeypatch.undo()
+        await generator.close()
+
+
+@pytest.mark.asyncio
+async def test_pillow_worker_pool_sized_from_concurrency(upload_dir):
+    from datasette_files import register_thumbnail_generators
+
+    ds = _make_datasette(
+        upload_dir,
+        plugin_options={"thumbnail_concurrency": 3, "thumbnail_worker_max_jobs": 7},
+    )
+    (generator,) = register_thumbnail_generators(datasette=ds)
+    assert generator.pool.size == 3
+    assert generator.pool.max_jobs == 7
+
+
+@pytest.mark.asyncio
+async def test_fork_server_forks_workers(monkeypatch):
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    spawned = _spy_on_spawns(monkeypatch)
+    generator = PillowThumbnailGenerator(worker_launch="forkserver", worker_max_jobs=1)
+    try:
+        for i in range(3):
+            result = await generator.generate(
+                _make_test_jpeg(), "image/jpeg", f"{i}.jpg"
+            )
+            assert result.width == 200
+    finally:
+        await generator.close()
+    # One fork server started, which was the only process started directly
+    assert len(spawned) == 1
+    assert "--zygote" in spawned[0].args
+    assert spawned[0].returncode == 0
+
+
+@pytest.mark.asyncio
+async def test_exited_fork_server_worker_is_never_signalled_by_pid(monkeypatch):
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    generator = PillowThumbnailGenerator(worker_launch="forkserver")
+    try:
+        await generator.generate(_make_test_jpeg(), "image/jpeg", "one.jpg")
+        (worker,) = generator.pool._idle
+        if hasattr(os, "pidfd_open"):
+            assert worker.pidfd is not None
+        # The kernel reaps it straight away, freeing its PID for reuse
+        os.kill(worker.pid, 9)
+        for _ in range(100):
+            try:
+                os.kill(worker.pid, 0)
+            except ProcessLookupError:
+                break
+            await asyncio.sleep(0.02)
+        if worker.pidfd is None:
+            # Without pidfds the socket must show it exited
+            assert await worker.reader.read() == b""
+
+        def no_kill(pid, sig):
+            raise AssertionError(f"signalled PID {pid}")
+
+        monkeypatch.setattr(os, "kill", no_kill)
+        worker.kill()
+        assert worker.pidfd is None
+    finally:
+        monkeypatch.undo()
+        await generator.close()
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="RLIMIT_AS is only applied on Linux"
+)
+@pytest.mark.asyncio
+async def test_fork_server_worker_hits_memory_limit_and_is_replaced():
+    from datasette_files.base import ThumbnailGenerationError
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    generator = PillowThumbnailGenerator(
+        worker_launch="forkserver", max_pixels=100_000_000
+    )
+    try:
+        assert await generator.generate(_make_test_jpeg(), "image/jpeg", "a.jpg")
+        # Room for a forked copy of the fork server, not for decoding a big
+        # image. The limit is applied by each new worker on its first job.
+        zygote_pid = generator.pool._fork_server._process.pid
+        with open(f"/proc/{zygote_pid}/status") as status:
+            vm_kb = int(status.read().split("VmSize:")[1].split()[0])
+        generator.memory_limit_bytes = (vm_kb + 32 * 1024) * 1024
+        for worker in generator.pool._idle:
+            await worker.close()
+        generator.pool._idle.clear()
+
+        # A PNG, because a JPEG this size would be decoded at reduced size
+        with pytest.raises(ThumbnailGenerationError) as ex:
+            await generator.generate(_make_test_png(6000, 6000), "image/png", "big.png")
+        assert ex.value.reason == "memory_limit"
+        # The fork server was not limited, and forks a fresh worker
+        assert await generator.generate(_make_test_jpeg(), "image/jpeg", "b.jpg")
+    finally:
+        await generator.close()
+
+
+@pytest.mark.asyncio
+async def test_unknown_worker_launch_mode(upload_dir):
+    ds = _make_datasette(
+        upload_dir, plugin_options={"thumbnail_worker_launch": "spawn"}
+    )
+    with pytest.raises(ValueError, match="thumbnail_worker_launch"):
+        await ds.invoke_startup()
+
+
+@pytest.mark.asyncio
+async def test_pillow_generates_every_size_from_one_job():
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    generator = PillowThumbnailGenerator()
+    jobs = []
+    real_run = generator.pool.run
+
+    async def counting_run(header, body):
+        jobs.append(header)
+        return await real_run(header, body)
+
+    generator.pool.run = counting_run
+    try:
+        results = await generator.generate_renditions(
+            _make_test_jpeg(),
+            "image/jpeg",
+            "sizes.jpg",
+            [(200, 200), (64, 64), (300, 100), (800, 800)],
+        )
+    finally:
+        await generator.close()
+    assert len(jobs) == 1
+    assert [(r.width, r.height) for r in results] == [
+        (200, 150),
+        (64, 48),
+        (133, 100),
+        # Never scaled up
+        (400, 300),
+    ]
+    for result in results:
+        thumb = Image.open(io.BytesIO(result.thumb_bytes))
+        assert thumb.size == (result.width, result.height)
+
+
+@pytest.mark.asyncio
+async def test_thumbnail_sizes_are_served_from_the_whitelist(upload_dir):
+    from datasette_files import _drain_eager_thumbnails
+
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        plugin_options={"thumbnail_sizes": ["200x200", [64, 64]]},
+    )
+    data = await _upload_file(
+        ds, filename="sizes.jpg", content=_make_test_jpeg(), content_type="image/jpeg"
+    )
+    file_id = data["file_id"]
+    await _drain_eager_thumbnails()
+
+    # Eager generation made every configured size
+    cached = await _cached_thumbnails(ds, file_id)
+    assert {rendition: result.width for rendition, result in cached.items()} == {
+        "200x200": 200,
+        "64x64": 64,
+    }
+
+    for query, width in (("", 200), ("?w=64&h=64", 64), ("?w=64", 64)):
+        response = await ds.client.get(f"/-/files/{file_id}/thumbnail{query}")
+        assert response.status_code == 200
+        assert Image.open(io.BytesIO(response.content)).width == width
+
+    response = await ds.client.get(f"/-/files/{file_id}/thumbnail?w=1000&h=1000")
+    assert response.status_code == 400
+    assert response.json()["errors"] == [
+        "Thumbnail size not available, choose from: 200x200, 64x64"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_added_thumbnail_size_is_generated_on_request(upload_dir, tmp_path):
+    import datasette_files
+
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        plugin_options={
+            "thumbnail_sizes": ["200x200", "64x64"],
+            # Kept across the restart below
+            "thumbnail_cache_directory": str(tmp_path / "thumbnails"),
+        },
+    )
+    data = await _upload_file(
+        ds, filename="later.jpg", content=_make_test_jpeg(), content_type="image/jpeg"
+    )
+    file_id = data["file_id"]
+    await datasette_files._drain_eager_thumbnails()
+
+    ds.config["plugins"]["datasette-files"]["thumbnail_sizes"] = ["64x64", "32x32"]
+    await datasette_files.startup(ds)()
+    # The size no longer configured is dropped in the background
+    await asyncio.gather(*datasette_files._sync_tasks)
+    assert set(await _cached_thumbnails(ds, file_id)) == {"64x64"}
+    response = await ds.client.get(f"/-/files/{file_id}/thumbnail?w=32&h=32")
+    assert Image.open(io.BytesIO(response.content)).width == 32
+    assert set(await _cached_thumbnails(ds, file_id)) == {"64x64", "32x32"}
+
+
+@pytest.mark.asyncio
+async def test_thumbnails_keyed_by_file_migrate_to_renditions(upload_dir):
+    ds = _make_datasette(upload_dir, plugin_options={"thumbnail_cache": "database"})
+    db = ds.get_internal_database()
+    await db.execute_write_script("""
+        CREATE TABLE datasette_files_thumbnails (
+            file_id TEXT PRIMARY KEY,
+            thumbnail BLOB NOT NULL,
+            content_type TEXT NOT NULL DEFAULT 'image/png',
+            width INTEGER,
+            height INTEGER,
+            generator TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        INSERT INTO datasette_files_thumbnails (file_id, thumbnail, width)
+        VALUES ('df-legacy', X'00', 200);
+        """)
+    await ds.invoke_startup()
+    rows = (
+        await db.execute(
+            "SELECT file_id, rendition, width, cache_key IS NOT NULL AS adopted "
+            "FROM datasette_files_thumbnails"
+        )
+    ).rows
+    assert [dict(row) for row in rows] == [
+        {"file_id": "df-legacy", "rendition": "200x200", "width": 200, "adopted": 1}
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("sizes", [["big"], ["0x10"], [], "200x200"])
+async def test_invalid_thumbnail_sizes(upload_dir, sizes):
+    ds = _make_datasette(upload_dir, plugin_options={"thumbnail_sizes": sizes})
+    with pytest.raises(ValueError, match="thumbnail_sizes"):
+        await ds.invoke_startup()
+
+
+@pytest.mark.parametrize(
+    "accept,formats,expected",
+    [
+        ("image/avif,image/webp,*/*;q=0.8", ("webp", "avif"), "webp"),
+        ("image/avif,image/webp,*/*;q=0.8", ("avif", "webp"), "avif"),
+        ("image/webp;q=0, image/avif", ("webp", "avif"), "avif"),
+        ("image/webp", ("avif",), None),
+        ("*/*", ("webp", "avif"), None),
+        ("image/*", ("webp", "avif"), None),
+        (None, ("webp", "avif"), None),
+    ],
+)
+def test_negotiate_thumbnail_format(accept, formats, expected):
+    from datasette_files import _negotiate_thumbnail_format
+
+    assert _negotiate_thumbnail_format(accept, formats) == expected
+
+
+@pytest.mark.asyncio
+async def test_thumbnail_format_negotiated_from_accept(datasette_browse_allowed):
+    ds = datasette_browse_allowed
+    data = await _upload_file(
+        ds, filename="photo.jpg", content=_make_test_jpeg(), content_type="image/jpeg"
+    )
+    url = f"/-/files/{data['file_id']}/thumbnail"
+
+    webp = await ds.client.get(url, headers={"Accept": "image/webp,*/*"})
+    assert webp.headers["content-type"] == "image/webp"
+    assert "Accept" in webp.headers["vary"].split(", ")
+    assert Image.open(io.BytesIO(webp.content)).format == "WEBP"
+
+    jpeg = await ds.client.get(url, headers={"Accept": "*/*"})
+    assert jpeg.headers["content-type"] == "image/jpeg"
+    assert "Accept" in jpeg.headers["vary"].split(", ")
+    assert jpeg.headers["etag"] != webp.headers["etag"]
+
+    assert set(await _cached_thumbnails(ds, data["file_id"])) == {
+        "200x200",
+        "200x200.webp",
+    }
+
+
+@pytest.mark.asyncio
+async def test_webp_thumbnail_keeps_transparency():
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    generator = PillowThumbnailGenerator()
+    try:
+        (result,) = await generator.generate_renditions(
+            _make_test_png(400, 300), "image/png", "logo.png", [(200, 200)], "webp"
+        )
+    finally:
+        await generator.close()
+    assert result.content_type == "image/webp"
+    assert Image.open(io.BytesIO(result.thumb_bytes)).mode == "RGBA"
+
+
+@pytest.mark.asyncio
+async def test_thumbnail_formats_can_be_turned_off(upload_dir):
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        plugin_options={"thumbnail_formats": []},
+    )
+    data = await _upload_file(
+        ds, filename="photo.jpg", content=_make_test_jpeg(), content_type="image/jpeg"
+    )
+    response = await ds.client.get(
+        f"/-/files/{data['file_id']}/thumbnail", headers={"Accept": "image/webp"}
+    )
+    assert response.headers["content-type"] == "image/jpeg"
+    assert "Accept" not in response.headers.get("vary", "").split(", ")
+
+
+@pytest.mark.asyncio
+async def test_unknown_thumbnail_format(upload_dir):
+    ds = _make_datasette(upload_dir, plugin_options={"thumbnail_formats": ["heic"]})
+    with pytest.raises(ValueError, match="thumbnail_formats"):
+        await ds.invoke_startup()
+
+
+@pytest.mark.asyncio
+async def test_large_jpeg_is_decoded_at_reduced_size():
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    generator = PillowThumbnailGenerator(max_pixels=1_000_000)
+    try:
+        # 12 megapixels, but libjpeg can decode it at 1/8 size
+        result = await generator.generate(
+            _make_test_jpeg(4000, 3000), "image/jpeg", "camera.jpg"
+        )
+        assert (result.width, result.height) == (200, 150)
+        # Other formats are decoded at full size, so the limit still applies
+        with pytest.raises(Exception, match="too_many_pixels"):
+            await generator.generate(
+                _make_test_png(4000, 3000), "image/png", "poster.png"
+            )
+    finally:
+        await generator.close()
+
+
+@pytest.mark.asyncio
+async def test_reduced_decode_respects_exif_orientation():
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    image = Image.new("RGB", (1600, 800), color="blue")
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotate 90 degrees to display
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", exif=exif)
+
+    generator = PillowThumbnailGenerator()
+    try:
+        results = await generator.generate_renditions(
+            buf.getvalue(), "image/jpeg", "sideways.jpg", [(200, 200), (400, 400)]
+        )
+    finally:
+        await generator.close()
+    assert [(r.width, r.height) for r in results] == [(100, 200), (200, 400)]
+    for result in results:
+        thumb = Image.open(io.BytesIO(result.thumb_bytes))
+        assert thumb.size == (result.width, result.height)
+
+
+def _chunked_storage(content, chunk_size=1000):
+    from datasette_files.base import FileMetadata, Storage, StorageCapabilities
+
+    class ChunkedStorage(Storage):
+        storage_type = "chunked"
+        capabilities = StorageCapabilities()
+
+        async def configure(self, config, get_secret):
+            pass
+
+        async def get_file_metadata(self, path):
+            return FileMetadata(path=path, filename=path, size=len(content))
+
+        async def read_file(self, path):
+            raise AssertionError("the whole file should never be read")
+
+        async def stream_file(self, path):
+            for offset in range(0, len(content), chunk_size):
+                yield content[offset : offset + chunk_size]
+
+    return ChunkedStorage()
+
+
+def _spy_on_jobs(generator):
+    jobs = []
+    real_run = generator.pool.run
+
+    async def spying_run(header, body):
+        jobs.append((header, body))
+        return await real_run(header, body)
+
+    generator.pool.run = spying_run
+    return jobs
+
+
+@pytest.mark.asyncio
+async def test_remote_source_is_streamed_to_the_worker():
+    from datasette_files.base import ThumbnailGenerationError, ThumbnailSource
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    content = _make_test_jpeg()
+    generator = PillowThumbnailGenerator()
+    jobs = _spy_on_jobs(generator)
+    try:
+        source = ThumbnailSource(_chunked_storage(content), "remote.jpg", len(content))
+        (result,) = await generator.generate_from_source(
+            source, "image/jpeg", "remote.jpg", [(200, 200)]
+        )
+        assert (result.width, result.height) == (200, 150)
+        assert not isinstance(jobs[0][1], bytes)
+
+        # Stops streaming as soon as the limit is passed
+        source = ThumbnailSource(
+            _chunked_storage(content, chunk_size=100), "remote.jpg", len(content) // 2
+        )
+        with pytest.raises(ThumbnailGenerationError) as ex:
+            await generator.generate_from_source(
+                source, "image/jpeg", "remote.jpg", [(200, 200)]
+            )
+        assert ex.value.reason == "too_large"
+        assert ex.value.skipped
+        # The half-sent job's worker was replaced
+        assert await generator.generate(content, "image/jpeg", "next.jpg")
+    finally:
+        await generator.close()
+
+
+@pytest.mark.asyncio
+async def test_local_file_is_read_by_the_worker(upload_dir, monkeypatch):
+    import datasette_files
+    from datasette_files.base import Storage
+
+    async def no_reads(*args, **kwargs):
+        raise AssertionError("the file should not be read by Datasette")
+
+    monkeypatch.setattr(Storage, "read_file_limited", no_reads)
+    monkeypatch.setattr(Storage, "stream_file", no_reads)
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        plugin_options={"thumbnail_eager": False},
+    )
+    data = await _upload_file(
+        ds, filename="local.jpg", content=_make_test_jpeg(), content_type="image/jpeg"
+    )
+    (generator,) = datasette_files._thumbnail_generators
+    jobs = _spy_on_jobs(generator)
+
+    response = await ds.client.get(f"/-/files/{data['file_id']}/thumbnail")
+    assert response.headers["content-type"] == "image/jpeg"
+    header, body = jobs[0]
+    assert os.path.isabs(header["path"])
+    assert body == b""
+
+
+@pytest.mark.asyncio
+async def test_worker_refuses_local_file_over_limit(tmp_path):
+    from datasette_files.base import ThumbnailGenerationError, ThumbnailSource
+    from datasette_files.filesystem import FilesystemStorage
+
+    storage = FilesystemStorage()
+    await storage.configure({"root": str(tmp_path)}, None)
+    (tmp_path / "grown.jpg").write_bytes(_make_test_jpeg())
+
+    from datasette_files.pillow_thumbnails import PillowThumbnailGenerator
+
+    generator = PillowThumbnailGenerator()
+    try:
+        with pytest.raises(ThumbnailGenerationError) as ex:
+            await generator.generate_from_source(
+                ThumbnailSource(storage, "grown.jpg", 100),
+                "image/jpeg",
+                "grown.jpg",
+                [(200, 200)],
+            )
+    finally:
+        await generator.close()
+    assert ex.value.reason == "too_large"
+    assert ex.value.skipped
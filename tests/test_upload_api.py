@@ -163,6 +163,114 @@ async def test_content_upload_invalid_token(datasette_all_permissions):
     assert data["ok"] is False
 
 
+@pytest.mark.asyncio
+async def test_put_streams_raw_body(datasette_all_permissions, upload_dir, monkeypatch):
+    from datasette.utils.asgi import Request
+
+    async def no_form(*args, **kwargs):
+        raise AssertionError("PUT uploads must not parse a multipart form")
+
+    monkeypatch.setattr(Request, "form", no_form)
+    ds = datasette_all_permissions
+    prep = await _prepare_upload(ds, filename="raw.txt")
+    token = prep["upload_token"]
+
+    response = await ds.client.put(
+        f"{prep['upload_url']}?token={token}", content=b"Raw body bytes"
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == {"ok": True}
+
+    response = await ds.client.post(
+        "/-/files/upload/test-uploads/-/complete",
+        content=json.dumps({"upload_token": token}),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 201
+    file_id = response.json()["file"]["id"]
+    assert response.json()["file"]["size"] == len(b"Raw body bytes")
+    with open(os.path.join(upload_dir, file_id[3:], "raw.txt"), "rb") as fp:
+        assert fp.read() == b"Raw body bytes"
+
+    # The token cannot receive content twice
+    response = await ds.client.put(
+        f"{prep['upload_url']}?token={token}", content=b"again"
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_put_requires_token(datasette_all_permissions):
+    response = await datasette_all_permissions.client.put(
+        "/-/files/upload/test-uploads/-/upload", content=b"data"
+    )
+    assert response.status_code == 400
+    assert response.json()["errors"] == ["upload_token is required"]
+
+
+@pytest.mark.asyncio
+async def test_put_enforces_max_file_size(upload_dir):
+    from conftest import _make_datasette
+
+    ds = _make_datasette(
+        upload_dir,
+        permissions={"files-upload": True},
+        extra_sources={
+            "test-uploads": {
+                "storage": "filesystem",
+                "config": {"root": upload_dir, "max_file_size": 10},
+            }
+        },
+    )
+    prep = await _prepare_upload(ds, filename="big.txt")
+    response = await ds.client.put(
+        f"{prep['upload_url']}?token={prep['upload_token']}", content=b"x" * 11
+    )
+    assert response.status_code == 413
+    assert all(not files for _, _, files in os.walk(upload_dir))
+
+
+@pytest.mark.asyncio
+async def test_put_disconnect_leaves_no_partial_file(
+    datasette_all_permissions, upload_dir
+):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    prep = await _prepare_upload(ds, filename="partial.txt")
+    token = prep["upload_token"]
+    messages = [
+        {"type": "http.request", "body": b"first half", "more_body": True},
+        {"type": "http.disconnect"},
+    ]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        pass
+
+    path = prep["upload_url"]
+    await ds.app()(
+        {
+            "type": "http",
+            "http_version": "1.1",
+            "method": "PUT",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": f"token={token}".encode(),
+            "headers": [(b"host", b"localhost")],
+        },
+        receive,
+        send,
+    )
+    assert all(not files for _, _, files in os.walk(upload_dir))
+
+    # The token is still usable for a retry
+    response = await ds.client.put(f"{path}?token={token}", content=b"whole")
+    assert response.status_code == 200
+
+
 # --- Complete endpoint ---
 
 
@@ -0,0 +1,315 @@
+"""Tests for the upload token stores."""
+
+import dataclasses
+import json
+import time
+
+import pytest
+from datasette.app import Datasette
+
+import datasette_files
+from datasette_files.tokens import (
+    DatabaseUploadTokenStore,
+    MemoryUploadTokenStore,
+    UploadToken,
+)
+from conftest import _make_datasette, _upload_file
+
+PERMISSIONS = {"files-browse": True, "files-upload": True}
+
+
+def _token(**kwargs):
+    fields = dict(
+        source_slug="test-uploads",
+        filename="a.txt",
+        content_type="text/plain",
+        size=3,
+        path="x/a.txt",
+        file_id="df-x",
+        created_at=time.time(),
+    )
+    fields.update(kwargs)
+    return UploadToken(**fields)
+
+
+def _shared_datasette(upload_dir, internal):
+    return Datasette(
+        memory=True,
+        internal=internal,
+        config={
+            "permissions": PERMISSIONS,
+            "plugins": {
+                "datasette-files": {
+                    "upload_token_store": "database",
+                    "sources": {
+                        "test-uploads": {
+                            "storage": "filesystem",
+                            "config": {"root": upload_dir},
+                        }
+                    },
+                }
+            },
+        },
+    )
+
+
+async def _prepare(ds, size=None):
+    body = {"filename": "hello.txt", "content_type": "text/plain"}
+    if size is not None:
+        body["size"] = size
+    response = await ds.client.post(
+        "/-/files/upload/test-uploads/-/prepare",
+        content=json.dumps(body),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+async def _complete(ds, token):
+    return await ds.client.post(
+        "/-/files/upload/test-uploads/-/complete",
+        content=json.dumps({"upload_token": token}),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+@pytest.mark.asyncio
+async def test_database_store_upload(upload_dir):
+    ds = _make_datasette(
+        upload_dir,
+        permissions=PERMISSIONS,
+        plugin_options={"upload_token_store": "database"},
+    )
+    data = await _upload_file(ds, content=b"stored in the database")
+    download = await ds.client.get(data["file"]["download_url"])
+    assert download.content == b"stored in the database"
+    # Completed tokens are removed
+    db = ds.get_internal_database()
+    count = (
+        await db.execute("SELECT count(*) FROM datasette_files_upload_tokens")
+    ).single_value()
+    assert count == 0
+
+
+@pytest.mark.asyncio
+async def test_database_store_is_shared_between_instances(upload_dir, tmp_path):
+    internal = str(tmp_path / "internal.db")
+    first = _shared_datasette(upload_dir, internal)
+    second = _shared_datasette(upload_dir, internal)
+    await first.invoke_startup()
+    await second.invoke_startup()
+
+    # Prepare on one instance, send the bytes to the other...
+    prep = await _prepare(first, size=5)
+    response = await second.client.put(
+        f"{prep['upload_url']}?token={prep['upload_token']}", content=b"hello"
+    )
+    assert response.status_code == 200, response.text
+
+    # ...and complete on the first again
+    complete = await _complete(first, prep["upload_token"])
+    assert complete.status_code == 201, complete.text
+    download = await second.client.get(complete.json()["file"]["download_url"])
+    assert download.content == b"hello"
+    assert (await _complete(second, prep["upload_token"])).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_database_store_resumable_upload(upload_dir):
+    ds = _make_datasette(
+        upload_dir,
+        permissions=PERMISSIONS,
+        plugin_options={"upload_token_store": "database"},
+    )
+    prep = await _prepare(ds, size=10)
+    headers = {"Content-Type": "application/offset+octet-stream"}
+    for offset in (0, 5):
+        response = await ds.client.patch(
+            prep["resumable_url"],
+            content=b"0123456789"[offset : offset + 5],
+            headers={**headers, "Upload-Offset": str(offset)},
+        )
+        assert response.status_code == 204, response.text
+    head = await ds.client.head(prep["resumable_url"])
+    assert head.headers["upload-offset"] == "10"
+    complete = await _complete(ds, prep["upload_token"])
+    assert complete.status_code == 201, complete.text
+    download = await ds.client.get(complete.json()["file"]["download_url"])
+    assert download.content == b"0123456789"
+
+
+@pytest.mark.asyncio
+async def test_upload_refused_while_token_is_claimed(datasette_all_permissions):
+    ds = datasette_all_permissions
+    prep = await _prepare(ds)
+    tokens = datasette_files._token_store(ds)
+    assert await tokens.claim(prep["upload_token"])
+    response = await ds.client.put(
+        f"{prep['upload_url']}?token={prep['upload_token']}", content=b"hello"
+    )
+    assert response.status_code == 409
+    await tokens.release(prep["upload_token"])
+    response = await ds.client.put(
+        f"{prep['upload_url']}?token={prep['upload_token']}", content=b"hello"
+    )
+    assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_database_store_operations(datasette_all_permissions):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    store = DatabaseUploadTokenStore(ttl=60)
+    await store.startup(ds)
+
+    await store.add("tok_a", _token())
+    assert await store.claim("tok_a")
+    assert not await store.claim("tok_a")
+    await store.release("tok_a")
+    assert await store.claim("tok_a")
+
+    token = await store.get("tok_a")
+    token.offset = 2
+    await store.save("tok_a", token)
+    assert (await store.get("tok_a")).offset == 2
+
+    assert await store.mark_used("tok_a")
+    assert not await store.mark_used("tok_a")
+    assert (await store.get("tok_a")).used
+
+    await store.add("tok_old", _token(created_at=time.time() - 120))
+    assert await store.get("tok_old") is None
+    assert [t.file_id for t in await store.remove_expired()] == ["df-x"]
+
+
+@pytest.mark.asyncio
+async def test_database_store_paths_in_use_uses_index(datasette_all_permissions):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    db = ds.get_internal_database()
+    # A table from before tokens were indexed by path
+    await db.execute_write_script("""
+        DROP TABLE IF EXISTS datasette_files_upload_tokens;
+        CREATE TABLE datasette_files_upload_tokens (
+            token TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            claimed_at REAL,
+            used INTEGER NOT NULL DEFAULT 0,
+            actor_key TEXT NOT NULL DEFAULT ''
+        );
+        """)
+    await db.execute_write(
+        "INSERT INTO datasette_files_upload_tokens VALUES (?, ?, ?, NULL, 0, '')",
+        ["tok_a", json.dumps(dataclasses.asdict(_token())), time.time() + 60],
+    )
+    store = DatabaseUploadTokenStore(ttl=60)
+    await store.startup(ds)
+    await store.add("tok_b", _token(path="y/b.txt"))
+    await store.add("tok_c", _token(source_slug="other", path="z/c.txt"))
+
+    paths = ["x/a.txt", "y/b.txt", "z/c.txt", "w/d.txt"]
+    assert await store.paths_in_use("test-uploads", paths) == {"x/a.txt", "y/b.txt"}
+    plan = (
+        await db.execute(
+            "EXPLAIN QUERY PLAN SELECT path FROM datasette_files_upload_tokens "
+            "WHERE source_slug = ? AND path IN (SELECT value FROM json_each(?))",
+            ["test-uploads", json.dumps(paths)],
+        )
+    ).rows
+    assert any(
+        "datasette_files_upload_tokens_source_path" in row["detail"] for row in plan
+    )
+
+
+@pytest.mark.asyncio
+async def test_unknown_upload_token_store(upload_dir):
+    ds = _make_datasette(upload_dir, plugin_options={"upload_token_store": "redis"})
+    with pytest.raises(ValueError, match="Unknown upload_token_store 'redis'"):
+        await ds.invoke_startup()
+
+
+@pytest.mark.asyncio
+async def test_memory_store_expires_oldest_first():
+    store = MemoryUploadTokenStore(ttl=60)
+    now = time.time()
+    await store.add("tok_old", _token(file_id="df-old", created_at=now - 120))
+    await store.add("tok_done", _token(file_id="df-done", created_at=now - 90))
+    await store.add("tok_busy", _token(file_id="df-busy", created_at=now - 80))
+    await store.add("tok_new", _token(file_id="df-new", created_at=now))
+    await store.remove("tok_done")
+    assert await store.claim("tok_busy")
+
+    assert [t.file_id for t in await store.remove_expired()] == ["df-old"]
+    assert await store.get("tok_new") is not None
+    # Only the unexpired token is left to look at
+    assert [token for _, token in store._expiry] == ["tok_new"]
+
+    # The claimed token goes once it is released
+    assert await store.remove_expired() == []
+    await store.release("tok_busy")
+    assert [t.file_id for t in await store.remove_expired()] == ["df-busy"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "store_cls", [MemoryUploadTokenStore, DatabaseUploadTokenStore]
+)
+async def test_store_limits_tokens_per_actor(store_cls, datasette_all_permissions):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    store = store_cls(ttl=60, max_per_actor=2)
+    await store.startup(ds)
+    alice = {"id": "alice"}
+    assert await store.add("tok_1", _token(actor=alice))
+    assert await store.add("tok_2", _token(actor=alice))
+    assert not await store.add("tok_3", _token(actor=alice))
+    # Other actors have their own allowance
+    assert await store.add("tok_4", _token(actor={"id": "bob"}))
+    assert await store.add("tok_5", _token())
+    # Completed and expired tokens no longer count
+    await store.remove("tok_1")
+    assert await store.add("tok_3", _token(actor=alice))
+    await store.add("tok_old", _token(actor={"id": "carol"}, created_at=0))
+    await store.remove_expired()
+    assert await store.add("tok_6", _token(actor={"id": "carol"}))
+    assert await store.add("tok_7", _token(actor={"id": "carol"}))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("token_store", ["memory", "database"])
+async def test_prepare_refused_over_pending_upload_limit(upload_dir, token_store):
+    ds = _make_datasette(
+        upload_dir,
+        permissions=PERMISSIONS,
+        plugin_options={
+            "upload_token_store": token_store,
+            "max_pending_uploads_per_actor": 2,
+        },
+    )
+    first = await _prepare(ds)
+    await _prepare(ds)
+    response = await ds.client.post(
+        "/-/files/upload/test-uploads/-/prepare",
+        content=json.dumps({"filename": "three.txt"}),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 429
+    assert response.json()["ok"] is False
+
+    upload = await ds.client.put(
+        f"{first['upload_url']}?token={first['upload_token']}", content=b"hi"
+    )
+    assert upload.status_code == 200
+    assert (await _complete(ds, first["upload_token"])).status_code == 201
+    await _prepare(ds)
+
+
+@pytest.mark.asyncio
+async def test_max_pending_uploads_must_be_positive(upload_dir):
+    ds = _make_datasette(
+        upload_dir, plugin_options={"max_pending_uploads_per_actor": 0}
+    )
+    with pytest.raises(ValueError, match="max_pending_uploads_per_actor"):
+        await ds.invoke_startup()
@@ -0,0 +1,209 @@
+"""Tests for keeping a filesystem source's catalog current with a watcher."""
+
+import asyncio
+import json
+import os
+import shutil
+import threading
+
+import pytest
+
+import datasette_files
+from datasette_files.watch import InotifyWatcher, WatchBatch, inotify_available
+from conftest import _make_datasette
+
+needs_inotify = pytest.mark.skipif(
+    not inotify_available(), reason="inotify is not available"
+)
+
+
+def _write(upload_dir, path, content=b"data"):
+    full = os.path.join(upload_dir, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, "wb") as f:
+        f.write(content)
+
+
+async def _catalog(ds):
+    db = ds.get_internal_database()
+    rows = (await db.execute("SELECT id, path, size FROM datasette_files")).rows
+    return {row["path"]: dict(row) for row in rows}
+
+
+async def _wait_for(ds, check):
+    for _ in range(300):
+        catalog = await _catalog(ds)
+        if check(catalog):
+            return catalog
+        await asyncio.sleep(0.01)
+    assert check(await _catalog(ds))
+
+
+def _watched_datasette(upload_dir, **source_options):
+    return _make_datasette(
+        upload_dir,
+        permissions={"files-browse": True, "files-upload": True},
+        extra_sources={
+            "test-uploads": {
+                "storage": "filesystem",
+                "config": {"root": upload_dir},
+                "watch": True,
+                "watch_debounce": 0.02,
+                **source_options,
+            }
+        },
+    )
+
+
+async def _started(upload_dir, **source_options):
+    ds = _watched_datasette(upload_dir, **source_options)
+    await ds.invoke_startup()
+    # Wait for the watches to be in place
+    await _wait_for(ds, lambda catalog: "ready.txt" in catalog)
+    return ds
+
+
+@needs_inotify
+@pytest.mark.asyncio
+async def test_watcher_follows_file_changes(upload_dir):
+    _write(upload_dir, "ready.txt")
+    ds = await _started(upload_dir)
+
+    _write(upload_dir, "a.txt", b"aaa")
+    catalog = await _wait_for(ds, lambda catalog: "a.txt" in catalog)
+    file_id = catalog["a.txt"]["id"]
+
+    _write(upload_dir, "a.txt", b"aaaaaa")
+    await _wait_for(ds, lambda catalog: catalog["a.txt"]["size"] == 6)
+
+    os.rename(os.path.join(upload_dir, "a.txt"), os.path.join(upload_dir, "b.txt"))
+    catalog = await _wait_for(
+        ds, lambda catalog: "b.txt" in catalog and "a.txt" not in catalog
+    )
+
+    # Moved back, it gets its old ID again
+    os.rename(os.path.join(upload_dir, "b.txt"), os.path.join(upload_dir, "a.txt"))
+    catalog = await _wait_for(ds, lambda catalog: "a.txt" in catalog)
+    assert catalog["a.txt"]["id"] == file_id
+
+    os.unlink(os.path.join(upload_dir, "a.txt"))
+    await _wait_for(ds, lambda catalog: "a.txt" not in catalog)
+
+
+@needs_inotify
+@pytest.mark.asyncio
+async def test_watcher_follows_directories(upload_dir, tmp_path):
+    _write(upload_dir, "ready.txt")
+    ds = await _started(upload_dir)
+
+    # A tree moved in from elsewhere arrives complete
+    outside = tmp_path / "outside"
+    _write(str(outside), "one.txt")
+    _write(str(outside), "deeper/two.txt")
+    shutil.move(str(outside), os.path.join(upload_dir, "album"))
+    await _wait_for(
+        ds,
+        lambda catalog: {"album/one.txt", "album/deeper/two.txt"} <= set(catalog),
+    )
+
+    # New directories inside it are watched too
+    _write(upload_dir, "album/deeper/still/three.txt")
+    await _wait_for(ds, lambda catalog: "album/deeper/still/three.txt" in catalog)
+
+    shutil.rmtree(os.path.join(upload_dir, "album"))
+    catalog = await _wait_for(
+        ds, lambda catalog: not any(p.startswith("album/") for p in catalog)
+    )
+    assert set(catalog) == {"ready.txt"}
+
+
+@needs_inotify
+@pytest.mark.asyncio
+async def test_new_directories_are_walked_off_the_event_loop(upload_dir, monkeypatch):
+    walked_on = []
+    original = InotifyWatcher._add_watches
+
+    def spy(self, directory):
+        walked_on.append((directory, threading.current_thread()))
+        return original(self, directory)
+
+    monkeypatch.setattr(InotifyWatcher, "_add_watches", spy)
+    _write(upload_dir, "ready.txt")
+    ds = await _started(upload_dir)
+    _write(upload_dir, "album/deeper/one.txt")
+    await _wait_for(ds, lambda catalog: "album/deeper/one.txt" in catalog)
+    assert "album" in [directory for directory, _ in walked_on]
+    assert threading.main_thread() not in [thread for _, thread in walked_on]
+
+
+@needs_inotify
+@pytest.mark.asyncio
+async def test_watched_uploads_register_once(upload_dir):
+    _write(upload_dir, "ready.txt")
+    ds = await _started(upload_dir)
+    prepare = await ds.client.post(
+        "/-/files/upload/test-uploads/-/prepare",
+        content=json.dumps({"filename": "up.txt", "size": 5}),
+        headers={"Content-Type": "application/json"},
+    )
+    prep = prepare.json()
+    await ds.client.put(
+        f"{prep['upload_url']}?token={prep['upload_token']}", content=b"hello"
+    )
+    # The watcher sees the file land before the upload is completed, but
+    # leaves it to the upload
+    _write(upload_dir, "after.txt")
+    catalog = await _wait_for(ds, lambda catalog: "after.txt" in catalog)
+    assert not any(p.endswith("/up.txt") for p in catalog)
+
+    complete = await ds.client.post(
+        "/-/files/upload/test-uploads/-/complete",
+        content=json.dumps({"upload_token": prep["upload_token"]}),
+        headers={"Content-Type": "application/json"},
+    )
+    assert complete.status_code == 201, complete.text
+    file_id = complete.json()["file"]["id"]
+    catalog = await _catalog(ds)
+    assert [
+        row["id"] for row in catalog.values() if row["path"].endswith("/up.txt")
+    ] == [file_id]
+    # Nothing from the reserved directory is catalogued
+    assert not any(p.startswith(".datasette-files") for p in catalog)
+
+
+@pytest.mark.asyncio
+async def test_watch_falls_back_to_polling(upload_dir, monkeypatch):
+    monkeypatch.setattr(datasette_files, "inotify_available", lambda: False)
+    _write(upload_dir, "polled.txt")
+    ds = _watched_datasette(upload_dir)
+    await ds.invoke_startup()
+    await _wait_for(ds, lambda catalog: "polled.txt" in catalog)
+
+
+@pytest.mark.asyncio
+async def test_sync_paths_only_touches_given_paths(
+    datasette_all_permissions, upload_dir
+):
+    ds = datasette_all_permissions
+    await ds.invoke_startup()
+    _write(upload_dir, "a.txt")
+    _write(upload_dir, "b.txt")
+    _write(upload_dir, "dir/c.txt")
+    batch = WatchBatch(
+        paths={"a.txt", "gone.txt", ".datasette-files/tmp/x"}, added_dirs={"dir"}
+    )
+    await datasette_files._apply_watch_batch(ds, "test-uploads", batch)
+    assert set(await _catalog(ds)) == {"a.txt", "dir/c.txt"}
+
+    os.unlink(os.path.join(upload_dir, "a.txt"))
+    shutil.rmtree(os.path.join(upload_dir, "dir"))
+    batch = WatchBatch(paths={"a.txt"}, removed_dirs={"dir"})
+    await datasette_files._apply_watch_batch(ds, "test-uploads", batch)
+    assert await _catalog(ds) == {}
+
+
+@pytest.mark.asyncio
+async def test_watch_debounce_must_be_positive(upload_dir):
+    ds = _watched_datasette(upload_dir, watch_debounce=0)
+    with pytest.raises(ValueError, match="watch_debounce"):
+        await ds.invoke_startup()